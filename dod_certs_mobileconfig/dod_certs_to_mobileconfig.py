@@ -8,23 +8,42 @@
 # Version       : 0.1
 # Changelog     : 11/17/2021 - Initial Script
 
+import asyncio
 import base64
-import io
+import hashlib
+import json
 import optparse
 import os
 import os.path
+import posixpath
 import re
+import shutil
 import ssl
-import subprocess
 import sys
 import tempfile
+import time
+import urllib.error
 import urllib.request
 import zipfile
+from datetime import datetime, timedelta, timezone
 from html.parser import HTMLParser
 from pathlib import Path
-from plistlib import dump
+from plistlib import FMT_BINARY, FMT_XML, dumps, loads
 from urllib.parse import urlparse
-from uuid import uuid4
+from uuid import NAMESPACE_URL, uuid4, uuid5
+
+# PKI families published by the DOD PKE library, and the URL of their bundles
+BUNDLE_SOURCES = ("DoD", "ECA", "JITC", "WCF")
+BUNDLE_URL = "https://dl.dod.cyber.mil/wp-content/uploads/pki-pke/zip/unclass-certificates_pkcs7_{}.zip"
+
+# Seconds to wait before retrying a failed download, doubled on every attempt
+RETRY_DELAY = 1.0
+
+# Downloads up to this size are kept in memory, larger ones spill to a temporary file
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Files of the hashed export layout, <subject hash>.N and <subject hash>.N.der
+HASHED_EXPORT_NAME = re.compile(r"[0-9a-f]{8}\.\d+(\.der)?")
 
 
 class URLHtmlParser(HTMLParser):
@@ -40,8 +59,574 @@ class URLHtmlParser(HTMLParser):
                 break
 
 
+# ASN.1 object identifiers used when decoding certificates
+OID_SIGNED_DATA = "1.2.840.113549.1.7.2"
+OID_COMMON_NAME = "2.5.4.3"
+OID_ORGANIZATIONAL_UNIT = "2.5.4.11"
+OID_SUBJECT_KEY_ID = "2.5.29.14"
+OID_AUTHORITY_KEY_ID = "2.5.29.35"
+
+# DER string types that may hold attribute values in a Name, and their codecs
+DER_STRING_CODECS = {
+    0x0C: "utf-8",  # UTF8String
+    0x13: "ascii",  # PrintableString
+    0x14: "latin-1",  # T61String
+    0x16: "ascii",  # IA5String
+    0x1A: "ascii",  # VisibleString
+    0x1C: "utf-32-be",  # UniversalString
+    0x1E: "utf-16-be",  # BMPString
+}
+
+
+def _der_read(data, offset, end=None):
+    """Read the DER element starting at offset.
+
+    Constructed elements may also use the BER indefinite length encoding, which
+    some tools write p7b files with; their content ends before the end-of-contents
+    octets.  Returns a tuple of (tag, content start, content end).
+    """
+    end = len(data) if end is None else end
+    if offset + 2 > end:
+        raise ValueError("Truncated DER element")
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7F
+        if size == 0:
+            if not tag & 0x20:
+                raise ValueError("Indefinite length on a primitive element")
+            content_end = offset
+            while True:
+                if content_end + 2 > end:
+                    raise ValueError("Truncated BER element")
+                if data[content_end : content_end + 2] == b"\x00\x00":
+                    return tag, offset, content_end
+                content_end = _der_next(data, content_end, end)
+        length = int.from_bytes(data[offset : offset + size], "big")
+        offset += size
+    if offset + length > end:
+        raise ValueError("Truncated DER element")
+    return tag, offset, offset + length
+
+
+def _der_next(data, offset, end):
+    """Return the offset following the element starting at offset."""
+    _, _, content_end = _der_read(data, offset, end)
+    # skip the end-of-contents octets of an indefinite length element
+    return content_end + 2 if data[offset + 1] == 0x80 else content_end
+
+
+def _der_children(data, start, end):
+    """Yield (tag, content start, content end, element start) for each element in data[start:end]."""
+    offset = start
+    while offset < end:
+        tag, content_start, content_end = _der_read(data, offset, end)
+        yield tag, content_start, content_end, offset
+        offset = content_end + 2 if data[offset + 1] == 0x80 else content_end
+
+
+def _der_oid(data):
+    """Decode the content bytes of an OBJECT IDENTIFIER."""
+    arcs = []
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(value)
+            value = 0
+    if not arcs:
+        raise ValueError("Empty OBJECT IDENTIFIER")
+    first = min(arcs[0] // 40, 2)
+    return ".".join(str(arc) for arc in [first, arcs[0] - first * 40] + arcs[1:])
+
+
+def _der_name(data, start, end):
+    """Decode a Name into a list of (oid, value) tuples in encoded order."""
+    attributes = []
+    for _, set_start, set_end, _ in _der_children(data, start, end):
+        for _, seq_start, seq_end, _ in _der_children(data, set_start, set_end):
+            fields = list(_der_children(data, seq_start, seq_end))
+            if len(fields) != 2:
+                raise ValueError("Malformed Name attribute")
+            oid = _der_oid(data[fields[0][1] : fields[0][2]])
+            tag, value_start, value_end, _ = fields[1]
+            raw = data[value_start:value_end]
+            codec = DER_STRING_CODECS.get(tag)
+            value = raw.decode(codec, errors="replace") if codec else raw.hex()
+            attributes.append((oid, value))
+    return attributes
+
+
+def _der_encode(tag, content):
+    """Encode a DER element."""
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    size = (length.bit_length() + 7) // 8
+    return bytes([tag, 0x80 | size]) + length.to_bytes(size, "big") + content
+
+
+def _der_name_hash(data, start, end):
+    """Compute OpenSSL's hash of a Name (X509_NAME_hash), which c_rehash names files by.
+
+    The hash is over the canonical encoding of the Name: its RDN sets without the
+    outer SEQUENCE, with string values as UTF8String, lower cased, stripped and with
+    runs of whitespace collapsed.  It is the first four bytes of the SHA-1 of that,
+    read little endian.
+    """
+    canonical = []
+    for _, set_start, set_end, _ in _der_children(data, start, end):
+        entries = []
+        for _, seq_start, seq_end, _ in _der_children(data, set_start, set_end):
+            fields = list(_der_children(data, seq_start, seq_end))
+            if len(fields) != 2:
+                raise ValueError("Malformed Name attribute")
+            oid = data[fields[0][3] : fields[0][2]]
+            tag, value_start, value_end, _ = fields[1]
+            value = data[value_start:value_end]
+            codec = DER_STRING_CODECS.get(tag)
+            if codec:
+                value = value.decode(codec, errors="replace").encode("utf-8")
+                value = re.sub(rb"[ \t\n\v\f\r]+", b" ", value.strip(b" \t\n\v\f\r")).lower()
+                tag = 0x0C
+            entries.append(_der_encode(0x30, oid + _der_encode(tag, value)))
+        canonical.append(_der_encode(0x31, b"".join(sorted(entries))))
+    digest = hashlib.sha1(b"".join(canonical)).digest()
+    return int.from_bytes(digest[:4], "little")
+
+
+def _der_time(data, start, end, tag):
+    """Decode the content of a UTCTime or GeneralizedTime."""
+    text = data[start:end].decode("ascii")
+    if tag == 0x17:  # UTCTime has a two digit year
+        text = ("19" if int(text[:2]) >= 50 else "20") + text
+    return datetime.strptime(text[:14], "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+
+
+def _display_name(attributes):
+    """Return the last CN of a Name, falling back to the last OU, then any value."""
+    for oid in (OID_COMMON_NAME, OID_ORGANIZATIONAL_UNIT):
+        values = [value for attr_oid, value in attributes if attr_oid == oid]
+        if values:
+            return values[-1]
+    return attributes[-1][1] if attributes else ""
+
+
+class Certificate:
+    """An X.509 certificate decoded from its DER encoding."""
+
+    def __init__(self, der):
+        self.der = bytes(der)
+        _, cert_start, cert_end = _der_read(self.der, 0)
+        _, tbs_start, tbs_end = _der_read(self.der, cert_start, cert_end)
+
+        fields = list(_der_children(self.der, tbs_start, tbs_end))
+        if fields and fields[0][0] == 0xA0:  # explicit version
+            fields = fields[1:]
+        if len(fields) < 6:
+            raise ValueError("Malformed certificate")
+        # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo, ...
+        self.issuer = _der_name(self.der, fields[2][1], fields[2][2])
+        self.subject = _der_name(self.der, fields[4][1], fields[4][2])
+        self.issuer_der = self.der[fields[2][3] : fields[2][2]]
+        self.subject_der = self.der[fields[4][3] : fields[4][2]]
+
+        # Validity ::= SEQUENCE { notBefore Time, notAfter Time }
+        validity = list(_der_children(self.der, fields[3][1], fields[3][2]))
+        if len(validity) != 2:
+            raise ValueError("Malformed certificate validity")
+        self.not_before = _der_time(self.der, validity[0][1], validity[0][2], validity[0][0])
+        self.not_after = _der_time(self.der, validity[1][1], validity[1][2], validity[1][0])
+
+        self.subject_key_id = None
+        self.authority_key_id = None
+        for tag, start, end, _ in fields[6:]:
+            if tag == 0xA3:  # extensions
+                self._read_extensions(start, end)
+
+        self.name = _display_name(self.subject)
+        self.issuer_name = _display_name(self.issuer)
+        self.fingerprint = hashlib.sha256(self.der).hexdigest()
+
+    def _read_extensions(self, start, end):
+        """Pick the key identifiers out of the [3] EXPLICIT extensions field."""
+        _, seq_start, seq_end = _der_read(self.der, start, end)
+        for _, ext_start, ext_end, _ in _der_children(self.der, seq_start, seq_end):
+            # Extension ::= SEQUENCE { extnID, critical BOOLEAN DEFAULT FALSE, extnValue OCTET STRING }
+            parts = list(_der_children(self.der, ext_start, ext_end))
+            if len(parts) < 2:
+                raise ValueError("Malformed certificate extension")
+            oid = _der_oid(self.der[parts[0][1] : parts[0][2]])
+            if oid not in (OID_SUBJECT_KEY_ID, OID_AUTHORITY_KEY_ID):
+                continue
+            _, value_start, value_end = _der_read(self.der, parts[-1][1], parts[-1][2])
+            if oid == OID_SUBJECT_KEY_ID:
+                self.subject_key_id = self.der[value_start:value_end]
+                continue
+            for tag, id_start, id_end, _ in _der_children(self.der, value_start, value_end):
+                if tag == 0x80:  # [0] keyIdentifier
+                    self.authority_key_id = self.der[id_start:id_end]
+
+    @property
+    def subject_hash(self):
+        """OpenSSL's hash of the subject, as printed by openssl x509 -subject_hash."""
+        _, start, end = _der_read(self.subject_der, 0)
+        return _der_name_hash(self.subject_der, start, end)
+
+    @property
+    def self_signed(self):
+        """True if the certificate is its own issuer."""
+        if self.subject_der != self.issuer_der:
+            return False
+        return (
+            self.authority_key_id is None
+            or self.subject_key_id is None
+            or self.authority_key_id == self.subject_key_id
+        )
+
+    def pem(self):
+        """Return the certificate in PEM format."""
+        body = base64.b64encode(self.der).decode("ascii")
+        lines = [body[i : i + 64] for i in range(0, len(body), 64)]
+        return "-----BEGIN CERTIFICATE-----\n" + "\n".join(lines) + "\n-----END CERTIFICATE-----\n"
+
+
+def _pem_blocks(text, label):
+    """Return the decoded bodies of all PEM blocks with the given label."""
+    regex = re.compile(
+        f"-----BEGIN {label}-----(.*?)-----END {label}-----", flags=re.DOTALL
+    )
+    return [base64.b64decode("".join(body.split())) for body in regex.findall(text)]
+
+
+def pkcs7_der_certificates(data):
+    """Return the DER encodings of the certificates in a PKCS#7 (p7b) bundle.
+
+    Accepts the DER (or BER) encoding as well as PEM, either a PKCS7 block or a
+    list of CERTIFICATE blocks, and returns the certificates in bundle order.
+    Raises ValueError if data is none of these.
+    """
+    if data.lstrip().startswith(b"-----BEGIN"):
+        text = data.decode("ascii", errors="replace")
+        certs = _pem_blocks(text, "CERTIFICATE")
+        if certs:
+            return certs
+        bundles = _pem_blocks(text, "PKCS7")
+        if not bundles:
+            raise ValueError("No PKCS7 or CERTIFICATE PEM block found")
+        return [der for bundle in bundles for der in pkcs7_der_certificates(bundle)]
+
+    # ContentInfo ::= SEQUENCE { contentType OID, content [0] EXPLICIT ANY }
+    if data[:1] != b"\x30":
+        raise ValueError("Not a DER or PEM encoded PKCS#7 bundle")
+    _, info_start, info_end = _der_read(data, 0)
+    fields = list(_der_children(data, info_start, info_end))
+    if len(fields) < 2 or _der_oid(data[fields[0][1] : fields[0][2]]) != OID_SIGNED_DATA:
+        raise ValueError("Not a PKCS#7 SignedData bundle")
+    _, signed_start, signed_end = _der_read(data, fields[1][1], fields[1][2])
+
+    # SignedData ::= SEQUENCE { version, digestAlgorithms, encapContentInfo,
+    #                           certificates [0] IMPLICIT OPTIONAL, ... }
+    certificates = []
+    for tag, start, end, _ in _der_children(data, signed_start, signed_end):
+        if tag != 0xA0:
+            continue
+        for cert_tag, _, cert_end, cert_start in _der_children(data, start, end):
+            if cert_tag == 0x30:  # skip attribute certificates and other choices
+                certificates.append(data[cert_start:cert_end])
+    return certificates
+
+
+def pkcs7_content(data):
+    """Return the signed content of a PKCS#7 SignedData structure, such as a signed profile."""
+    _, info_start, info_end = _der_read(data, 0)
+    fields = list(_der_children(data, info_start, info_end))
+    if _der_oid(data[fields[0][1] : fields[0][2]]) != OID_SIGNED_DATA:
+        raise ValueError("Not a PKCS#7 SignedData structure")
+    _, signed_start, signed_end = _der_read(data, fields[1][1], fields[1][2])
+
+    # encapContentInfo ::= SEQUENCE { eContentType, eContent [0] EXPLICIT OCTET STRING }
+    encap = list(_der_children(data, signed_start, signed_end))[2]
+    parts = list(_der_children(data, encap[1], encap[2]))
+    tag, content_start, content_end = _der_read(data, parts[1][1], parts[1][2])
+    if tag == 0x24:  # BER splits the content into a constructed OCTET STRING of chunks
+        return b"".join(data[start:end] for _, start, end, _ in _der_children(data, content_start, content_end))
+    return data[content_start:content_end]
+
+
+def load_pkcs7_certificates(data):
+    """Decode the certificates of a PKCS#7 (p7b) bundle in bundle order."""
+    return [Certificate(der) for der in pkcs7_der_certificates(data)]
+
+
+class CertificateIndex:
+    """Certificates of one or more bundles keyed by SHA-256 fingerprint.
+
+    Overlapping bundles contribute each certificate once, in the order it was
+    first seen, and only that first copy is decoded.  Iterating yields the
+    unique certificates.
+    """
+
+    def __init__(self):
+        self.certificates = {}
+        self.bundles = []
+
+    def add_bundle(self, source, data):
+        """Add the certificates of a bundle, returning the number of duplicates dropped."""
+        return self.add_der_certificates(source, pkcs7_der_certificates(data))
+
+    def add_der_certificates(self, source, ders):
+        """Add the DER encoded certificates of a bundle, returning the number of duplicates dropped."""
+        dropped = 0
+        for der in ders:
+            fingerprint = hashlib.sha256(der).hexdigest()
+            if fingerprint in self.certificates:
+                dropped += 1
+            else:
+                self.certificates[fingerprint] = Certificate(der)
+        self.bundles.append((source, len(ders), dropped))
+        return dropped
+
+    def __iter__(self):
+        return iter(self.certificates.values())
+
+    def __len__(self):
+        return len(self.certificates)
+
+    def summary(self):
+        """Return a line per bundle with the number of duplicates dropped."""
+        lines = [
+            f"{source}: {total} certificates, {dropped} duplicates dropped"
+            for source, total, dropped in self.bundles
+        ]
+        lines.append(f"{len(self)} unique certificates")
+        return "\n".join(lines)
+
+
+class CertificateGraph:
+    """Subject, issuer and key identifier index over a set of certificates.
+
+    Every certificate is linked to its issuer by authority key identifier,
+    falling back to the issuer name, and gets the depth of its chain below the
+    top certificate.  Chains topped by a self-signed root are anchored, the
+    others start with an orphaned intermediate whose issuer is not in the set.
+    Each certificate is visited once, so building the index is linear.
+    """
+
+    def __init__(self, certificates):
+        self.certificates = list(certificates)
+        by_key_id = {}
+        by_subject = {}
+        for cert in self.certificates:
+            if cert.subject_key_id is not None:
+                by_key_id.setdefault(cert.subject_key_id, cert)
+            by_subject.setdefault(cert.subject_der, []).append(cert)
+
+        self.issuers = {}
+        for cert in self.certificates:
+            if cert.self_signed:
+                continue
+            issuer = by_key_id.get(cert.authority_key_id)
+            if issuer is None:
+                issuer = next(
+                    (c for c in by_subject.get(cert.issuer_der, ()) if c is not cert), None
+                )
+            if issuer is not None and issuer is not cert:
+                self.issuers[cert.fingerprint] = issuer
+
+        self.depths = {}
+        self.anchored = {}
+        for cert in self.certificates:
+            # walk up until a certificate with a known depth, the top of the chain or a cycle
+            path = []
+            on_path = set()
+            node = cert
+            while node.fingerprint not in self.depths and node.fingerprint not in on_path:
+                path.append(node)
+                on_path.add(node.fingerprint)
+                issuer = self.issuers.get(node.fingerprint)
+                if issuer is None:
+                    break
+                node = issuer
+            if node.fingerprint not in self.depths:
+                self.depths[node.fingerprint] = 0
+                self.anchored[node.fingerprint] = node.self_signed
+            for node in reversed(path):
+                if node.fingerprint in self.depths:
+                    continue
+                issuer = self.issuers[node.fingerprint]
+                self.depths[node.fingerprint] = self.depths[issuer.fingerprint] + 1
+                self.anchored[node.fingerprint] = self.anchored[issuer.fingerprint]
+
+    def orphans(self):
+        """Return the intermediates whose issuer is not in the set."""
+        return [
+            cert
+            for cert in self.certificates
+            if self.depths[cert.fingerprint] == 0 and not cert.self_signed
+        ]
+
+    def ordered(self):
+        """Return the certificates sorted in chain order.
+
+        Roots come first, then intermediates by depth, then the chains below
+        orphaned intermediates.  Certificates at the same depth are ordered by
+        name and fingerprint, so the order does not depend on the bundles.
+        This is a sort on the depths computed when the graph was built.
+        """
+        return sorted(
+            self.certificates,
+            key=lambda cert: (
+                not self.anchored[cert.fingerprint],
+                self.depths[cert.fingerprint],
+                cert.name,
+                cert.fingerprint,
+            ),
+        )
+
+
+class CertificateExport:
+    """Writes certificates to a folder, as <name>.pem or in a hashed layout.
+
+    The hashed layout is the one c_rehash creates, so the folder can be used as an
+    OpenSSL CApath: each certificate is stored as <subject hash>.N in PEM, with a DER
+    copy in <subject hash>.N.der, and index.json maps fingerprints to the files.
+    Hashed files left from an earlier export are removed on close, so a CA that
+    was dropped from the bundle is no longer trusted through the folder.  Each
+    certificate is written once however many profiles include it.
+    """
+
+    def __init__(self, directory="./certs", layout="pem"):
+        self.directory = directory
+        self.layout = layout
+        self.files = {}
+        self.names = set()
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+    def write(self, cert):
+        if cert.fingerprint in self.files:
+            return
+
+        if self.layout == "hashed":
+            index = 0
+            while f"{cert.subject_hash:08x}.{index}" in self.names:
+                index += 1
+            pem_name = f"{cert.subject_hash:08x}.{index}"
+            der_name = pem_name + ".der"
+        else:
+            # names may contain path separators, and different certificates may share one
+            name = re.sub(r"[/\\:]", "_", cert.name) or cert.fingerprint
+            if f"{name}.pem" in self.names:
+                name = f"{name}-{cert.fingerprint[:8]}"
+            pem_name = f"{name}.pem"
+            der_name = None
+
+        print(f"Writing {pem_name} to {self.directory} folder...")
+        with open(os.path.join(self.directory, pem_name), "w") as cert_file:
+            cert_file.write(cert.pem())
+        if der_name:
+            with open(os.path.join(self.directory, der_name), "wb") as cert_file:
+                cert_file.write(cert.der)
+
+        self.names.add(pem_name)
+        self.files[cert.fingerprint] = {"subject": cert.name, "pem": pem_name, "der": der_name}
+
+    def close(self):
+        """Remove stale hashed files and write index.json for the hashed layout"""
+        if self.layout != "hashed":
+            return
+
+        written = {name for files in self.files.values() for name in (files["pem"], files["der"])}
+        for name in sorted(os.listdir(self.directory)):
+            if HASHED_EXPORT_NAME.fullmatch(name) and name not in written:
+                print(f"Removing {name} from {self.directory} folder, which is no longer in the bundle")
+                os.remove(os.path.join(self.directory, name))
+
+        with open(os.path.join(self.directory, "index.json"), "w") as index_file:
+            json.dump(self.files, index_file, indent=2, sort_keys=True)
+
+
+class ProfileWriter:
+    """Writes a profile as an XML plist while its payloads are being added.
+
+    plistlib sorts dict keys and PayloadContent sorts before every other key
+    of a profile, so each payload can be written as soon as it is added and
+    the remaining keys once the profile is finalized.  The result is identical
+    to plistlib.dump of the whole profile, but the payloads never have to be
+    held in memory.  The profile goes to a temporary file next to output_path,
+    which replaces output_path on commit.  Used as a context manager, the
+    temporary file is removed if an exception is raised before the profile is
+    committed.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        self.digest = hashlib.sha256()
+        self.file = open(self.tmp_path, "wb")
+        head, _ = self._skeleton({})
+        self._write(head)
+
+    @staticmethod
+    def _skeleton(data):
+        """Render data with no payloads, split where the payloads go."""
+        rendered = dumps(dict(data, PayloadContent=[]))
+        marker = b"\t<key>PayloadContent</key>\n\t<array/>\n"
+        index = rendered.index(marker)
+        return (
+            rendered[:index] + b"\t<key>PayloadContent</key>\n\t<array>\n",
+            b"\t</array>\n" + rendered[index + len(marker) :],
+        )
+
+    def _write(self, data):
+        self.digest.update(data)
+        self.file.write(data)
+
+    def write_payload(self, payload):
+        """Write a payload, rendered exactly as it would be inside the profile."""
+        rendered = dumps({"PayloadContent": [payload]})
+        start = rendered.index(b"\t<array>\n") + len(b"\t<array>\n")
+        end = rendered.rindex(b"\t</array>\n")
+        self._write(rendered[start:end])
+
+    def close(self, data):
+        """Write the remaining keys of the profile and return the SHA-256 of the file."""
+        _, tail = self._skeleton(data)
+        self._write(tail)
+        self.file.close()
+        return self.digest.hexdigest()
+
+    def commit(self):
+        os.replace(self.tmp_path, self.output_path)
+
+    def discard(self):
+        """Close and remove the temporary file, unless it was committed."""
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+
+
 class ConfigurationProfile:
-    """Class to create and manipulate Configuration Profiles."""
+    """Class to create and manipulate Configuration Profiles.
+
+    Given an output_path, XML profiles are streamed to it by a ProfileWriter
+    as payloads are added, so the profile does not hold its rendered payloads
+    in memory.  Binary (FMT_BINARY) profiles are always built in memory.  Use
+    it as a context manager so a partly streamed profile is removed if
+    building it fails.
+
+    Payloads are written in the order they are added, in deterministic mode
+    too, so callers add them in CertificateGraph.ordered() order for the
+    profile to be the same whatever the order of the bundles.
+    """
 
     def __init__(
         self,
@@ -50,15 +635,22 @@ class ConfigurationProfile:
         removal_allowed=False,
         organization="",
         displayname="",
-        export=False,
+        export=None,
+        deterministic=False,
+        output_path=None,
+        fmt=FMT_XML,
     ):
+        self.identifier = identifier
+        self.deterministic = deterministic
+        self.fmt = fmt
+        self.certificates = []
         self.data = {}
         self.data["PayloadVersion"] = 1
         self.data["PayloadOrganization"] = organization
         if uuid:
             self.data["PayloadUUID"] = uuid
         else:
-            self.data["PayloadUUID"] = makeNewUUID()
+            self.data["PayloadUUID"] = self._makeUUID("profile")
         if removal_allowed:
             self.data["PayloadRemovalDisallowed"] = False
         else:
@@ -67,20 +659,41 @@ class ConfigurationProfile:
         self.data["PayloadScope"] = "System"
         self.data["PayloadDescription"] = displayname
         self.data["PayloadDisplayName"] = displayname
-        self.data["PayloadIdentifier"] = makeNewUUID()
+        self.data["PayloadIdentifier"] = self._makeUUID("identifier")
 
         # An empty list for 'sub payloads' that we'll fill later
         self.data["PayloadContent"] = []
 
         self.export = export
 
+        self.writer = None
+        if output_path and fmt == FMT_XML:
+            self.writer = ProfileWriter(output_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.writer is not None:
+            self.writer.__exit__(exc_type, exc_value, traceback)
+
+    def _makeUUID(self, name):
+        """Return a new UUID, or in deterministic mode one derived from the profile identifier and name"""
+        if self.deterministic:
+            return makeStableUUID(self.identifier, name)
+        return makeNewUUID()
+
     def _addCertificatePayload(self, payload_content, certname, certtype):
         """Add a Certificate payload to the profile. Takes a dict which will be the
         PayloadContent dict within the payload.
         """
+        fingerprint = hashlib.sha256(payload_content).hexdigest()
+        if self.deterministic:
+            self.certificates.append({"name": certname, "sha256": fingerprint})
+
         payload_dict = {}
         payload_dict["PayloadVersion"] = 1
-        payload_dict["PayloadUUID"] = makeNewUUID()
+        payload_dict["PayloadUUID"] = self._makeUUID(fingerprint)
         payload_dict["PayloadEnabled"] = True
 
         if certtype == "root":
@@ -103,63 +716,186 @@ class ConfigurationProfile:
         # Add our actual content
         payload_dict["PayloadContent"] = payload_content
 
-        # Add to the profile's PayloadContent array
-        self.data["PayloadContent"].append(payload_dict)
+        # Add to the profile's PayloadContent array, or straight to the output
+        if self.writer is not None:
+            self.writer.write_payload(payload_dict)
+        else:
+            self.data["PayloadContent"].append(payload_dict)
 
     def addPayloadFromPEM(self, pemfile):
         """Add Certificates to the profile's payloads."""
-        payload_content = ""
-        regex_pattern = "(-+BEGIN CERTIFICATE-+)(.*?)(-+END CERTIFICATE-+)"
-        regex = re.compile(regex_pattern, flags=re.MULTILINE | re.DOTALL)
-        cert = regex.search(pemfile)
-
-        payload_content = cert.group(2)
-        payload_content_ascii = payload_content.encode("ascii")
-        payload_content_bytes = base64.b64decode(payload_content_ascii)
+        der = _pem_blocks(pemfile, "CERTIFICATE")[0]
+        return self.addPayloadFromCertificate(Certificate(der))
 
-        name_regex_pattern = "(^subject.*)((CN\s?=\s?)(.*))"
-        name_regex = re.compile(name_regex_pattern, flags=re.MULTILINE)
-        name = name_regex.search(pemfile).group(4)
-
-        issuer_regex_pattern = "(^issuer.*)((CN\s?=\s?)(.*))"
-        issuer_regex = re.compile(issuer_regex_pattern, flags=re.MULTILINE)
-        issuer = issuer_regex.search(pemfile).group(4)
+    def addPayloadFromCertificate(self, cert):
+        """Add a decoded Certificate to the profile's payloads."""
+        name = cert.name
 
         # get type
-        if issuer == name:
+        if cert.self_signed:
             certtype = "root"
         else:
             certtype = "intermediate"
 
         # print(f"Adding {name} to profile...")
-        self._addCertificatePayload(bytes(payload_content_bytes), name, certtype)
+        self._addCertificatePayload(cert.der, name, certtype)
 
-        # write PEM to file
+        # write the certificate to the export folder
         if self.export:
-            print(f"Writing {name}.pem to certs folder...")
-            self._writePEMtoFile(pemfile, name)
+            self.export.write(cert)
 
         return name
 
-    def _writePEMtoFile(self, pemfile, name):
-        Path("./certs").mkdir(parents=True, exist_ok=True)
-        output_path = f"./certs/{name}.pem"
-        with open(output_path, "w") as cert_file:
-            cert_file.write(pemfile)
+    def finalizeAndSave(self, output_path, force=False):
+        """Perform last modifications and save to an output plist.
+
+        In deterministic mode a manifest with the hash of the profile is kept next to it in <output>.manifest.json.  If the hash matches the recorded one the profile is left untouched, so it is not re-signed or re-uploaded.  Returns True if the profile was written.
+        """
+        if self.writer is not None:
+            if output_path != self.writer.output_path:
+                raise ValueError(f"Profile is being streamed to {self.writer.output_path}")
+            content = None
+            digest = self.writer.close(self.data)
+        else:
+            content = dumps(self.data, fmt=self.fmt)
+            digest = hashlib.sha256(content).hexdigest()
+
+        manifest_path = output_path + ".manifest.json"
+        if self.deterministic and not force and os.path.exists(output_path):
+            try:
+                with open(manifest_path, "r") as manifest_file:
+                    recorded = json.load(manifest_file).get("sha256")
+            except (OSError, ValueError):
+                recorded = None
+            if recorded == digest:
+                print(f"Certificates unchanged, keeping {output_path}")
+                if self.writer is not None:
+                    self.writer.discard()
+                return False
 
-    def finalizeAndSave(self, output_path):
-        """Perform last modifications and save to an output plist."""
         print(f"Writing .mobileconfig file to: {output_path}")
-        with open(output_path, "wb+") as plist_file:
-            dump(self.data, plist_file)
+        if self.writer is not None:
+            self.writer.commit()
+        else:
+            with open(output_path, "wb+") as plist_file:
+                plist_file.write(content)
+
+        if self.deterministic:
+            manifest = {
+                "identifier": self.identifier,
+                "sha256": digest,
+                "certificates": self.certificates,
+            }
+            with open(manifest_path, "w") as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
+        return True
+
+
+def payload_size(cert, fmt=FMT_XML):
+    """Returns the approximate number of bytes the payload of cert adds to a profile"""
+    profile = ConfigurationProfile("size", fmt=fmt)
+    profile.addPayloadFromCertificate(cert)
+    return len(dumps(profile.data["PayloadContent"][0], fmt=fmt))
+
+
+def shard_certificates(graph, max_certs=0, max_size=0, fmt=FMT_XML):
+    """Splits the certificates of a CertificateGraph into shards of at most max_certs certificates and about max_size bytes.
+
+    Chains are never split: certificates are packed depth first and every shard also holds the issuers of its certificates, so roots and the intermediates near the top of large trees are repeated in each shard that needs them.  A chain that exceeds the limits by itself gets a shard of its own.  Returns the shards as lists of certificates in chain order.
+    """
+    ordered = graph.ordered()
+    position = {cert.fingerprint: index for index, cert in enumerate(ordered)}
+    children = {}
+    for cert in ordered:
+        if graph.depths[cert.fingerprint] > 0:
+            issuer = graph.issuers[cert.fingerprint]
+            children.setdefault(issuer.fingerprint, []).append(cert)
+
+    sizes = {cert.fingerprint: payload_size(cert, fmt) for cert in ordered}
+    base_size = len(dumps(ConfigurationProfile("size", fmt=fmt).data, fmt=fmt))
+
+    shards = []
+    shard, shard_size = {}, base_size
+    stack = [cert for cert in reversed(ordered) if graph.depths[cert.fingerprint] == 0]
+    while stack:
+        cert = stack.pop()
+        stack.extend(reversed(children.get(cert.fingerprint, [])))
+
+        chain = [cert]
+        while graph.depths[chain[-1].fingerprint] > 0:
+            chain.append(graph.issuers[chain[-1].fingerprint])
+        missing = [c for c in chain if c.fingerprint not in shard]
+        extra = sum(sizes[c.fingerprint] for c in missing)
+
+        if shard and (
+            (max_certs and len(shard) + len(missing) > max_certs)
+            or (max_size and shard_size + extra > max_size)
+        ):
+            shards.append(shard)
+            shard, shard_size = {}, base_size
+            missing = chain
+            extra = sum(sizes[c.fingerprint] for c in missing)
+
+        for c in missing:
+            shard[c.fingerprint] = c
+        shard_size += extra
+    if shard:
+        shards.append(shard)
+
+    return [
+        sorted(shard.values(), key=lambda cert: position[cert.fingerprint])
+        for shard in shards
+    ]
+
+
+def previous_shards(output_file, identifier):
+    """Returns the fingerprints of the certificates in each shard of output_file written by an earlier run, keyed by the absolute path of the shard.  Shards are found by their manifests, and only those carrying the identifier <identifier>.N the shard would get are returned"""
+    stem, extension = os.path.splitext(os.path.abspath(output_file))
+    directory = os.path.dirname(stem)
+    pattern = re.compile(
+        re.escape(os.path.basename(stem)) + r"-(\d+)" + re.escape(extension) + r"\.manifest\.json$"
+    )
+    shards = {}
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        match = pattern.match(name)
+        if not match:
+            continue
+        try:
+            with open(os.path.join(directory, name), "r") as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            continue
+        if manifest.get("identifier") != f"{identifier}.{match.group(1)}":
+            continue
+        shards[f"{stem}-{match.group(1)}{extension}"] = {
+            cert["sha256"] for cert in manifest.get("certificates", [])
+        }
+    return shards
+
+
+def parse_size(value):
+    """Parses a size in bytes with an optional K or M suffix"""
+    units = {"K": 1024, "M": 1024 * 1024}
+    value = value.strip().upper().rstrip("B")
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        errorAndExit(f"Invalid size: {value}")
 
 
 def makeNewUUID():
     return str(uuid4())
 
 
+def makeStableUUID(*names):
+    """Return a UUID derived from names, identical on every run"""
+    return str(uuid5(NAMESPACE_URL, "/".join(names)))
+
+
 def errorAndExit(errmsg):
-    print >> sys.stderr, errmsg
+    print(errmsg, file=sys.stderr)
     exit(-1)
 
 
@@ -174,24 +910,307 @@ def extract_dod_cert_url(content):
     return
 
 
-def extract_dod_cert_zip_file(zip_url, tempdir):
-    """Takes the URL to the .zip file and extracts the contents to a temp directory.  Returns the location of the .pem file for processing"""
+class DownloadCache:
+    """Keeps the last downloaded certificate archive for a URL, along with its ETag, Last-Modified and SHA-256, so later runs can send conditional requests and skip unchanged bundles."""
+
+    def __init__(self, cache_dir, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+        self.zip_path = os.path.join(cache_dir, f"{key}.zip")
+        self.meta_path = os.path.join(cache_dir, f"{key}.json")
+        self.url = url
+        try:
+            with open(self.meta_path, "r") as meta_file:
+                self.meta = json.load(meta_file)
+        except (OSError, ValueError):
+            self.meta = {}
+
+    def has_copy(self):
+        """Returns True if an archive for this URL has been cached"""
+        return bool(self.meta.get("sha256")) and os.path.exists(self.zip_path)
+
+    def conditional_headers(self):
+        """Returns the headers that make the server answer 304 if the cached copy is current"""
+        headers = {}
+        if self.has_copy():
+            if self.meta.get("etag"):
+                headers["If-None-Match"] = self.meta["etag"]
+            if self.meta.get("last_modified"):
+                headers["If-Modified-Since"] = self.meta["last_modified"]
+        return headers
+
+    def open(self):
+        return open(self.zip_path, "rb")
+
+    def store(self, spool, headers):
+        """Saves a downloaded archive and its validators. Returns True if its content differs from the cached copy"""
+        digest = hashlib.sha256()
+        os.makedirs(os.path.dirname(self.zip_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.zip_path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as zip_file:
+            for chunk in iter(lambda: spool.read(1024 * 1024), b""):
+                digest.update(chunk)
+                zip_file.write(chunk)
+        spool.seek(0)
+        os.replace(tmp_path, self.zip_path)
+
+        changed = digest.hexdigest() != self.meta.get("sha256")
+        self.meta.update(
+            {
+                "url": self.url,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "sha256": digest.hexdigest(),
+            }
+        )
+        self._save()
+        return changed
+
+    def is_built(self, output_path, settings):
+        """Returns True if output_path was built from the cached archive with the same settings and the profiles written for it still exist"""
+        build = self.meta.get("builds", {}).get(os.path.abspath(output_path))
+        if build is None:
+            return False
+        return (
+            build["sha256"] == self.meta.get("sha256")
+            and build["settings"] == settings
+            and all(os.path.exists(path) for path in build.get("outputs", [output_path]))
+        )
+
+    def mark_built(self, output_path, settings, outputs=None):
+        """Records that output_path was built from the cached archive, written as outputs if it was sharded"""
+        self.meta.setdefault("builds", {})[os.path.abspath(output_path)] = {
+            "sha256": self.meta.get("sha256"),
+            "settings": settings,
+            "outputs": [os.path.abspath(path) for path in outputs or [output_path]],
+        }
+        self._save()
+
+    def _save(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.meta_path), suffix=".tmp")
+        with os.fdopen(fd, "w") as meta_file:
+            json.dump(self.meta, meta_file, indent=2)
+        os.replace(tmp_path, self.meta_path)
+
+
+def extract_dod_cert_zip_file(zip_url, cache=None, offline=False, timeout=None):
+    """Takes the URL to the .zip file and downloads it without extracting anything to disk.  The download is kept in memory and only spills to a temporary file if it grows beyond SPOOL_MAX_SIZE.
+
+    With a DownloadCache the request is conditional and the cached copy is used when the server reports it unchanged, or without any request when offline.  Returns the archive as a file object, which is removed when closed if it is not the cached copy, and whether its content changed since the cached copy"""
+    name = posixpath.basename(urlparse(zip_url).path)
+    if offline:
+        if cache is None or not cache.has_copy():
+            raise FileNotFoundError(f"No cached copy of {name} is available for offline use.")
+        print(f"Offline, using the cached copy of {name}")
+        return cache.open(), False
+
     context = ssl._create_unverified_context()
-    r = urllib.request.urlopen(url=zip_url, context=context)
-    z = zipfile.ZipFile(io.BytesIO(r.read()))
-    z.extractall(tempdir)
-    return
+    request = urllib.request.Request(
+        zip_url, headers=cache.conditional_headers() if cache else {}
+    )
+    try:
+        r = urllib.request.urlopen(request, context=context, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cache is not None and cache.has_copy():
+            print(f"{name} not modified, using the cached copy")
+            return cache.open(), False
+        raise
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with r:
+        shutil.copyfileobj(r, spool)
+    spool.seek(0)
 
+    changed = True
+    if cache is not None:
+        changed = cache.store(spool, r.headers)
+    return spool, changed
 
-def find_p7b_file(tempdir):
-    """Attempts to return the path to the pkcs7 bundle file containing all of the certificates"""
+
+def find_p7b_file(zip_file, archive_name=""):
+    """Attempts to return the names of the pkcs7 bundle members containing all of the certificates, and the name of the folder holding them, or archive_name if they sit at the root of the zip"""
     p7b_files = []
-    for dirpath, subdir, files in os.walk(tempdir):
-        for file in files:
-            if "der.p7b" in file and "Root_CA" not in file:
-                p7b_files.append(os.path.join(dirpath, file))
-        pem_title = os.path.basename(dirpath)
-    return p7b_files, pem_title
+    pem_title = ""
+    for member in zip_file.namelist():
+        file = posixpath.basename(member)
+        if "der.p7b" in file and "Root_CA" not in file:
+            p7b_files.append(member)
+            pem_title = posixpath.basename(posixpath.dirname(member))
+    return p7b_files, pem_title or archive_name
+
+
+def load_profile_certificates(profile_path):
+    """Decodes the certificates in the payloads of an existing profile, which may be an XML, binary or signed plist"""
+    with open(profile_path, "rb") as profile_file:
+        data = profile_file.read()
+    if data[:1] == b"\x30":  # signed profiles are a PKCS#7 SignedData structure
+        data = pkcs7_content(data)
+    profile = loads(data)
+
+    certificates = []
+    for payload in profile.get("PayloadContent", []):
+        content = payload.get("PayloadContent")
+        if payload.get("PayloadType") in ("com.apple.security.root", "com.apple.security.pkcs1") and isinstance(content, bytes):
+            certificates.append(Certificate(content))
+    return certificates
+
+
+def diff_profiles(profile_paths, certificates, expiring_days):
+    """Compares the certificates in existing profiles with those of the new bundles.
+
+    Reports the certificates that were added, removed, re-issued (removed and added with the same subject), have expired or expire within expiring_days, using fingerprint sets so each certificate is looked at once.  Re-issues are paired by subject and key identifier first, then by subject alone.  Returns 1 if the profiles need to be rebuilt, 0 otherwise"""
+    old = {}
+    for profile_path in profile_paths:
+        for cert in load_profile_certificates(profile_path):
+            old[cert.fingerprint] = cert
+    new = {cert.fingerprint: cert for cert in certificates}
+    print(f"Comparing {len(old)} certificates in {', '.join(profile_paths)} with {len(new)} in the bundles")
+
+    added = {fingerprint: new[fingerprint] for fingerprint in new.keys() - old.keys()}
+    removed = {fingerprint: old[fingerprint] for fingerprint in old.keys() - new.keys()}
+
+    # a removed and an added certificate with the same subject is a re-issue, and
+    # one that also kept its key identifier is the better match
+    removed_by_key = {}
+    for cert in sorted(removed.values(), key=lambda cert: (cert.not_after, cert.fingerprint)):
+        removed_by_key.setdefault((cert.subject_der, cert.subject_key_id), []).append(cert)
+        removed_by_key.setdefault(cert.subject_der, []).append(cert)
+    reissued = []
+    for match_key in (lambda cert: (cert.subject_der, cert.subject_key_id), lambda cert: cert.subject_der):
+        for fingerprint, cert in sorted(added.items(), key=lambda item: (item[1].name, item[0])):
+            candidates = [c for c in removed_by_key.get(match_key(cert), ()) if c.fingerprint in removed]
+            if candidates:
+                previous = candidates[0]
+                reissued.append((previous, cert))
+                del added[fingerprint]
+                del removed[previous.fingerprint]
+    reissued.sort(key=lambda pair: (pair[1].name, pair[1].fingerprint))
+
+    now = datetime.now(timezone.utc)
+    deadline = now + timedelta(days=expiring_days)
+    expired = [cert for cert in new.values() if cert.not_after <= now]
+    expiring = [cert for cert in new.values() if now < cert.not_after <= deadline]
+
+    def describe(cert):
+        return f"{cert.name} ({cert.fingerprint[:16]}, expires {cert.not_after:%Y-%m-%d})"
+
+    for title, entries, marker in (
+        ("Added", added.values(), "+"),
+        ("Removed", removed.values(), "-"),
+    ):
+        if entries:
+            print(f"{title} ({len(entries)}):")
+            for cert in sorted(entries, key=lambda cert: cert.name):
+                print(f"    {marker} {describe(cert)}")
+    if reissued:
+        print(f"Re-issued ({len(reissued)}):")
+        for previous, cert in reissued:
+            print(f"    ~ {describe(previous)} -> {describe(cert)}")
+    if expired:
+        print(f"Expired ({len(expired)}):")
+        for cert in sorted(expired, key=lambda cert: cert.not_after):
+            print(f"    x {describe(cert)}")
+    if expiring:
+        print(f"Expiring within {expiring_days} days ({len(expiring)}):")
+        for cert in sorted(expiring, key=lambda cert: cert.not_after):
+            print(f"    ! {describe(cert)}")
+
+    if added or removed or reissued:
+        print("The profile needs to be rebuilt.")
+        return 1
+    print("The profile is up to date.")
+    return 0
+
+
+def decode_bundle_archive(archive, archive_name=""):
+    """Reads the pkcs7 bundles out of a downloaded archive and closes it.  Returns the name of the folder holding them, or archive_name if there is none, and a list of (bundle name, DER encoded certificates)"""
+    with archive, zipfile.ZipFile(archive) as zip_file:
+        members, title = find_p7b_file(zip_file, archive_name)
+        bundles = []
+        for member in members:
+            try:
+                bundles.append((posixpath.basename(member), pkcs7_der_certificates(zip_file.read(member))))
+            except ValueError as e:
+                raise ValueError(f"{member} is not a DER/PEM PKCS#7 bundle: {e}") from e
+        return title, bundles
+
+
+async def fetch_bundle(name, url, semaphore, options):
+    """Downloads the archive at url, retrying failed attempts, and decodes it as soon as it arrives"""
+    loop = asyncio.get_running_loop()
+    cache = DownloadCache(options.cache_dir, url) if options.cache_dir else None
+    start = time.perf_counter()
+
+    async with semaphore:
+        for attempt in range(1, options.retries + 1):
+            try:
+                archive, changed = await loop.run_in_executor(
+                    None,
+                    extract_dod_cert_zip_file,
+                    url,
+                    cache,
+                    options.offline,
+                    options.timeout,
+                )
+                break
+            except urllib.error.HTTPError as e:
+                # only server errors are worth another attempt
+                if e.code < 500 or attempt == options.retries:
+                    raise
+                error = e
+            except OSError as e:
+                if options.offline or attempt == options.retries:
+                    raise
+                error = e
+            print(f"{name}: attempt {attempt} failed ({error}), retrying")
+            await asyncio.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+
+    archive_name = posixpath.splitext(posixpath.basename(urlparse(url).path))[0]
+    title, bundles = await loop.run_in_executor(None, decode_bundle_archive, archive, archive_name)
+    return {
+        "name": name,
+        "cache": cache,
+        "changed": changed,
+        "title": title,
+        "bundles": bundles,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+async def fetch_bundles(sources, options):
+    """Downloads and decodes the archives of sources concurrently, at most options.jobs at a time.  Returns the results in the order of sources"""
+    semaphore = asyncio.Semaphore(options.jobs)
+    tasks = [
+        asyncio.ensure_future(fetch_bundle(name, url, semaphore, options))
+        for name, url in sources
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            count = sum(len(ders) for _, ders in result["bundles"])
+            print(f"{result['name']}: {count} certificates in {result['seconds']:.2f}s")
+    finally:
+        for task in tasks:
+            task.cancel()
+    return [task.result() for task in tasks]
+
+
+def bundle_sources(options):
+    """Returns the (name, url) of every bundle to include, each url once"""
+    bundle_url = BUNDLE_URL
+    if options.mirror:
+        bundle_url = options.mirror.rstrip("/") + "/" + posixpath.basename(BUNDLE_URL)
+
+    sources = [(name, bundle_url.format(name)) for name in options.sources or []]
+    for url in options.urls or []:
+        sources.append((posixpath.splitext(posixpath.basename(urlparse(url).path))[0], url))
+    if not sources:
+        sources.append(("DoD", bundle_url.format("DoD")))
+
+    # a bundle given twice would be downloaded twice into the same cache entry
+    unique = {}
+    for name, url in sources:
+        unique.setdefault(url, name)
+    return [(name, url) for url, name in unique.items()]
 
 
 def main():
@@ -230,6 +1249,132 @@ def main():
         default=False,
         help="""If set, will save individual certs into a ./certs folder.""",
     )
+    parser.add_option(
+        "--export-format",
+        action="store",
+        type="choice",
+        choices=["pem", "hashed"],
+        default="pem",
+        help="Layout of the exported certs: 'pem' writes <name>.pem, 'hashed' writes an OpenSSL CApath with <subject hash>.N PEM and DER files and an index.json.",
+    )
+    parser.add_option(
+        "--export-dir",
+        action="store",
+        default="./certs",
+        metavar="PATH",
+        help="Folder to save individual certs into. Defaults to ./certs.",
+    )
+    parser.add_option(
+        "--diff",
+        action="append",
+        metavar="PROFILE",
+        help="Compare an existing profile with the bundles instead of building one, exiting with 1 if it needs to be rebuilt. Can be repeated for sharded profiles.",
+    )
+    parser.add_option(
+        "--expiring-days",
+        action="store",
+        type="int",
+        default=30,
+        metavar="DAYS",
+        help="With --diff, report certificates that expire within DAYS. Defaults to 30.",
+    )
+    parser.add_option(
+        "--source",
+        action="append",
+        dest="sources",
+        type="choice",
+        choices=BUNDLE_SOURCES,
+        metavar="NAME",
+        help=f"PKI family whose bundle to include, one of {', '.join(BUNDLE_SOURCES)}. Can be repeated. Defaults to DoD.",
+    )
+    parser.add_option(
+        "--url",
+        action="append",
+        dest="urls",
+        metavar="URL",
+        help="URL of a certificate bundle .zip file to include. Can be repeated.",
+    )
+    parser.add_option(
+        "--mirror",
+        action="store",
+        metavar="URL",
+        help="Get the --source bundles from a mirror holding the unclass-certificates_pkcs7_<NAME>.zip files instead of the DOD PKE library.",
+    )
+    parser.add_option(
+        "--jobs",
+        "-j",
+        action="store",
+        type="int",
+        default=4,
+        help="Number of bundles to download at the same time, at least 1. Defaults to 4.",
+    )
+    parser.add_option(
+        "--retries",
+        action="store",
+        type="int",
+        default=3,
+        help="Number of attempts to download a bundle, including the first, at least 1. Defaults to 3.",
+    )
+    parser.add_option(
+        "--timeout",
+        action="store",
+        type="float",
+        default=60,
+        metavar="SECONDS",
+        help="Timeout for connecting to and reading from the server. Defaults to 60.",
+    )
+    parser.add_option(
+        "--cache-dir",
+        action="store",
+        metavar="PATH",
+        help="Directory to keep the downloaded bundle in. The download is skipped when the server reports it unchanged, and so is the rebuild if the output is still current.",
+    )
+    parser.add_option(
+        "--offline",
+        action="store_true",
+        default=False,
+        help="""Use the bundle in --cache-dir without connecting to the server.""",
+    )
+    parser.add_option(
+        "--force",
+        "-f",
+        action="store_true",
+        default=False,
+        help="""Rebuild the profile even if the bundle is unchanged.""",
+    )
+    parser.add_option(
+        "--deterministic",
+        action="store_true",
+        default=False,
+        help="Derive payload UUIDs from the certificate fingerprints and the profile identifier, so the same certificates always give the same profile. The profile is not rewritten if it is unchanged.",
+    )
+    parser.add_option(
+        "--identifier",
+        action="store",
+        default="",
+        help="Identifier the deterministic UUIDs are derived from. Defaults to the name of the DOD Cert file.",
+    )
+    parser.add_option(
+        "--binary",
+        action="store_true",
+        default=False,
+        help="Write a binary plist, which is smaller and faster for devices to parse, instead of XML.",
+    )
+    parser.add_option(
+        "--max-certs",
+        action="store",
+        type="int",
+        default=0,
+        metavar="COUNT",
+        help="Split the certificates across several profiles of at most COUNT certificates each.",
+    )
+    parser.add_option(
+        "--max-size",
+        action="store",
+        default="",
+        metavar="SIZE",
+        help="Split the certificates across several profiles of about SIZE bytes each, e.g. 512K.",
+    )
 
     options, args = parser.parse_args()
 
@@ -237,60 +1382,43 @@ def main():
         parser.print_usage()
         sys.exit(-1)
 
-    # create working directory
-    tempdir = tempfile.mkdtemp()
-    pem_file = tempdir + "/dod.txt"
-    pem_file_prefix = tempdir + "/DoD_CA-"
+    # The DOD PKE library at https://public.cyber.mil/pki-pke/document-library/
+    # lists the bundles; extract_dod_cert_url can locate a .zip from its html
+    sources = bundle_sources(options)
+    for name, url in sources:
+        print(f"Attempting to get {name} .zip file from {url}")
 
-    # URL to the DOD PKE library, will parse its contents to locate the .zip file to process
-    pke_library_url = "https://public.cyber.mil/pki-pke/document-library/"
-    context = ssl._create_unverified_context()
+    if options.offline and not options.cache_dir:
+        errorAndExit("--offline requires --cache-dir.")
+    if options.jobs < 1:
+        errorAndExit("--jobs must be at least 1.")
+    if options.retries < 1:
+        errorAndExit("--retries must be at least 1.")
 
-    pke_site_contents = urllib.request.urlopen(url=pke_library_url, context=context)
-
-    pke_bytes = pke_site_contents.read()
-    pke_site_contents_string = pke_bytes.decode("utf8")
-    pke_site_contents.close()
-
-    # certificate_url = extract_dod_cert_url(pke_site_contents_string)
-    certificate_url = "https://dl.dod.cyber.mil/wp-content/uploads/pki-pke/zip/unclass-certificates_pkcs7_DoD.zip"
-    print(f"Attempting to get .zip file from {certificate_url}")
-
-    extract_dod_cert_zip_file(certificate_url, tempdir)
-
-    # extract the certificates in .pem format from the p7b file
-    pem_bundle_files, pem_title = find_p7b_file(tempdir)
-
-    for pem_bundle_file in pem_bundle_files:
-        # print(f"processing bundle file {pem_bundle_file}")
-        process = subprocess.Popen(
-            [
-                "openssl",
-                "pkcs7",
-                "-in",
-                pem_bundle_file,
-                "-inform",
-                "der",
-                "-print_certs",
-                "-out",
-                pem_file,
-            ],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=False,
-        )
-        process.communicate()
-
-        # split the .pem file into individual certificates
-        split_process = subprocess.Popen(
-            ["split", "-c", "-p", "subject=", pem_file, pem_file_prefix],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=False,
-        )
-        split_process.communicate()
+    settings = {
+        "sources": [url for _, url in sources],
+        "removal_allowed": options.removal_allowed,
+        "organization": options.organization,
+        "export_certs": options.export_certs,
+        "export_format": options.export_format,
+        "export_dir": options.export_dir,
+        "deterministic": options.deterministic,
+        "identifier": options.identifier,
+        "binary": options.binary,
+        "max_certs": options.max_certs,
+        "max_size": options.max_size,
+    }
+
+    # download the bundles concurrently, each is decoded as soon as it arrives
+    try:
+        results = asyncio.run(fetch_bundles(sources, options))
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        errorAndExit(f"Could not get the certificate bundles: {e}")
+
+    if len(results) == 1:
+        pem_title = results[0]["title"]
+    else:
+        pem_title = "PKI_" + "_".join(result["name"] for result in results)
 
     # setup output file
     if options.output:
@@ -298,28 +1426,111 @@ def main():
     else:
         output_file = os.path.join(os.getcwd(), pem_title + ".mobileconfig")
 
-    newPayload = ConfigurationProfile(
-        identifier=pem_title,
-        uuid=False,
-        removal_allowed=options.removal_allowed,
-        organization=options.organization,
-        displayname=pem_title,
-        export=options.export_certs,
-    )
+    certificates = CertificateIndex()
+    for result in results:
+        for bundle, ders in result["bundles"]:
+            try:
+                certificates.add_der_certificates(bundle, ders)
+            except ValueError as e:
+                errorAndExit(f"Could not decode the certificates in {bundle}: {e}")
 
-    added_certs = []
-    for cert in os.listdir(tempdir):
-        if cert.startswith("DoD_CA-"):
-            f = open(os.path.join(tempdir, cert), "r")
-            certData = f.read()
-            added_certs.append(newPayload.addPayloadFromPEM(certData))
-            continue
+    if options.diff:
+        try:
+            sys.exit(diff_profiles(options.diff, certificates, options.expiring_days))
+        except (OSError, ValueError) as e:
+            errorAndExit(f"Could not read the profile: {e}")
+
+    caches = [result["cache"] for result in results if result["cache"] is not None]
+    if (
+        not any(result["changed"] for result in results)
+        and not options.force
+        and caches
+        and all(cache.is_built(output_file, settings) for cache in caches)
+    ):
+        print(f"Certificate bundles unchanged since {output_file} was built, nothing to do.")
+        return
+
+    print(certificates.summary())
+
+    # add the payloads in chain order, roots first
+    graph = CertificateGraph(certificates)
+    for orphan in graph.orphans():
+        print(f"Warning: issuer {orphan.issuer_name} of {orphan.name} is not in the bundle")
+
+    fmt = FMT_BINARY if options.binary else FMT_XML
+    if options.max_certs or options.max_size:
+        shards = shard_certificates(
+            graph, options.max_certs, parse_size(options.max_size or "0"), fmt
+        )
+    else:
+        shards = [graph.ordered()]
+
+    export = None
+    if options.export_certs:
+        export = CertificateExport(options.export_dir, options.export_format)
+
+    identifier = options.identifier or pem_title
+    previous = previous_shards(output_file, identifier)
+    outputs = []
+    for index, shard in enumerate(shards, 1):
+        if len(shards) > 1:
+            # shards are always built deterministically, so each one keeps its identifier
+            # as long as the same certificates are packed into it
+            stem, extension = os.path.splitext(output_file)
+            shard_file = f"{stem}-{index}{extension}"
+            shard_title = f"{pem_title} {index}"
+            shard_identifier = f"{identifier}.{index}"
+
+            moved = previous.get(os.path.abspath(shard_file), set()) - {cert.fingerprint for cert in shard}
+            moved &= {cert.fingerprint for cert in graph.certificates}
+            if moved:
+                print(
+                    f"Warning: {len(moved)} certificates of {shard_file} moved to other shards, so "
+                    f"{shard_identifier} now holds different chains. Deploy all the shards together."
+                )
         else:
-            continue
+            shard_file, shard_title, shard_identifier = output_file, pem_title, identifier
+
+        with ConfigurationProfile(
+            identifier=shard_identifier,
+            uuid=False,
+            removal_allowed=options.removal_allowed,
+            organization=options.organization,
+            displayname=shard_title,
+            export=export,
+            deterministic=options.deterministic or len(shards) > 1,
+            output_path=shard_file,
+            fmt=fmt,
+        ) as newPayload:
+            added_certs = []
+            for cert in shard:
+                added_certs.append(newPayload.addPayloadFromCertificate(cert))
+
+            if len(shards) == 1:
+                print("Added the following certificates to the configuration profile:")
+                print("\n".join(str(x) for x in sorted(added_certs)))
+            newPayload.finalizeAndSave(shard_file, force=options.force)
+        outputs.append((shard_file, added_certs))
+
+    if export is not None:
+        export.close()
+
+    # shards left over from an earlier run that produced more of them
+    written = {os.path.abspath(shard_file) for shard_file, _ in outputs}
+    for shard_file in sorted(set(previous) - written):
+        print(f"Removing {shard_file}, which is no longer part of the profile")
+        for path in (shard_file, shard_file + ".manifest.json"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    if len(shards) > 1:
+        print(f"Split {len(graph.certificates)} certificates into {len(shards)} profiles:")
+        for shard_file, added_certs in outputs:
+            print(f"{shard_file}: {len(added_certs)} certificates, {os.path.getsize(shard_file)} bytes")
+            print("\n".join(f"    {name}" for name in added_certs))
 
-    print("Added the following certificates to the configuration profile:")
-    print("\n".join(str(x) for x in sorted(added_certs)))
-    newPayload.finalizeAndSave(output_file)
+    for cache in caches:
+        cache.mark_built(output_file, settings, [shard_file for shard_file, _ in outputs])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,508 @@
+"""Tests for dod_certs_to_mobileconfig.py
+
+Bundles are served by a local HTTP server standing in for the DoD PKI site, and
+the certificates in them are built on the fly, so no network access is needed.
+Run with `python -m unittest` or pytest from this directory.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import zipfile
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import dod_certs_to_mobileconfig as dod
+
+OID_COMMON_NAME = bytes.fromhex("550403")
+OID_RSA_ENCRYPTION = bytes.fromhex("2a864886f70d010101")
+OID_SHA256_WITH_RSA = bytes.fromhex("2a864886f70d01010b")
+OID_SUBJECT_KEY_ID = bytes.fromhex("551d0e")
+OID_DATA = bytes.fromhex("2a864886f70d010701")
+OID_SIGNED_DATA = bytes.fromhex("2a864886f70d010702")
+
+
+def der(tag, *parts):
+    return dod._der_encode(tag, b"".join(parts))
+
+
+def der_name(common_name):
+    return der(0x30, der(0x31, der(0x30, der(0x06, OID_COMMON_NAME), der(0x0C, common_name.encode()))))
+
+
+def der_time(when):
+    return der(0x17, when.strftime("%y%m%d%H%M%SZ").encode())
+
+
+def make_certificate(common_name, issuer=None, serial=1, days=365, key_id=None):
+    """Build an unsigned certificate, which is all the decoder needs.
+
+    It expires in days, which may be negative, and carries key_id as its subject key identifier.
+    """
+    now = datetime.now(timezone.utc)
+    algorithm = der(0x30, der(0x06, OID_SHA256_WITH_RSA), der(0x05))
+    extensions = b""
+    if key_id is not None:
+        extensions = der(0xA3, der(0x30, der(0x30, der(0x06, OID_SUBJECT_KEY_ID), der(0x04, der(0x04, key_id)))))
+    tbs = der(
+        0x30,
+        der(0xA0, der(0x02, b"\x02")),
+        der(0x02, serial.to_bytes(4, "big")),
+        algorithm,
+        der_name(issuer or common_name),
+        der(0x30, der_time(now - timedelta(days=max(1, 1 - days))), der_time(now + timedelta(days=days))),
+        der_name(common_name),
+        der(0x30, der(0x30, der(0x06, OID_RSA_ENCRYPTION), der(0x05)), der(0x03, b"\x00" + bytes(16))),
+        extensions,
+    )
+    return der(0x30, tbs, algorithm, der(0x03, b"\x00" + bytes(16)))
+
+
+def ber(tag, *parts):
+    """Encode a constructed element with the BER indefinite length."""
+    return bytes([tag, 0x80]) + b"".join(parts) + b"\x00\x00"
+
+
+def make_p7b(certificates, content=None, indefinite=False):
+    """Return a PKCS#7 SignedData holding certificates and, if given, the content chunks."""
+    encode = ber if indefinite else der
+    encap = [der(0x06, OID_DATA)]
+    if content is not None:
+        encap.append(encode(0xA0, encode(0x24, *(der(0x04, chunk) for chunk in content))))
+    signed = encode(
+        0x30,
+        der(0x02, b"\x01"),
+        der(0x31),
+        encode(0x30, *encap),
+        encode(0xA0, *certificates),
+        der(0x31),
+    )
+    return encode(0x30, der(0x06, OID_SIGNED_DATA), encode(0xA0, signed))
+
+
+def make_bundle_zip(name, certificates):
+    """Return a zip laid out like the DoD downloads, holding a PEM p7b of certificates."""
+    pem = "".join(dod.Certificate(cert).pem() for cert in certificates)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr(f"{name}/{name}.der.p7b", pem)
+    return archive.getvalue()
+
+
+class Pkcs7Test(unittest.TestCase):
+    def setUp(self):
+        self.certificates = [make_certificate("Test Root"), make_certificate("Test Sub", "Test Root", 2, key_id=b"s")]
+
+    def test_der_bundle(self):
+        self.assertEqual(dod.pkcs7_der_certificates(make_p7b(self.certificates)), self.certificates)
+
+    def test_pem_bundle(self):
+        body = base64.encodebytes(make_p7b(self.certificates)).decode()
+        pem = f"-----BEGIN PKCS7-----\n{body}-----END PKCS7-----\n".encode()
+        self.assertEqual(dod.pkcs7_der_certificates(pem), self.certificates)
+
+    def test_indefinite_length_bundle(self):
+        bundle = make_p7b(self.certificates, indefinite=True)
+        self.assertEqual(dod.pkcs7_der_certificates(bundle), self.certificates)
+        self.assertEqual(dod.load_pkcs7_certificates(bundle)[1].name, "Test Sub")
+
+    def test_indefinite_length_signed_content(self):
+        signed = make_p7b([], content=[b"<plist>", b"</plist>"], indefinite=True)
+        self.assertEqual(dod.pkcs7_content(signed), b"<plist></plist>")
+
+    def test_malformed_bundles_raise_value_error(self):
+        bundle = make_p7b(self.certificates, indefinite=True)
+        malformed = {
+            "empty": b"",
+            "text": b"not a bundle",
+            "truncated": make_p7b(self.certificates)[:-10],
+            "truncated indefinite": bundle[:-3],
+            "missing end of contents": bundle[:-2],
+            "pem without blocks": b"-----BEGIN PKCS7-----\n",
+            "not signed data": der(0x30, der(0x06, OID_DATA), der(0xA0)),
+            "malformed certificate": make_p7b([der(0x30, der(0x30, der(0x02, b"\x01")))]),
+        }
+        for name, data in malformed.items():
+            with self.subTest(name):
+                with self.assertRaises(ValueError):
+                    dod.load_pkcs7_certificates(data)
+
+
+class ProfileWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="dod-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.output = os.path.join(self.directory, "test.mobileconfig")
+        self.certificates = [dod.Certificate(make_certificate("Test Root")),
+                             dod.Certificate(make_certificate("Test Sub", "Test Root", 2))]
+
+    def build(self, output_path):
+        profile = dod.ConfigurationProfile("test", displayname="Test", deterministic=True, output_path=output_path)
+        with profile:
+            for cert in self.certificates:
+                profile.addPayloadFromCertificate(cert)
+            with contextlib.redirect_stdout(io.StringIO()):
+                profile.finalizeAndSave(output_path or self.output, force=True)
+        return profile
+
+    def test_streamed_profile_matches_plistlib(self):
+        self.build(self.output)
+        with open(self.output, "rb") as streamed:
+            streamed = streamed.read()
+        profile = self.build(None)
+        self.assertEqual(streamed, dod.dumps(profile.data))
+        self.assertEqual(sorted(os.listdir(self.directory)), ["test.mobileconfig", "test.mobileconfig.manifest.json"])
+
+    def test_failed_build_removes_temporary_file(self):
+        with self.assertRaises(ValueError):
+            with dod.ConfigurationProfile("test", output_path=self.output) as profile:
+                profile.addPayloadFromCertificate(self.certificates[0])
+                raise ValueError("bundle could not be read")
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class DiffProfilesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="dod-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def diff(self, old, new, expiring_days=30):
+        profile_path = os.path.join(self.directory, "old.mobileconfig")
+        profile = dod.ConfigurationProfile("old")
+        for der_cert in old:
+            profile.addPayloadFromCertificate(dod.Certificate(der_cert))
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            profile.finalizeAndSave(profile_path)
+            status = dod.diff_profiles([profile_path], [dod.Certificate(der_cert) for der_cert in new], expiring_days)
+        return status, stdout.getvalue()
+
+    def test_unchanged(self):
+        root = make_certificate("Test Root")
+        self.assertEqual(self.diff([root], [root])[0], 0)
+
+    def test_reissues_are_paired_by_subject_and_key_id(self):
+        old = [make_certificate("Test CA", "Test Root", 1, key_id=b"a"), make_certificate("Test CA", "Test Root", 2, key_id=b"b")]
+        new = [make_certificate("Test CA", "Test Root", 3, key_id=b"b"), make_certificate("Test CA", "Test Root", 4, key_id=b"a")]
+        status, output = self.diff(old, new)
+
+        self.assertEqual(status, 1)
+        self.assertIn("Re-issued (2):", output)
+        self.assertNotIn("Removed", output)
+        self.assertNotIn("Added", output)
+        fingerprints = [dod.Certificate(der_cert).fingerprint[:16] for der_cert in old + new]
+        lines = [line for line in output.splitlines() if line.startswith("    ~")]
+        self.assertEqual(len(lines), 2)
+        # old serial 1 and new serial 4 share key id a, old serial 2 and new serial 3 key id b
+        self.assertTrue(any(fingerprints[0] in line and fingerprints[3] in line for line in lines))
+        self.assertTrue(any(fingerprints[1] in line and fingerprints[2] in line for line in lines))
+
+    def test_unpaired_removals_are_all_reported(self):
+        old = [make_certificate("Test CA", "Test Root", 1, key_id=b"a"), make_certificate("Test CA", "Test Root", 2, key_id=b"b")]
+        new = [make_certificate("Test CA", "Test Root", 3, key_id=b"c")]
+        status, output = self.diff(old, new)
+
+        self.assertEqual(status, 1)
+        self.assertIn("Re-issued (1):", output)
+        self.assertIn("Removed (1):", output)
+
+    def test_expired_are_reported_apart_from_expiring(self):
+        certs = [make_certificate("Expired CA", serial=1, days=-5), make_certificate("Expiring CA", serial=2, days=5),
+                 make_certificate("Current CA", serial=3)]
+        status, output = self.diff(certs, certs)
+
+        self.assertEqual(status, 0)
+        self.assertIn("Expired (1):\n    x Expired CA", output)
+        self.assertIn("Expiring within 30 days (1):\n    ! Expiring CA", output)
+        self.assertNotIn("Current CA", output)
+
+
+class BundleHandler(BaseHTTPRequestHandler):
+    """Serves the files of its server, honouring If-None-Match."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            failures = server.failures.get(self.path, 0)
+            if failures:
+                server.failures[self.path] = failures - 1
+        try:
+            time.sleep(server.delay)
+            if failures:
+                self.send_error(503)
+                return
+            content = server.files.get(self.path)
+            if content is None:
+                self.send_error(404)
+                return
+            etag = '"%s"' % hashlib.sha256(content).hexdigest()[:16]
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(len(content)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BundleServerTestCase(unittest.TestCase):
+    """Runs a BundleHandler server on localhost and a scratch directory for each test."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), BundleHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.files = {}
+        self.server.failures = {}
+        self.server.requests = []
+        self.server.delay = 0
+        self.server.active = 0
+        self.server.max_active = 0
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.directory = tempfile.mkdtemp(prefix="dod-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def serve(self, path, content):
+        self.server.files[path] = content
+        return f"http://127.0.0.1:{self.server.server_address[1]}{path}"
+
+
+class DownloadCacheTest(BundleServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.directory, "cache")
+        self.content = make_bundle_zip("Test_CA", [make_certificate("Test Root")])
+        self.url = self.serve("/bundle.zip", self.content)
+
+    def fetch(self, **kwargs):
+        cache = dod.DownloadCache(self.cache_dir, self.url)
+        with contextlib.redirect_stdout(io.StringIO()):
+            archive, changed = dod.extract_dod_cert_zip_file(self.url, cache, **kwargs)
+        with archive:
+            return archive.read(), changed
+
+    def test_first_download_is_cached(self):
+        self.assertEqual(self.fetch(), (self.content, True))
+        self.assertNotIn("If-None-Match", self.server.requests[0][1])
+        self.assertTrue(dod.DownloadCache(self.cache_dir, self.url).has_copy())
+
+    def test_not_modified_reuses_cached_copy(self):
+        self.fetch()
+        self.assertEqual(self.fetch(), (self.content, False))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIn("If-None-Match", self.server.requests[1][1])
+
+    def test_modified_replaces_cached_copy(self):
+        self.fetch()
+        updated = make_bundle_zip("Test_CA", [make_certificate("Test Root"), make_certificate("Test Sub", "Test Root", 2)])
+        self.serve("/bundle.zip", updated)
+
+        self.assertEqual(self.fetch(), (updated, True))
+        with dod.DownloadCache(self.cache_dir, self.url).open() as cached:
+            self.assertEqual(cached.read(), updated)
+        self.assertEqual(self.fetch(), (updated, False))
+
+    def test_offline_uses_cached_copy_without_request(self):
+        self.fetch()
+        self.assertEqual(self.fetch(offline=True), (self.content, False))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_offline_without_cached_copy_fails(self):
+        with self.assertRaises(FileNotFoundError):
+            self.fetch(offline=True)
+        self.assertEqual(self.server.requests, [])
+
+
+class FetchBundlesTest(BundleServerTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(dod, "RETRY_DELAY", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sources = [
+            (name, self.serve(f"/{name}.zip", make_bundle_zip(f"{name}_CA", [make_certificate(f"{name} Root")])))
+            for name in dod.BUNDLE_SOURCES
+        ]
+
+    def fetch(self, sources, jobs=4, retries=3, timeout=5):
+        options = argparse.Namespace(jobs=jobs, retries=retries, timeout=timeout, cache_dir=None, offline=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return asyncio.run(dod.fetch_bundles(sources, options))
+
+    def test_results_follow_source_order(self):
+        self.server.delay = 0.1
+        results = self.fetch(self.sources)
+        self.assertEqual([result["name"] for result in results], list(dod.BUNDLE_SOURCES))
+        self.assertEqual([result["title"] for result in results], [f"{name}_CA" for name in dod.BUNDLE_SOURCES])
+
+    def test_server_error_is_retried(self):
+        self.server.failures["/WCF.zip"] = 2
+        results = self.fetch(self.sources)
+        self.assertEqual(results[-1]["title"], "WCF_CA")
+        self.assertEqual([path for path, _ in self.server.requests].count("/WCF.zip"), 3)
+
+    def test_server_error_after_last_retry_fails(self):
+        self.server.failures["/WCF.zip"] = 3
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self.fetch(self.sources)
+        self.assertEqual(raised.exception.code, 503)
+
+    def test_client_error_is_not_retried(self):
+        with self.assertRaises(urllib.error.HTTPError):
+            self.fetch([("Missing", self.serve("/Missing.zip", None))])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_timeout(self):
+        self.server.delay = 2
+        start = time.perf_counter()
+        with self.assertRaises(OSError):
+            self.fetch(self.sources[:1], retries=1, timeout=0.2)
+        self.assertLess(time.perf_counter() - start, 1.5)
+
+    def test_jobs_limit_concurrent_downloads(self):
+        self.server.delay = 0.2
+        self.fetch(self.sources, jobs=2)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(self.server.max_active, 2)
+
+    def test_duplicate_sources_are_fetched_once(self):
+        options = argparse.Namespace(sources=["DoD", "ECA", "DoD"], urls=[dod.BUNDLE_URL.format("ECA")], mirror="")
+        self.assertEqual(
+            dod.bundle_sources(options),
+            [("DoD", dod.BUNDLE_URL.format("DoD")), ("ECA", dod.BUNDLE_URL.format("ECA"))],
+        )
+
+
+class MainCacheTest(BundleServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = self.serve(
+            "/bundle.zip",
+            make_bundle_zip("Test_CA", [make_certificate("Test Root"), make_certificate("Test Sub", "Test Root", 2)]),
+        )
+        self.output = os.path.join(self.directory, "Test_CA.mobileconfig")
+
+    def run_main(self, *args):
+        argv = ["dod_certs_to_mobileconfig.py", "--url", self.url, "-o", self.output,
+                "--cache-dir", os.path.join(self.directory, "cache"), *args]
+        stdout = io.StringIO()
+        with mock.patch.object(sys, "argv", argv), contextlib.redirect_stdout(stdout):
+            dod.main()
+        return stdout.getvalue()
+
+    def test_unchanged_bundle_is_not_rebuilt(self):
+        self.run_main()
+        os.utime(self.output, (0, 0))
+        self.assertIn("nothing to do", self.run_main())
+        self.assertEqual(os.path.getmtime(self.output), 0)
+
+    def test_force_rebuilds_unchanged_bundle(self):
+        self.run_main()
+        os.utime(self.output, (0, 0))
+        self.assertNotIn("nothing to do", self.run_main("--force"))
+        self.assertNotEqual(os.path.getmtime(self.output), 0)
+
+    def test_jobs_and_retries_below_one_are_rejected(self):
+        for option in ("--jobs", "--retries"):
+            with self.subTest(option=option):
+                stderr = io.StringIO()
+                with self.assertRaises(SystemExit), contextlib.redirect_stderr(stderr):
+                    self.run_main(option, "0")
+                self.assertIn(f"{option} must be at least 1", stderr.getvalue())
+        self.assertEqual(self.server.requests, [])
+
+    def test_offline_builds_from_cache(self):
+        self.run_main()
+        os.remove(self.output)
+        requests = len(self.server.requests)
+
+        self.assertIn("using the cached copy", self.run_main("--offline"))
+        self.assertTrue(os.path.exists(self.output))
+        self.assertEqual(len(self.server.requests), requests)
+
+    def test_malformed_bundle_is_reported(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as zip_file:
+            zip_file.writestr("Test_CA/Test_CA.der.p7b", b"\x30\x80\x06\x09")
+        self.serve("/bundle.zip", archive.getvalue())
+
+        stderr = io.StringIO()
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(stderr):
+            self.run_main()
+        self.assertIn("Test_CA/Test_CA.der.p7b is not a DER/PEM PKCS#7 bundle", stderr.getvalue())
+        self.assertFalse(os.path.exists(self.output))
+
+
+class HashedExportTest(BundleServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.export_dir = os.path.join(self.directory, "certs")
+        self.root = make_certificate("Test Root", key_id=b"r")
+        self.subs = [make_certificate(f"Test Sub {n}", "Test Root", n + 1) for n in range(3)]
+
+    def export(self, certificates):
+        url = self.serve("/bundle.zip", make_bundle_zip("Test_CA", certificates))
+        argv = ["dod_certs_to_mobileconfig.py", "--url", url, "-o", os.path.join(self.directory, "Test_CA.mobileconfig"),
+                "--export-certs", "--export-format", "hashed", "--export-dir", self.export_dir]
+        stdout = io.StringIO()
+        with mock.patch.object(sys, "argv", argv), contextlib.redirect_stdout(stdout):
+            dod.main()
+        with open(os.path.join(self.export_dir, "index.json")) as index_file:
+            return json.load(index_file), stdout.getvalue()
+
+    def test_shrinking_bundle_removes_stale_files(self):
+        index, _ = self.export([self.root, *self.subs])
+        self.assertEqual(len(os.listdir(self.export_dir)), 2 * 4 + 1)
+
+        index, output = self.export([self.root, self.subs[0]])
+        listed = {name for files in index.values() for name in (files["pem"], files["der"])}
+        self.assertEqual(set(os.listdir(self.export_dir)), listed | {"index.json"})
+        self.assertEqual(len(listed), 4)
+        self.assertEqual(output.count("Removing"), 4)
+        for cert in self.subs[1:]:
+            self.assertNotIn(dod.Certificate(cert).fingerprint, index)
+
+    def test_other_files_are_kept(self):
+        os.makedirs(self.export_dir)
+        for name in ("README", "0000000a.r0", "notes.0"):
+            with open(os.path.join(self.export_dir, name), "w") as other:
+                other.write("kept\n")
+        self.export([self.root])
+        self.assertLessEqual({"README", "0000000a.r0", "notes.0"}, set(os.listdir(self.export_dir)))
+
+
+if __name__ == "__main__":
+    unittest.main()
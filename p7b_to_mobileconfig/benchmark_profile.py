@@ -0,0 +1,102 @@
+"""Benchmark for writing profiles with p7b_to_mobileconfig.py
+
+Builds profiles with an increasing number of certificate payloads and measures
+the wall-clock time, peak Python memory (tracemalloc) and file size of each way
+of writing them: the whole profile built in memory and dumped as XML, XML
+streamed by ProfileWriter as payloads are added, and binary plist.
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from plistlib import FMT_BINARY, FMT_XML
+
+import p7b_to_mobileconfig as p7b
+
+MODES = {
+    "in-memory xml": {"fmt": FMT_XML, "stream": False},
+    "streaming xml": {"fmt": FMT_XML, "stream": True},
+    "binary": {"fmt": FMT_BINARY, "stream": False},
+}
+
+
+def iter_payloads(count, bundle, size):
+    """Yield count (der, name, certtype) payloads.
+
+    Certificates of bundle are repeated as needed, otherwise random bytes of
+    size are used. Payloads are generated lazily so they do not count towards
+    the memory of the profile.
+    """
+    if bundle:
+        with open(bundle, "rb") as bundle_file:
+            certificates = p7b.load_pkcs7_certificates(bundle_file.read())
+        for index, cert in enumerate(itertools.islice(itertools.cycle(certificates), count)):
+            yield cert.der, f"{cert.name} {index}", "root" if cert.self_signed else "intermediate"
+    else:
+        for index in range(count):
+            yield os.urandom(size), f"Synthetic CA {index}", "root" if index < 2 else "intermediate"
+
+
+def build(output_path, count, mode, args):
+    """Build and save a profile with count payloads using mode."""
+    settings = MODES[mode]
+    with p7b.ConfigurationProfile(identifier="Benchmark",
+            displayname="Benchmark",
+            output_path=output_path if settings["stream"] else None,
+            fmt=settings["fmt"]) as profile:
+        for der, name, certtype in iter_payloads(count, args.bundle, args.size):
+            profile._addCertificatePayload(der, name, certtype)
+        with contextlib.redirect_stdout(io.StringIO()):
+            profile.finalizeAndSave(output_path)
+
+
+def measure(directory, count, mode, args):
+    """Return the best time, peak traced memory and file size of a build."""
+    output_path = os.path.join(directory, f"{count}-{mode.replace(' ', '-')}.mobileconfig")
+
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        build(output_path, count, mode, args)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        build(output_path, count, mode, args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak, os.path.getsize(output_path)
+
+
+def main():
+    """Main entry point for the benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmark writing profiles with p7b_to_mobileconfig.py")
+    parser.add_argument("--counts", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="Numbers of certificate payloads to build profiles with")
+    parser.add_argument("--bundle", default="",
+                        help="p7b bundle whose certificates are repeated (default: random payloads)")
+    parser.add_argument("--size", type=int, default=1500, help="Size of each random payload in bytes")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, best is reported")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="p7b-bench-")
+    try:
+        print(f"{'Payloads':>8}  {'Mode':<14}  {'Seconds':>8}  {'Peak MiB':>8}  {'Size KiB':>9}")
+        for count in args.counts:
+            for mode in MODES:
+                seconds, peak, size = measure(directory, count, mode, args)
+                print(f"{count:>8}  {mode:<14}  {seconds:>8.3f}  {peak / 2 ** 20:>8.2f}  {size / 2 ** 10:>9.1f}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
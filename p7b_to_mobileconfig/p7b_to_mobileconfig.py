@@ -9,28 +9,476 @@
 # Changelog     : 06/01/2022 - Initial Script
 
 import os
-import tempfile
-import subprocess
 import sys
 import os.path
 import base64
+import contextlib
+import hashlib
+import io
+import json
 import optparse
 import logging
 import re
-from plistlib import Data, dump
-from uuid import uuid4
+import time
+from concurrent.futures import ProcessPoolExecutor
+from plistlib import FMT_BINARY, FMT_XML, dumps
+from uuid import NAMESPACE_URL, uuid4, uuid5
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# ASN.1 object identifiers used when decoding certificates
+OID_SIGNED_DATA = "1.2.840.113549.1.7.2"
+OID_COMMON_NAME = "2.5.4.3"
+OID_ORGANIZATIONAL_UNIT = "2.5.4.11"
+OID_SUBJECT_KEY_ID = "2.5.29.14"
+OID_AUTHORITY_KEY_ID = "2.5.29.35"
+
+# DER string types that may hold attribute values in a Name, and their codecs
+DER_STRING_CODECS = {
+    0x0C: "utf-8",  # UTF8String
+    0x13: "ascii",  # PrintableString
+    0x14: "latin-1",  # T61String
+    0x16: "ascii",  # IA5String
+    0x1A: "ascii",  # VisibleString
+    0x1C: "utf-32-be",  # UniversalString
+    0x1E: "utf-16-be",  # BMPString
+}
+
+
+def _der_read(data, offset, end=None):
+    """Read the DER element starting at offset.
+
+    Constructed elements may also use the BER indefinite length encoding, which
+    some tools write p7b files with; their content ends before the end-of-contents
+    octets.  Returns a tuple of (tag, content start, content end).
+    """
+    end = len(data) if end is None else end
+    if offset + 2 > end:
+        raise ValueError("Truncated DER element")
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7F
+        if size == 0:
+            if not tag & 0x20:
+                raise ValueError("Indefinite length on a primitive element")
+            content_end = offset
+            while True:
+                if content_end + 2 > end:
+                    raise ValueError("Truncated BER element")
+                if data[content_end : content_end + 2] == b"\x00\x00":
+                    return tag, offset, content_end
+                content_end = _der_next(data, content_end, end)
+        length = int.from_bytes(data[offset : offset + size], "big")
+        offset += size
+    if offset + length > end:
+        raise ValueError("Truncated DER element")
+    return tag, offset, offset + length
+
+
+def _der_next(data, offset, end):
+    """Return the offset following the element starting at offset."""
+    _, _, content_end = _der_read(data, offset, end)
+    # skip the end-of-contents octets of an indefinite length element
+    return content_end + 2 if data[offset + 1] == 0x80 else content_end
+
+
+def _der_children(data, start, end):
+    """Yield (tag, content start, content end, element start) for each element in data[start:end]."""
+    offset = start
+    while offset < end:
+        tag, content_start, content_end = _der_read(data, offset, end)
+        yield tag, content_start, content_end, offset
+        offset = content_end + 2 if data[offset + 1] == 0x80 else content_end
+
+
+def _der_oid(data):
+    """Decode the content bytes of an OBJECT IDENTIFIER."""
+    arcs = []
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(value)
+            value = 0
+    if not arcs:
+        raise ValueError("Empty OBJECT IDENTIFIER")
+    first = min(arcs[0] // 40, 2)
+    return ".".join(str(arc) for arc in [first, arcs[0] - first * 40] + arcs[1:])
+
+
+def _der_name(data, start, end):
+    """Decode a Name into a list of (oid, value) tuples in encoded order."""
+    attributes = []
+    for _, set_start, set_end, _ in _der_children(data, start, end):
+        for _, seq_start, seq_end, _ in _der_children(data, set_start, set_end):
+            fields = list(_der_children(data, seq_start, seq_end))
+            if len(fields) != 2:
+                raise ValueError("Malformed Name attribute")
+            oid = _der_oid(data[fields[0][1] : fields[0][2]])
+            tag, value_start, value_end, _ = fields[1]
+            raw = data[value_start:value_end]
+            codec = DER_STRING_CODECS.get(tag)
+            value = raw.decode(codec, errors="replace") if codec else raw.hex()
+            attributes.append((oid, value))
+    return attributes
+
+
+def _display_name(attributes):
+    """Return the last CN of a Name, falling back to the last OU, then any value."""
+    for oid in (OID_COMMON_NAME, OID_ORGANIZATIONAL_UNIT):
+        values = [value for attr_oid, value in attributes if attr_oid == oid]
+        if values:
+            return values[-1]
+    return attributes[-1][1] if attributes else ""
+
+
+class Certificate:
+    """An X.509 certificate decoded from its DER encoding."""
+
+    def __init__(self, der):
+        self.der = bytes(der)
+        _, cert_start, cert_end = _der_read(self.der, 0)
+        _, tbs_start, tbs_end = _der_read(self.der, cert_start, cert_end)
+
+        fields = list(_der_children(self.der, tbs_start, tbs_end))
+        if fields and fields[0][0] == 0xA0:  # explicit version
+            fields = fields[1:]
+        if len(fields) < 6:
+            raise ValueError("Malformed certificate")
+        # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo, ...
+        self.issuer = _der_name(self.der, fields[2][1], fields[2][2])
+        self.subject = _der_name(self.der, fields[4][1], fields[4][2])
+        self.issuer_der = self.der[fields[2][3] : fields[2][2]]
+        self.subject_der = self.der[fields[4][3] : fields[4][2]]
+
+        self.subject_key_id = None
+        self.authority_key_id = None
+        for tag, start, end, _ in fields[6:]:
+            if tag == 0xA3:  # extensions
+                self._read_extensions(start, end)
+
+        self.name = _display_name(self.subject)
+        self.issuer_name = _display_name(self.issuer)
+        self.fingerprint = hashlib.sha256(self.der).hexdigest()
+
+    def _read_extensions(self, start, end):
+        """Pick the key identifiers out of the [3] EXPLICIT extensions field."""
+        _, seq_start, seq_end = _der_read(self.der, start, end)
+        for _, ext_start, ext_end, _ in _der_children(self.der, seq_start, seq_end):
+            # Extension ::= SEQUENCE { extnID, critical BOOLEAN DEFAULT FALSE, extnValue OCTET STRING }
+            parts = list(_der_children(self.der, ext_start, ext_end))
+            if len(parts) < 2:
+                raise ValueError("Malformed certificate extension")
+            oid = _der_oid(self.der[parts[0][1] : parts[0][2]])
+            if oid not in (OID_SUBJECT_KEY_ID, OID_AUTHORITY_KEY_ID):
+                continue
+            _, value_start, value_end = _der_read(self.der, parts[-1][1], parts[-1][2])
+            if oid == OID_SUBJECT_KEY_ID:
+                self.subject_key_id = self.der[value_start:value_end]
+                continue
+            for tag, id_start, id_end, _ in _der_children(self.der, value_start, value_end):
+                if tag == 0x80:  # [0] keyIdentifier
+                    self.authority_key_id = self.der[id_start:id_end]
+
+    @property
+    def self_signed(self):
+        """True if the certificate is its own issuer."""
+        if self.subject_der != self.issuer_der:
+            return False
+        return (
+            self.authority_key_id is None
+            or self.subject_key_id is None
+            or self.authority_key_id == self.subject_key_id
+        )
+
+    def pem(self):
+        """Return the certificate in PEM format."""
+        body = base64.b64encode(self.der).decode("ascii")
+        lines = [body[i : i + 64] for i in range(0, len(body), 64)]
+        return "-----BEGIN CERTIFICATE-----\n" + "\n".join(lines) + "\n-----END CERTIFICATE-----\n"
+
+
+def _pem_blocks(text, label):
+    """Return the decoded bodies of all PEM blocks with the given label."""
+    regex = re.compile(
+        f"-----BEGIN {label}-----(.*?)-----END {label}-----", flags=re.DOTALL
+    )
+    return [base64.b64decode("".join(body.split())) for body in regex.findall(text)]
+
+
+def pkcs7_der_certificates(data):
+    """Return the DER encodings of the certificates in a PKCS#7 (p7b) bundle.
+
+    Accepts the DER (or BER) encoding as well as PEM, either a PKCS7 block or a
+    list of CERTIFICATE blocks, and returns the certificates in bundle order.
+    Raises ValueError if data is none of these.
+    """
+    if data.lstrip().startswith(b"-----BEGIN"):
+        text = data.decode("ascii", errors="replace")
+        certs = _pem_blocks(text, "CERTIFICATE")
+        if certs:
+            return certs
+        bundles = _pem_blocks(text, "PKCS7")
+        if not bundles:
+            raise ValueError("No PKCS7 or CERTIFICATE PEM block found")
+        return [der for bundle in bundles for der in pkcs7_der_certificates(bundle)]
+
+    # ContentInfo ::= SEQUENCE { contentType OID, content [0] EXPLICIT ANY }
+    if data[:1] != b"\x30":
+        raise ValueError("Not a DER or PEM encoded PKCS#7 bundle")
+    _, info_start, info_end = _der_read(data, 0)
+    fields = list(_der_children(data, info_start, info_end))
+    if len(fields) < 2 or _der_oid(data[fields[0][1] : fields[0][2]]) != OID_SIGNED_DATA:
+        raise ValueError("Not a PKCS#7 SignedData bundle")
+    _, signed_start, signed_end = _der_read(data, fields[1][1], fields[1][2])
+
+    # SignedData ::= SEQUENCE { version, digestAlgorithms, encapContentInfo,
+    #                           certificates [0] IMPLICIT OPTIONAL, ... }
+    certificates = []
+    for tag, start, end, _ in _der_children(data, signed_start, signed_end):
+        if tag != 0xA0:
+            continue
+        for cert_tag, _, cert_end, cert_start in _der_children(data, start, end):
+            if cert_tag == 0x30:  # skip attribute certificates and other choices
+                certificates.append(data[cert_start:cert_end])
+    return certificates
+
+
+def load_pkcs7_certificates(data):
+    """Decode the certificates of a PKCS#7 (p7b) bundle in bundle order."""
+    return [Certificate(der) for der in pkcs7_der_certificates(data)]
+
+
+class CertificateIndex:
+    """Certificates of one or more bundles keyed by SHA-256 fingerprint.
+
+    Overlapping bundles contribute each certificate once, in the order it was
+    first seen, and only that first copy is decoded.  Iterating yields the
+    unique certificates.
+    """
+
+    def __init__(self):
+        self.certificates = {}
+        self.bundles = []
+
+    def add_bundle(self, source, data):
+        """Add the certificates of a bundle, returning the number of duplicates dropped."""
+        ders = pkcs7_der_certificates(data)
+        dropped = 0
+        for der in ders:
+            fingerprint = hashlib.sha256(der).hexdigest()
+            if fingerprint in self.certificates:
+                dropped += 1
+            else:
+                self.certificates[fingerprint] = Certificate(der)
+        self.bundles.append((source, len(ders), dropped))
+        return dropped
+
+    def add_certificates(self, source, certificates):
+        """Add already decoded certificates, returning the number of duplicates dropped."""
+        dropped = 0
+        for cert in certificates:
+            if cert.fingerprint in self.certificates:
+                dropped += 1
+            else:
+                self.certificates[cert.fingerprint] = cert
+        self.bundles.append((source, len(certificates), dropped))
+        return dropped
+
+    def __iter__(self):
+        return iter(self.certificates.values())
+
+    def __len__(self):
+        return len(self.certificates)
+
+    def summary(self):
+        """Return a line per bundle with the number of duplicates dropped."""
+        lines = [
+            f"{source}: {total} certificates, {dropped} duplicates dropped"
+            for source, total, dropped in self.bundles
+        ]
+        lines.append(f"{len(self)} unique certificates")
+        return "\n".join(lines)
+
+
+class CertificateGraph:
+    """Subject, issuer and key identifier index over a set of certificates.
+
+    Every certificate is linked to its issuer by authority key identifier,
+    falling back to the issuer name, and gets the depth of its chain below the
+    top certificate.  Chains topped by a self-signed root are anchored, the
+    others start with an orphaned intermediate whose issuer is not in the set.
+    Each certificate is visited once, so building the index is linear.
+    """
+
+    def __init__(self, certificates):
+        self.certificates = list(certificates)
+        by_key_id = {}
+        by_subject = {}
+        for cert in self.certificates:
+            if cert.subject_key_id is not None:
+                by_key_id.setdefault(cert.subject_key_id, cert)
+            by_subject.setdefault(cert.subject_der, []).append(cert)
+
+        self.issuers = {}
+        for cert in self.certificates:
+            if cert.self_signed:
+                continue
+            issuer = by_key_id.get(cert.authority_key_id)
+            if issuer is None:
+                issuer = next(
+                    (c for c in by_subject.get(cert.issuer_der, ()) if c is not cert), None
+                )
+            if issuer is not None and issuer is not cert:
+                self.issuers[cert.fingerprint] = issuer
+
+        self.depths = {}
+        self.anchored = {}
+        for cert in self.certificates:
+            # walk up until a certificate with a known depth, the top of the chain or a cycle
+            path = []
+            on_path = set()
+            node = cert
+            while node.fingerprint not in self.depths and node.fingerprint not in on_path:
+                path.append(node)
+                on_path.add(node.fingerprint)
+                issuer = self.issuers.get(node.fingerprint)
+                if issuer is None:
+                    break
+                node = issuer
+            if node.fingerprint not in self.depths:
+                self.depths[node.fingerprint] = 0
+                self.anchored[node.fingerprint] = node.self_signed
+            for node in reversed(path):
+                if node.fingerprint in self.depths:
+                    continue
+                issuer = self.issuers[node.fingerprint]
+                self.depths[node.fingerprint] = self.depths[issuer.fingerprint] + 1
+                self.anchored[node.fingerprint] = self.anchored[issuer.fingerprint]
+
+    def orphans(self):
+        """Return the intermediates whose issuer is not in the set."""
+        return [
+            cert
+            for cert in self.certificates
+            if self.depths[cert.fingerprint] == 0 and not cert.self_signed
+        ]
+
+    def ordered(self):
+        """Return the certificates sorted in chain order.
+
+        Roots come first, then intermediates by depth, then the chains below
+        orphaned intermediates.  Certificates at the same depth are ordered by
+        name and fingerprint, so the order does not depend on the bundles.
+        This is a sort on the depths computed when the graph was built.
+        """
+        return sorted(
+            self.certificates,
+            key=lambda cert: (
+                not self.anchored[cert.fingerprint],
+                self.depths[cert.fingerprint],
+                cert.name,
+                cert.fingerprint,
+            ),
+        )
+
+
+class ProfileWriter:
+    """Writes a profile as an XML plist while its payloads are being added.
+
+    plistlib sorts dict keys and PayloadContent sorts before every other key of a profile,
+    so each payload can be written as soon as it is added and the remaining keys once the
+    profile is finalized. The result is identical to plistlib.dump of the whole profile,
+    but the payloads never have to be held in memory. The profile goes to a temporary file
+    next to output_path, which replaces output_path on commit. Used as a context manager,
+    the temporary file is removed if an exception is raised before the profile is committed.
+    """
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        self.digest = hashlib.sha256()
+        self.file = open(self.tmp_path, 'wb')
+        head, _ = self._skeleton({})
+        self._write(head)
+
+    @staticmethod
+    def _skeleton(data):
+        """Render data with no payloads, split where the payloads go.
+        """
+        rendered = dumps(dict(data, PayloadContent=[]))
+        marker = b'\t<key>PayloadContent</key>\n\t<array/>\n'
+        index = rendered.index(marker)
+        return (rendered[:index] + b'\t<key>PayloadContent</key>\n\t<array>\n',
+            b'\t</array>\n' + rendered[index + len(marker):])
+
+    def _write(self, data):
+        self.digest.update(data)
+        self.file.write(data)
+
+    def write_payload(self, payload):
+        """Write a payload, rendered exactly as it would be inside the profile.
+        """
+        rendered = dumps({'PayloadContent': [payload]})
+        start = rendered.index(b'\t<array>\n') + len(b'\t<array>\n')
+        end = rendered.rindex(b'\t</array>\n')
+        self._write(rendered[start:end])
+
+    def close(self, data):
+        """Write the remaining keys of the profile and return the SHA-256 of the file.
+        """
+        _, tail = self._skeleton(data)
+        self._write(tail)
+        self.file.close()
+        return self.digest.hexdigest()
+
+    def commit(self):
+        os.replace(self.tmp_path, self.output_path)
+
+    def discard(self):
+        """Close and remove the temporary file, unless it was committed.
+        """
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+
 
 class ConfigurationProfile:
     """Class to create and manipulate Configuration Profiles.
+
+    Given an output_path, XML profiles are streamed to it by a ProfileWriter as payloads
+    are added, so the profile does not hold its rendered payloads in memory. Binary
+    (FMT_BINARY) profiles are always built in memory. Use it as a context manager so a
+    partly streamed profile is removed if building it fails.
+
+    Payloads are written in the order they are added, in deterministic mode too, so
+    callers add them in CertificateGraph.ordered() order for the profile to be the same
+    whatever the order of the bundles.
     """
-    def __init__(self, identifier, uuid=False, removal_allowed=False, organization='', displayname=''):
+    def __init__(self, identifier, uuid=False, removal_allowed=False, organization='', displayname='', deterministic=False,
+            output_path=None, fmt=FMT_XML):
+        self.identifier = identifier
+        self.deterministic = deterministic
+        self.fmt = fmt
+        self.certificates = []
         self.data = {}
         self.data['PayloadVersion'] = 1
         self.data['PayloadOrganization'] = organization
         if uuid:
             self.data['PayloadUUID'] = uuid
         else:
-            self.data['PayloadUUID'] = makeNewUUID()
+            self.data['PayloadUUID'] = self._makeUUID('profile')
         if removal_allowed:
             self.data['PayloadRemovalDisallowed'] = False
         else:
@@ -39,18 +487,40 @@ class ConfigurationProfile:
         self.data['PayloadScope'] = 'System'
         self.data['PayloadDescription'] = displayname
         self.data['PayloadDisplayName'] = displayname
-        self.data['PayloadIdentifier'] = makeNewUUID()
+        self.data['PayloadIdentifier'] = self._makeUUID('identifier')
         
         # An empty list for 'sub payloads' that we'll fill later
         self.data['PayloadContent'] = []
+
+        self.writer = None
+        if output_path and fmt == FMT_XML:
+            self.writer = ProfileWriter(output_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.writer is not None:
+            self.writer.__exit__(exc_type, exc_value, traceback)
+
+    def _makeUUID(self, name):
+        """Return a new UUID, or in deterministic mode one derived from the profile identifier and name.
+        """
+        if self.deterministic:
+            return makeStableUUID(self.identifier, name)
+        return makeNewUUID()
     
     def _addCertificatePayload(self, payload_content, certname, certtype):
         """Add a Certificate payload to the profile. Takes a dict which will be the
         PayloadContent dict within the payload.
         """
+        fingerprint = hashlib.sha256(payload_content).hexdigest()
+        if self.deterministic:
+            self.certificates.append({'name': certname, 'sha256': fingerprint})
+
         payload_dict = {}
         payload_dict['PayloadVersion'] = 1
-        payload_dict['PayloadUUID'] = makeNewUUID()
+        payload_dict['PayloadUUID'] = self._makeUUID(fingerprint)
         payload_dict['PayloadEnabled'] = True
         
         if certtype == 'root':
@@ -69,70 +539,293 @@ class ConfigurationProfile:
         # Add our actual content
         payload_dict['PayloadContent'] = payload_content
 
-        # Add to the profile's PayloadContent array
-        self.data['PayloadContent'].append(payload_dict)
+        # Add to the profile's PayloadContent array, or straight to the output
+        if self.writer is not None:
+            self.writer.write_payload(payload_dict)
+        else:
+            self.data['PayloadContent'].append(payload_dict)
 
 
     def addPayloadFromPEM(self, pemfile):
         """Add Certificates to the profile's payloads.
         """
-        payload_content = ""
-        regex_pattern = '(-+BEGIN CERTIFICATE-+)(.*?)(-+END CERTIFICATE-+)'
-        regex = re.compile(regex_pattern, flags=re.MULTILINE|re.DOTALL)
-        cert = regex.search(pemfile)
-        
-        payload_content = cert.group(2)
-        payload_content_ascii = payload_content.encode('ascii')
-        payload_content_bytes = base64.b64decode(payload_content_ascii)
-  
-        try:
-            name_regex_pattern = '(^subject.*)((?<=CN=)>*?.*)'
-            name_regex = re.compile(name_regex_pattern, flags=re.MULTILINE)
-            name = name_regex.search(pemfile).group(2)
-        except:
-            name_regex_pattern = '(^subject.*)((?<=OU=)>*?.*)'
-            name_regex = re.compile(name_regex_pattern, flags=re.MULTILINE)
-            name = name_regex.search(pemfile).group(2)
-            logging.debug("Using OU for CN")
+        der = _pem_blocks(pemfile, "CERTIFICATE")[0]
+        return self.addPayloadFromCertificate(Certificate(der))
+
+    def addPayloadFromCertificate(self, cert):
+        """Add a decoded Certificate to the profile's payloads.
+        """
+        name = cert.name
+        issuer = cert.issuer_name
         logging.debug(f"Subject: {name}")
-        
-        
-        try:
-            issuer_regex_pattern = '(^issuer.*)((?<=CN=)>*?.*)'
-            issuer_regex = re.compile(issuer_regex_pattern, flags=re.MULTILINE)
-            issuer = issuer_regex.search(pemfile).group(2)
-        except:
-            issuer_regex_pattern = '(^issuer.*)((?<=OU=)>*?.*)'
-            issuer_regex = re.compile(issuer_regex_pattern, flags=re.MULTILINE)
-            issuer = issuer_regex.search(pemfile).group(2)
-            logging.debug("Using OU for CN")
         logging.debug(f"Issuer: {issuer}")
         
         # get type
-        if issuer == name:
+        if cert.self_signed:
             certtype = "root"
         else:
             certtype = "intermediate"
         
-        self._addCertificatePayload(Data(payload_content_bytes), name, certtype)
+        self._addCertificatePayload(cert.der, name, certtype)
+        return name
 
-    def finalizeAndSave(self, output_path):
+    def finalizeAndSave(self, output_path, force=False):
         """Perform last modifications and save to an output plist.
+
+        In deterministic mode a manifest with the hash of the profile is kept next to it in
+        <output>.manifest.json. If the hash matches the recorded one the profile is left untouched.
+        Returns True if the profile was written.
         """
+        if self.writer is not None:
+            if output_path != self.writer.output_path:
+                raise ValueError(f"Profile is being streamed to {self.writer.output_path}")
+            content = None
+            digest = self.writer.close(self.data)
+        else:
+            content = dumps(self.data, fmt=self.fmt)
+            digest = hashlib.sha256(content).hexdigest()
+
+        manifest_path = output_path + '.manifest.json'
+        if self.deterministic and not force and os.path.exists(output_path):
+            try:
+                with open(manifest_path, 'r') as manifest_file:
+                    recorded = json.load(manifest_file).get('sha256')
+            except (OSError, ValueError):
+                recorded = None
+            if recorded == digest:
+                print(f"Certificates unchanged, keeping {output_path}")
+                if self.writer is not None:
+                    self.writer.discard()
+                return False
+
         print(f"Writing .mobileconfig file to: {output_path}")
-        with open(output_path, 'wb+') as plist_file:
-            dump(self.data, plist_file)
+        if self.writer is not None:
+            self.writer.commit()
+        else:
+            with open(output_path, 'wb+') as plist_file:
+                plist_file.write(content)
+
+        if self.deterministic:
+            manifest = {
+                'identifier': self.identifier,
+                'sha256': digest,
+                'certificates': self.certificates,
+            }
+            with open(manifest_path, 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
+        return True
 
 
 def makeNewUUID():
     return str(uuid4())
 
 
+def makeStableUUID(*names):
+    """Return a UUID derived from names, identical on every run.
+    """
+    return str(uuid5(NAMESPACE_URL, '/'.join(names)))
+
+
 def errorAndExit(errmsg):
-    print >> sys.stderr, errmsg
+    print(errmsg, file=sys.stderr)
     exit(-1)
 
 
+def read_bundle(p7b_file):
+    """Return the DER encodings of the certificates in a p7b file and an error message.
+
+    This runs in worker processes, so failures are returned instead of raised.
+    """
+    try:
+        with open(p7b_file, 'rb') as bundle:
+            return pkcs7_der_certificates(bundle.read()), None
+    except OSError as e:
+        return [], f"could not read {p7b_file}: {e}"
+    except ValueError as e:
+        return [], f"{p7b_file} is not a DER/PEM PKCS#7 bundle: {e}"
+
+
+def decode_certificate(der):
+    """Return the Certificate decoded from der and an error message, for worker processes.
+    """
+    try:
+        return Certificate(der), None
+    except ValueError as e:
+        return None, str(e)
+
+
+def pool_map(function, items, jobs):
+    """Map function over items on a pool of worker processes, keeping the order of items.
+    """
+    if jobs > 1 and len(items) > 1:
+        # hand out items in chunks so the per-task IPC overhead stays small
+        chunksize = max(1, len(items) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(function, items, chunksize=chunksize))
+    return [function(item) for item in items]
+
+
+def load_manifest(manifest_path, defaults):
+    """Read a batch manifest and return its profiles.
+
+    The manifest is JSON, or YAML if PyYAML is installed, holding a list of profiles
+    or a dict with a "profiles" list and optional "defaults" applied to each of them.
+    Every profile needs a "title" and a list of existing "bundles", and can set "organization",
+    "removal_allowed", "deterministic", "binary", "identifier" and "output". Paths are relative
+    to the manifest, and no two profiles may be written to the same output.
+    """
+    with open(manifest_path, 'r') as manifest_file:
+        if manifest_path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                errorAndExit("PyYAML is required to read YAML manifests.")
+            data = yaml.safe_load(manifest_file)
+        else:
+            data = json.load(manifest_file)
+
+    if isinstance(data, list):
+        data = {'profiles': data}
+    if not isinstance(data, dict) or not isinstance(data.get('profiles'), list) or not data['profiles']:
+        errorAndExit(f"Manifest {manifest_path} lists no profiles.")
+    base = os.path.dirname(os.path.abspath(manifest_path))
+
+    profiles = []
+    outputs = {}
+    for entry in data.get('profiles', []):
+        profile = dict(defaults)
+        profile.update(data.get('defaults', {}))
+        profile.update(entry)
+        if not profile.get('title') or not profile.get('bundles'):
+            errorAndExit(f"Manifest profile is missing a title or bundles: {entry}")
+        bundles = profile['bundles']
+        if not isinstance(bundles, list) or not all(isinstance(bundle, str) for bundle in bundles):
+            errorAndExit(f"Manifest profile {profile['title']} needs a list of bundle paths: {bundles!r}")
+        profile['bundles'] = [os.path.join(base, bundle) for bundle in bundles]
+        missing = [bundle for bundle in profile['bundles'] if not os.path.isfile(bundle)]
+        if missing:
+            errorAndExit(f"Manifest profile {profile['title']} lists bundles that do not exist: {', '.join(missing)}")
+        if profile.get('output'):
+            profile['output'] = os.path.join(base, profile['output'])
+        else:
+            profile['output'] = os.path.join(os.getcwd(), 'build', profile['title'] + '.mobileconfig')
+
+        # workers building to the same file would overwrite each other
+        output = os.path.normcase(os.path.abspath(profile['output']))
+        if output in outputs:
+            errorAndExit(f"Manifest profiles {outputs[output]} and {profile['title']} are both written to {profile['output']}")
+        outputs[output] = profile['title']
+        profiles.append(profile)
+    return profiles
+
+
+def build_profile(job):
+    """Build one profile of a batch manifest from its decoded bundles and return a report.
+    """
+    profile, bundles = job
+    start = time.perf_counter()
+
+    certificates = CertificateIndex()
+    for source, bundle in bundles:
+        certificates.add_certificates(source, bundle)
+    graph = CertificateGraph(certificates)
+
+    os.makedirs(os.path.dirname(profile['output']), exist_ok=True)
+    with ConfigurationProfile(identifier=profile['identifier'] or profile['title'],
+            uuid=False,
+            removal_allowed=profile['removal_allowed'],
+            organization=profile['organization'],
+            displayname=profile['title'],
+            deterministic=profile['deterministic'],
+            output_path=profile['output'],
+            fmt=FMT_BINARY if profile['binary'] else FMT_XML) as newPayload:
+        for cert in graph.ordered():
+            newPayload.addPayloadFromCertificate(cert)
+
+        # printed by the parent, so the output of parallel builds does not interleave
+        messages = io.StringIO()
+        with contextlib.redirect_stdout(messages):
+            written = newPayload.finalizeAndSave(profile['output'], force=profile['force'])
+
+    return {
+        'title': profile['title'],
+        'output': profile['output'],
+        'certificates': len(certificates),
+        'duplicates': sum(dropped for _, _, dropped in certificates.bundles),
+        'orphans': [cert.name for cert in graph.orphans()],
+        'bytes': os.path.getsize(profile['output']),
+        'seconds': time.perf_counter() - start,
+        'written': written,
+        'messages': messages.getvalue().splitlines(),
+    }
+
+
+def run_manifest(options):
+    """Build every profile of a batch manifest on a pool of worker processes.
+
+    Each bundle is read once and each certificate decoded once, however many
+    bundles and profiles include it, and a report with the size and build time
+    of every profile is printed.
+    """
+    profiles = load_manifest(options.manifest, {
+        'organization': options.organization,
+        'removal_allowed': options.removal_allowed,
+        'deterministic': options.deterministic,
+        'identifier': '',
+        'binary': options.binary,
+        'force': options.force,
+    })
+    jobs = options.jobs or os.cpu_count() or 1
+
+    start = time.perf_counter()
+    p7b_files = sorted({bundle for profile in profiles for bundle in profile['bundles']})
+    # failures are reported against the first profile including the bundle
+    titles = {}
+    for profile in profiles:
+        for bundle in profile['bundles']:
+            titles.setdefault(bundle, profile['title'])
+
+    fingerprints = {}
+    unique = {}
+    sources = {}
+    for p7b_file, (ders, error) in zip(p7b_files, pool_map(read_bundle, p7b_files, jobs)):
+        if error:
+            errorAndExit(f"Manifest profile {titles[p7b_file]}: {error}")
+        fingerprints[p7b_file] = [hashlib.sha256(der).hexdigest() for der in ders]
+        unique.update(zip(fingerprints[p7b_file], ders))
+        for fingerprint in fingerprints[p7b_file]:
+            sources.setdefault(fingerprint, p7b_file)
+
+    decoded = {}
+    for fingerprint, (cert, error) in zip(unique, pool_map(decode_certificate, list(unique.values()), jobs)):
+        if error:
+            p7b_file = sources[fingerprint]
+            errorAndExit(f"Manifest profile {titles[p7b_file]}: a certificate in {p7b_file} could not be decoded: {error}")
+        decoded[fingerprint] = cert
+    logging.debug(f"Decoded {len(decoded)} certificates from {len(p7b_files)} bundles "
+        f"in {time.perf_counter() - start:.3f}s")
+
+    build_jobs = [
+        (profile, [
+            (os.path.basename(bundle), [decoded[fingerprint] for fingerprint in fingerprints[bundle]])
+            for bundle in profile['bundles']
+        ])
+        for profile in profiles
+    ]
+    reports = pool_map(build_profile, build_jobs, jobs)
+
+    for report in reports:
+        for message in report['messages']:
+            print(message)
+    width = max([len('Profile')] + [len(report['title']) for report in reports])
+    print(f"{'Profile':<{width}}  {'Certs':>5}  {'Dups':>5}  {'Bytes':>10}  {'Seconds':>8}  Status")
+    for report in reports:
+        status = 'written' if report['written'] else 'unchanged'
+        print(f"{report['title']:<{width}}  {report['certificates']:>5}  {report['duplicates']:>5}  "
+            f"{report['bytes']:>10}  {report['seconds']:>8.3f}  {status}")
+        for orphan in report['orphans']:
+            print(f"  Warning: issuer of {orphan} is not in any bundle")
+    print(f"Built {len(reports)} profiles from {len(p7b_files)} bundles in {time.perf_counter() - start:.3f}s")
+
+
 def main():
     # set up argument parser
     parser = optparse.OptionParser()
@@ -153,55 +846,72 @@ def main():
         action="store",
         default="",
         help="Cosmetic name for the organization deploying the profile.")
+    parser.add_option('--name', '-n',
+        action="store",
+        default="",
+        help="Name for the configuration profile. Prompted for if not given.")
+    parser.add_option('--deterministic',
+        action="store_true",
+        default=False,
+        help="""Derive payload UUIDs from the certificate fingerprints and the profile identifier, so the same certificates always give the same profile. The profile is not rewritten if it is unchanged.""")
+    parser.add_option('--identifier',
+        action="store",
+        default="",
+        help="Identifier the deterministic UUIDs are derived from. Defaults to the profile name.")
+    parser.add_option('--force', '-f',
+        action="store_true",
+        default=False,
+        help="""Write the profile even if it is unchanged.""")
+    parser.add_option('--binary',
+        action="store_true",
+        default=False,
+        help="Write a binary plist, which is smaller and faster for devices to parse, instead of XML.")
+    parser.add_option('--manifest', '-m',
+        action="store",
+        metavar="PATH",
+        help="Build every profile listed in a JSON (or YAML) batch manifest instead of prompting for one.")
+    parser.add_option('--jobs', '-j',
+        action="store",
+        type="int",
+        default=0,
+        help="Number of worker processes for --manifest, 0 for one per CPU core.")
 
     options, args = parser.parse_args()
 
-    if len(args) < 1:
-        parser.print_usage()
-        sys.exit(-1)
-    else:
-        p7b_files = args[0:]
-    
     if options.debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    # create working directory
-    tempdir = tempfile.mkdtemp()
+    if options.manifest:
+        run_manifest(options)
+        return
 
-    pem_title = ""
+    if len(args) < 1:
+        parser.print_usage()
+        sys.exit(-1)
+    else:
+        p7b_files = args[0:]
 
-    while True:
+    pem_title = options.name
+
+    while not pem_title:
         pem_title = input("Enter a name for this configuration profile (i.e. PKI Trust) ")
-        if pem_title:
-            break
-        else:
+        if not pem_title:
             print("Name cannot be blank.")
 
+    # certificates found in more than one bundle are only added once
+    certificates = CertificateIndex()
     for p7b_file in p7b_files:
         logging.debug(f"Processing p7b file: {p7b_file}")
-        pem_file = tempdir + f"/{p7b_file}.txt"
-        pem_file_prefix = tempdir + f"/CERT-{p7b_file}"
-        pem_bundle_file = f"./{p7b_file}"
-        process = subprocess.Popen(
-            ["openssl", "pkcs7", "-inform", "DER", "-in", pem_bundle_file, "-print_certs", "-out", pem_file],
-            stdin = subprocess.PIPE,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            shell=False
-        )
-        process.communicate()
-
-        # split the .pem file into individual certificates
-        split_process = subprocess.Popen(
-            ["split", "-p", "subject=", pem_file, pem_file_prefix],
-            stdin = subprocess.PIPE,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            shell=False
-        )
-        split_process.communicate()
+        try:
+            with open(p7b_file, 'rb') as bundle:
+                certificates.add_bundle(os.path.basename(p7b_file), bundle.read())
+        except OSError as e:
+            errorAndExit(f"Could not read {p7b_file}: {e}")
+        except ValueError as e:
+            errorAndExit(f"{p7b_file} is not a DER/PEM PKCS#7 bundle: {e}")
+    print(certificates.summary())
 
     # setup output file
     build_path = os.path.join(os.getcwd(), 'build')
@@ -210,23 +920,24 @@ def main():
     
     output_file = os.path.join(build_path, pem_title + '.mobileconfig')
 
-    newPayload = ConfigurationProfile(identifier=pem_title,
-        uuid=False,
-        removal_allowed=options.removal_allowed,
-        organization=options.organization,
-        displayname=pem_title)
-
-    for x, cert in enumerate(os.listdir(tempdir)):
-        logging.debug(f"{x},{cert}")
-        if cert.startswith("CERT-"):
-            f = open(os.path.join(tempdir, cert), 'r')
-            certData = f.read()
-            newPayload.addPayloadFromPEM(certData)
-            continue
-        else:
-            continue
-    		
-    newPayload.finalizeAndSave(output_file)
+    # add the payloads in chain order, roots first
+    graph = CertificateGraph(certificates)
+    for orphan in graph.orphans():
+        print(f"Warning: issuer {orphan.issuer_name} of {orphan.name} is not in any bundle")
+
+    with ConfigurationProfile(identifier=options.identifier or pem_title,
+            uuid=False,
+            removal_allowed=options.removal_allowed,
+            organization=options.organization,
+            displayname=pem_title,
+            deterministic=options.deterministic,
+            output_path=output_file,
+            fmt=FMT_BINARY if options.binary else FMT_XML) as newPayload:
+        for x, cert in enumerate(graph.ordered()):
+            logging.debug(f"{x},{cert.name}")
+            newPayload.addPayloadFromCertificate(cert)
+
+        newPayload.finalizeAndSave(output_file, force=options.force)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
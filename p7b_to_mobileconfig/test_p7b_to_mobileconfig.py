@@ -0,0 +1,212 @@
+"""Tests for p7b_to_mobileconfig.py
+
+The certificates and p7b bundles are built on the fly, so no real PKI files
+are needed. Run with `python -m unittest` or pytest from this directory.
+"""
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import p7b_to_mobileconfig as p7b
+
+OID_COMMON_NAME = bytes.fromhex("550403")
+OID_RSA_ENCRYPTION = bytes.fromhex("2a864886f70d010101")
+OID_SHA256_WITH_RSA = bytes.fromhex("2a864886f70d01010b")
+OID_DATA = bytes.fromhex("2a864886f70d010701")
+OID_SIGNED_DATA = bytes.fromhex("2a864886f70d010702")
+
+
+def der(tag, *parts):
+    content = b"".join(parts)
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    size = (length.bit_length() + 7) // 8
+    return bytes([tag, 0x80 | size]) + length.to_bytes(size, "big") + content
+
+
+def ber(tag, *parts):
+    """Encode a constructed element with the BER indefinite length."""
+    return bytes([tag, 0x80]) + b"".join(parts) + b"\x00\x00"
+
+
+def der_name(common_name):
+    return der(0x30, der(0x31, der(0x30, der(0x06, OID_COMMON_NAME), der(0x0C, common_name.encode()))))
+
+
+def der_time(when):
+    return der(0x17, when.strftime("%y%m%d%H%M%SZ").encode())
+
+
+def make_certificate(common_name, issuer=None, serial=1):
+    """Build an unsigned certificate, which is all the decoder needs."""
+    now = datetime.now(timezone.utc)
+    algorithm = der(0x30, der(0x06, OID_SHA256_WITH_RSA), der(0x05))
+    tbs = der(
+        0x30,
+        der(0xA0, der(0x02, b"\x02")),
+        der(0x02, serial.to_bytes(4, "big")),
+        algorithm,
+        der_name(issuer or common_name),
+        der(0x30, der_time(now - timedelta(days=1)), der_time(now + timedelta(days=365))),
+        der_name(common_name),
+        der(0x30, der(0x30, der(0x06, OID_RSA_ENCRYPTION), der(0x05)), der(0x03, b"\x00" + bytes(16))),
+    )
+    return der(0x30, tbs, algorithm, der(0x03, b"\x00" + bytes(16)))
+
+
+def make_p7b(certificates, indefinite=False):
+    """Return a PKCS#7 SignedData bundle holding certificates."""
+    encode = ber if indefinite else der
+    signed = encode(
+        0x30,
+        der(0x02, b"\x01"),
+        der(0x31),
+        encode(0x30, der(0x06, OID_DATA)),
+        encode(0xA0, *certificates),
+        der(0x31),
+    )
+    return encode(0x30, der(0x06, OID_SIGNED_DATA), encode(0xA0, signed))
+
+
+class ScratchTestCase(unittest.TestCase):
+    """Runs each test in a scratch directory, which the build folder is created in."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="p7b-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory)
+        self.certificates = [make_certificate("Test Root"), make_certificate("Test Sub", "Test Root", 2)]
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        return path
+
+    def run_main(self, *args):
+        """Run main with args, returning its exit status, stdout and stderr."""
+        stdout, stderr = io.StringIO(), io.StringIO()
+        status = 0
+        with mock.patch.object(sys, "argv", ["p7b_to_mobileconfig.py", *args]), \
+                contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                p7b.main()
+            except SystemExit as e:
+                status = e.code
+        return status, stdout.getvalue(), stderr.getvalue()
+
+
+class Pkcs7Test(ScratchTestCase):
+    def test_der_and_indefinite_length_bundles(self):
+        for indefinite in (False, True):
+            with self.subTest(indefinite=indefinite):
+                bundle = make_p7b(self.certificates, indefinite)
+                self.assertEqual(p7b.pkcs7_der_certificates(bundle), self.certificates)
+
+    def test_malformed_bundles_raise_value_error(self):
+        bundle = make_p7b(self.certificates, indefinite=True)
+        for data in (b"", b"not a bundle", bundle[:-3], bundle[:-2], make_p7b(self.certificates)[:-10]):
+            with self.subTest(data=data[:16]):
+                with self.assertRaises(ValueError):
+                    p7b.pkcs7_der_certificates(data)
+
+    def test_main_builds_indefinite_length_bundle(self):
+        path = self.write("ber.p7b", make_p7b(self.certificates, indefinite=True))
+        status, _, _ = self.run_main("--name", "Test", path)
+        self.assertEqual(status, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, "build", "Test.mobileconfig")))
+
+    def test_main_reports_malformed_bundle(self):
+        path = self.write("broken.p7b", make_p7b(self.certificates)[:-10])
+        status, _, stderr = self.run_main("--name", "Test", path)
+        self.assertNotEqual(status, 0)
+        self.assertIn(f"{path} is not a DER/PEM PKCS#7 bundle", stderr)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "build", "Test.mobileconfig")))
+
+
+class ManifestTest(ScratchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("roots.p7b", make_p7b(self.certificates[:1]))
+        self.write("subs.p7b", make_p7b(self.certificates[1:]))
+
+    def run_manifest(self, profiles, *args):
+        manifest = self.write("manifest.json", json.dumps({"profiles": profiles}))
+        return self.run_main("--manifest", manifest, *args)
+
+    def assertNothingBuilt(self):
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "build")))
+
+    def test_report_is_aligned_with_short_titles(self):
+        status, stdout, _ = self.run_manifest([
+            {"title": "A", "bundles": ["roots.p7b"]},
+            {"title": "B", "bundles": ["roots.p7b", "subs.p7b"]},
+        ], "--jobs", "2")
+        self.assertEqual(status, 0)
+        lines = stdout.splitlines()
+        header = next(line for line in lines if line.startswith("Profile"))
+        rows = [line for line in lines if line[:2] in ("A ", "B ")]
+        self.assertEqual(len(rows), 2)
+        for row in rows:
+            self.assertEqual(len(row), len(header.replace("Status", "written")))
+        self.assertEqual(rows[1].split()[:2], ["B", "2"])
+
+    def test_empty_manifest_is_rejected(self):
+        for profiles in ([], None):
+            with self.subTest(profiles=profiles):
+                status, _, stderr = self.run_manifest(profiles)
+                self.assertNotEqual(status, 0)
+                self.assertIn("lists no profiles", stderr)
+
+    def test_missing_bundle_is_rejected_before_building(self):
+        status, _, stderr = self.run_manifest([
+            {"title": "A", "bundles": ["roots.p7b"]},
+            {"title": "B", "bundles": ["roots.p7b", "missing.p7b"]},
+        ])
+        self.assertNotEqual(status, 0)
+        self.assertIn("Manifest profile B lists bundles that do not exist", stderr)
+        self.assertIn("missing.p7b", stderr)
+        self.assertNothingBuilt()
+
+    def test_malformed_bundle_is_reported_with_title(self):
+        self.write("broken.p7b", b"not a bundle")
+        for jobs in ("1", "2"):
+            with self.subTest(jobs=jobs):
+                status, _, stderr = self.run_manifest([
+                    {"title": "A", "bundles": ["roots.p7b"]},
+                    {"title": "B", "bundles": ["subs.p7b", "broken.p7b"]},
+                ], "--jobs", jobs)
+                self.assertNotEqual(status, 0)
+                self.assertIn("Manifest profile B:", stderr)
+                self.assertIn("broken.p7b is not a DER/PEM PKCS#7 bundle", stderr)
+                self.assertNotIn("Traceback", stderr)
+                self.assertNothingBuilt()
+
+    def test_malformed_certificate_is_reported_with_title(self):
+        self.write("bad_cert.p7b", make_p7b([der(0x30, der(0x30, der(0x02, b"\x01")))]))
+        status, _, stderr = self.run_manifest([{"title": "C", "bundles": ["bad_cert.p7b"]}])
+        self.assertNotEqual(status, 0)
+        self.assertIn("Manifest profile C: a certificate in", stderr)
+        self.assertNothingBuilt()
+
+    def test_duplicate_outputs_are_rejected(self):
+        status, _, stderr = self.run_manifest([
+            {"title": "A", "bundles": ["roots.p7b"], "output": "out.mobileconfig"},
+            {"title": "B", "bundles": ["subs.p7b"], "output": "out.mobileconfig"},
+        ])
+        self.assertNotEqual(status, 0)
+        self.assertIn("are both written to", stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
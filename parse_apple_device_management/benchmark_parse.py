@@ -0,0 +1,205 @@
+"""Benchmark for parse_device_management.py
+
+Generates a synthetic corpus shaped like Apple's device-management repository
+(or uses an existing checkout) and measures how the scan scales with the
+number of worker processes and what each available YAML loader costs per file.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import yaml
+from tabulate import tabulate
+
+import parse_device_management as pdm
+
+PLATFORMS = ["iOS", "macOS", "tvOS", "visionOS", "watchOS"]
+VERSIONS = ["n/a", "10.7", "13.0", "14.0", "15.0", "16.0", "17.0", "18.0", "26.0"]
+
+def make_supported_os(rng: random.Random) -> Dict[str, Any]:
+    """Build a supportedOS mapping like the ones found in the real corpus."""
+    supported_os = {}
+    for platform in PLATFORMS:
+        entry = {"introduced": rng.choice(VERSIONS)}
+        if rng.random() < 0.1:
+            entry["deprecated"] = rng.choice(VERSIONS[1:])
+        if rng.random() < 0.3:
+            entry["supervised"] = rng.random() < 0.5
+        if rng.random() < 0.2:
+            entry["userenrollment"] = {"mode": "allowed"}
+        supported_os[platform] = entry
+    return supported_os
+
+def make_payload_key(rng: random.Random, name: str, depth: int) -> Dict[str, Any]:
+    """Build a single payload key, optionally with nested subkeys."""
+    payload_key = {
+        "key": name,
+        "title": f"{name} title",
+        "supportedOS": make_supported_os(rng),
+        "type": "<boolean>",
+        "presence": "optional",
+        "default": True,
+        "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 3,
+    }
+    if depth and rng.random() < 0.2:
+        payload_key["type"] = "<dictionary>"
+        payload_key["subkeys"] = [
+            make_payload_key(rng, f"{name}Sub{i}", depth - 1) for i in range(rng.randint(1, 4))
+        ]
+    return payload_key
+
+def make_corpus(directory: str, files: int, keys: int, seed: int = 0) -> List[str]:
+    """Write a synthetic device-management corpus to directory.
+
+    Args:
+        directory: Directory to write the YAML files to
+        files: Number of YAML files to create
+        keys: Number of top-level payload keys per file
+        seed: Seed for the random generator so corpora are reproducible
+
+    Returns:
+        List of created file paths
+    """
+    rng = random.Random(seed)
+    paths = []
+    for index in range(files):
+        if index % 3:
+            kind, type_key = "profiles", "payloadtype"
+            payload_type = f"com.apple.synthetic.profile{index}"
+        else:
+            kind, type_key = "declarations", "declarationtype"
+            payload_type = f"com.apple.configuration.synthetic{index}"
+
+        data = {
+            "title": f"Synthetic {index}",
+            "description": "Synthetic payload used for benchmarking.",
+            "payload": {
+                type_key: payload_type,
+                "supportedOS": make_supported_os(rng),
+                "content": "Synthetic payload used for benchmarking.",
+            },
+            "payloadkeys": [make_payload_key(rng, f"Key{index}_{i}", 3) for i in range(keys)],
+        }
+
+        subdir = os.path.join(directory, "mdm", kind)
+        os.makedirs(subdir, exist_ok=True)
+        path = os.path.join(subdir, f"{payload_type}.yaml")
+        with open(path, "w", encoding="utf-8") as f:
+            yaml.safe_dump(data, f, sort_keys=False)
+        paths.append(path)
+    return paths
+
+def time_scan(directory: str, options: argparse.Namespace, repeat: int) -> float:
+    """Return the best wall-clock time of collect_keys over repeat runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pdm.collect_keys(directory, options)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_jobs(directory: str, args: argparse.Namespace) -> None:
+    """Measure scan time for 1..max_jobs worker processes."""
+    options = argparse.Namespace(platform="macOS", os_filter=None, type_filter="", jobs=1, cache="")
+    baseline = pdm.collect_keys(directory, options)
+    file_count = len(list(pdm.iter_yaml_files(directory)))
+
+    rows = []
+    serial = None
+    for jobs in range(1, args.max_jobs + 1):
+        options.jobs = jobs
+        if pdm.collect_keys(directory, options) != baseline:
+            raise SystemExit(f"Results with --jobs {jobs} differ from the serial run")
+        elapsed = time_scan(directory, options, args.repeat)
+        serial = serial or elapsed
+        rows.append({
+            "jobs": jobs,
+            "seconds": f"{elapsed:.3f}",
+            "ms/file": f"{elapsed * 1000 / max(file_count, 1):.3f}",
+            "speedup": f"{serial / elapsed:.2f}x",
+        })
+
+    print(f"\nScan of {file_count} files, scaling with --jobs")
+    print(tabulate(rows, headers="keys", tablefmt="grid"))
+
+def render(directory: str, loader: str) -> str:
+    """Return the output of a full find_keys run using loader."""
+    output = io.StringIO()
+    for platform in pdm.PLATFORMS:
+        options = argparse.Namespace(platform=platform, os_filter=None, type_filter="", jobs=1, cache="", loader=loader)
+        with contextlib.redirect_stdout(output):
+            pdm.find_keys(directory, options)
+    return output.getvalue()
+
+def bench_loaders(directory: str, args: argparse.Namespace) -> None:
+    """Measure the per-file parse cost of every available YAML loader."""
+    file_paths = list(pdm.iter_yaml_files(directory))
+    total_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+
+    reference = None
+    rows = []
+    for loader in pdm.LOADERS:
+        output = render(directory, loader)
+        if reference is None:
+            reference = output
+        elif output != reference:
+            raise SystemExit(f"Output with --loader {loader} differs from --loader {next(iter(pdm.LOADERS))}")
+
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for file_path in file_paths:
+                pdm.process_file(file_path, loader)
+            best = min(best, time.perf_counter() - start)
+        rows.append({
+            "loader": loader,
+            "seconds": f"{best:.3f}",
+            "ms/file": f"{best * 1000 / max(len(file_paths), 1):.3f}",
+            "MB/s": f"{total_bytes / best / 1e6:.2f}",
+        })
+
+    print(f"\nParse cost per loader over {len(file_paths)} files (output identical for all loaders)")
+    print(tabulate(rows, headers="keys", tablefmt="grid"))
+
+def run(directory: str, args: argparse.Namespace) -> None:
+    """Run the selected benchmarks against directory."""
+    if args.bench in ("all", "loaders"):
+        bench_loaders(directory, args)
+    if args.bench in ("all", "jobs"):
+        bench_jobs(directory, args)
+
+def main() -> None:
+    """Main entry point for the benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmark parse_device_management.py")
+    parser.add_argument("-d", "--directory", default="",
+                        help="Existing device-management checkout to benchmark (default: synthetic corpus)")
+    parser.add_argument("--files", type=int, default=300, help="Number of synthetic YAML files")
+    parser.add_argument("--keys", type=int, default=25, help="Payload keys per synthetic file")
+    parser.add_argument("--max-jobs", type=int, default=os.cpu_count() or 1,
+                        help="Highest --jobs value to measure")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, best is reported")
+    parser.add_argument("--bench", choices=["all", "jobs", "loaders"], default="all",
+                        help="Benchmarks to run")
+    args = parser.parse_args()
+
+    if args.directory:
+        run(args.directory, args)
+        return
+
+    directory = tempfile.mkdtemp(prefix="pdm-bench-")
+    try:
+        make_corpus(directory, args.files, args.keys)
+        run(directory, args)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,56 @@ and display payload keys for specific platforms (macOS, iOS, visionOS).
 """
 
 import argparse
+import csv
+import functools
+import json
 import os
+import re
+import sys
+import threading
+import time
 import yaml
+from bisect import bisect_left
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlparse
 from tabulate import tabulate
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterator, List, Optional, Any, Set, Tuple
+
+# Version of the record layout produced by extract_record. Bump it whenever the
+# extraction changes so stale entries in existing caches are discarded.
+EXTRACTOR_VERSION = 3
+
+PLATFORMS = ("macOS", "iOS", "visionOS")
+
+# Platform value selecting the key x platform compatibility matrix
+ALL_PLATFORMS = "all"
+
+VERSION_FIELDS = ("introduced", "deprecated", "removed")
+
+# YAML loaders by name; the libyaml based loader is only available when
+# PyYAML was built against libyaml.
+LOADERS = {"python": yaml.SafeLoader}
+if hasattr(yaml, "CSafeLoader"):
+    LOADERS["c"] = yaml.CSafeLoader
+DEFAULT_LOADER = "c" if "c" in LOADERS else "python"
+
+OUTPUT_FORMATS = ("table", "jsonl", "csv")
+
+# Columns written in csv format
+CSV_FIELDS = ("File", "Platform", "Payload Key", *VERSION_FIELDS)
+
+# Number of bytes read from each file when looking for its payload type
+SNIFF_BYTES = 8192
+
+# Characters that can not start a plain YAML scalar
+PLAIN_SCALAR_INDICATORS = "-?:,[]{}#&*!|>'\"%@`"
+
+VERSION_PATTERN = re.compile(r"\d+(?:\.\d+)*")
+
+Version = Tuple[int, ...]
 
 def normalize_platform(value: str) -> str:
     """Normalize platform string to standardized format.
@@ -18,13 +63,15 @@ def normalize_platform(value: str) -> str:
         value: Platform string (case-insensitive)
         
     Returns:
-        Normalized platform string (macOS, iOS, or visionOS)
+        Normalized platform string (macOS, iOS, visionOS, or all)
         
     Raises:
         argparse.ArgumentTypeError: If platform is not supported
     """
     value = value.lower()
-    if value in ["macos", "mac"]:
+    if value in ["all"]:
+        return ALL_PLATFORMS
+    elif value in ["macos", "mac"]:
         return "macOS"
     elif value in ["ios"]:
         return "iOS"
@@ -60,6 +107,595 @@ def skip_file(type_filter: str, data: dict) -> bool:
     
     return True
 
+def positive_jobs(value: str) -> int:
+    """Parse the --jobs argument.
+
+    Args:
+        value: Number of worker processes, or 0 for one per CPU core
+
+    Returns:
+        Number of worker processes to use
+
+    Raises:
+        argparse.ArgumentTypeError: If value is not a non-negative integer
+    """
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid job count: {value}")
+    if jobs < 0:
+        raise argparse.ArgumentTypeError(f"Invalid job count: {value}")
+    return jobs or os.cpu_count() or 1
+
+def loader_name(value: str) -> str:
+    """Resolve the --loader argument to a key of LOADERS.
+
+    Args:
+        value: auto, c or python (case-insensitive)
+
+    Returns:
+        'c' for auto when libyaml is available, otherwise 'python'
+
+    Raises:
+        argparse.ArgumentTypeError: If the loader is unknown or unavailable
+    """
+    value = value.lower()
+    if value == "auto":
+        return DEFAULT_LOADER
+    if value == "c" and "c" not in LOADERS:
+        raise argparse.ArgumentTypeError("The libyaml C loader is not available in this PyYAML installation")
+    if value not in LOADERS:
+        raise argparse.ArgumentTypeError(f"Unsupported loader: {value}")
+    return value
+
+def iter_yaml_files(directory: str) -> Iterator[str]:
+    """Yield the YAML files below directory in a stable, sorted order.
+
+    Args:
+        directory: Directory path to search for YAML files
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(".yaml"):
+                yield os.path.join(root, file)
+
+def extract_record(data: Any) -> Dict[str, Any]:
+    """Reduce a loaded YAML document to the fields used for key extraction.
+
+    The record is independent of the platform being queried, which lets it be
+    cached and reused for any combination of command line filters.
+
+    Args:
+        data: loaded data from YAML file being processed
+
+    Returns:
+        Dictionary holding the payload type information and supportedOS data
+        of the payload and its payloadkeys
+    """
+    record = {}
+    if not isinstance(data, dict):
+        return record
+
+    payload = data.get("payload")
+    if isinstance(payload, dict):
+        record["payload"] = {
+            k: payload[k] for k in ("key", "payloadtype", "declarationtype", "supportedOS") if k in payload
+        }
+
+    payload_keys = data.get("payloadkeys")
+    if isinstance(payload_keys, list):
+        record["payloadkeys"] = flatten_payload_keys(payload_keys)
+
+    return record
+
+def flatten_payload_keys(payload_keys: List[Any]) -> List[Dict[str, Any]]:
+    """Flatten payloadkeys and all of their nested subkeys.
+
+    Walks the tree depth-first with an explicit stack, so deeply nested keys
+    cannot hit the recursion limit. Every key is emitted with its dotted path
+    (e.g. 'Rules.Conditions.Operator') and the supportedOS data that applies
+    to it: its own entries merged over those inherited from its parent. Keys
+    without their own supportedOS share the parent's mapping rather than
+    copying it.
+
+    Args:
+        payload_keys: payloadkeys list of a loaded YAML document
+
+    Returns:
+        List of flat keys in document order. Nested keys carry their depth,
+        top-level keys have none.
+    """
+    flat = []
+    stack = [(payload_key, "", None, 0) for payload_key in reversed(payload_keys)]
+
+    while stack:
+        payload_key, parent_path, inherited, depth = stack.pop()
+        if not isinstance(payload_key, dict):
+            continue
+
+        name = payload_key.get("key", "ALL")
+        path = f"{parent_path}.{name}" if parent_path else name
+
+        supported_os = payload_key.get("supportedOS")
+        if not isinstance(supported_os, dict):
+            supported_os = inherited
+        elif inherited:
+            supported_os = {**inherited, **supported_os}
+
+        entry = {"key": path}
+        if supported_os is not None:
+            entry["supportedOS"] = supported_os
+        if depth:
+            entry["depth"] = depth
+        flat.append(entry)
+
+        subkeys = payload_key.get("subkeys")
+        if isinstance(subkeys, list):
+            for subkey in reversed(subkeys):
+                stack.append((subkey, path, supported_os, depth + 1))
+
+    return flat
+
+def extract_matches(record: Dict[str, Any], platform: str, subkeys: bool = False) -> List[Dict[str, Any]]:
+    """Extract the payload keys of a record that apply to a platform.
+
+    Args:
+        record: File record as returned by extract_record
+        platform: Target platform (macOS, iOS, or visionOS)
+        subkeys: Include nested subkeys, named by their dotted path
+
+    Returns:
+        List of extracted payload keys
+    """
+    matches = []
+
+    # Try payloadkeys first
+    for payload_key in record.get("payloadkeys", []):
+        if not subkeys and "depth" in payload_key:
+            continue
+        match = extract_os_key(payload_key, platform)
+        if match:
+            matches.append(match)
+
+    # If no payloadkeys found, try payload
+    if not matches:
+        payload = record.get("payload")
+        if isinstance(payload, dict):
+            match = extract_os_key(payload, platform)
+            if match:
+                matches.append(match)
+
+    return matches
+
+def process_file(file_path: str, loader: str = DEFAULT_LOADER) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Load a single YAML file and reduce it to a record.
+
+    This runs inside worker processes when --jobs is greater than one, so it
+    only takes and returns picklable values and reports errors instead of
+    printing them.
+
+    Args:
+        file_path: Path of the YAML file to load
+        loader: Name of the YAML loader in LOADERS to use
+
+    Returns:
+        Tuple of (record, error). record is None when the file could not be
+        processed, error is the message to report.
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = yaml.load(f, Loader=LOADERS[loader])
+        return extract_record(data), None
+
+    except (yaml.YAMLError, IOError, UnicodeDecodeError) as e:
+        return None, f"Error processing {file_path}: {e}"
+    except Exception as e:
+        return None, f"Unexpected error processing {file_path}: {e}"
+
+def scan_files(file_paths: List[str], jobs: int = 1, loader: str = DEFAULT_LOADER) -> Iterator[Tuple[str, Optional[Dict[str, Any]], Optional[str]]]:
+    """Process YAML files, optionally spread over a pool of worker processes.
+
+    Results are yielded in the order of file_paths regardless of the number
+    of jobs, so the output of a parallel run matches a serial one.
+
+    Args:
+        file_paths: YAML files to process
+        jobs: Number of worker processes to use
+        loader: Name of the YAML loader in LOADERS to use
+    """
+    worker = functools.partial(process_file, loader=loader)
+
+    if jobs > 1 and len(file_paths) > 1:
+        # Hand out files in chunks so the per-task IPC overhead stays small
+        # compared to the YAML parsing done in each worker.
+        chunksize = max(1, len(file_paths) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for file_path, (record, error) in zip(file_paths, executor.map(worker, file_paths, chunksize=chunksize)):
+                yield file_path, record, error
+    else:
+        for file_path in file_paths:
+            yield (file_path, *worker(file_path))
+
+def is_json_safe(value: Any) -> bool:
+    """Return whether value survives a JSON round trip unchanged.
+
+    Dates, tuples, sets and mappings with non-string keys would come back
+    from the cache as different types than a fresh parse produces.
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return True
+    if isinstance(value, list):
+        return all(is_json_safe(item) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and is_json_safe(v) for k, v in value.items())
+    return False
+
+class RecordCache:
+    """On-disk cache of file records for a device-management checkout.
+
+    Records are keyed by their path relative to the checkout and validated
+    against the file's mtime and size, so only added or changed files need to
+    be parsed again. The whole cache is discarded when EXTRACTOR_VERSION
+    changes. Without a path the cache only lives in memory. Records holding
+    values JSON can not represent exactly are kept in memory but not written
+    to disk.
+    """
+
+    def __init__(self, path: str = "") -> None:
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.dirty = False
+        # Incremented on every change, lets long-lived users detect updates
+        self.generation = 0
+        self.load()
+
+    def load(self) -> None:
+        """Read the cache file, ignoring it if missing, corrupt or outdated."""
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        if isinstance(data, dict) and data.get("version") == EXTRACTOR_VERSION:
+            self.entries = data.get("files", {})
+
+    def save(self) -> None:
+        """Write the cache file if it changed since it was loaded."""
+        if not self.dirty or not self.path:
+            self.dirty = False
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        files = {name: entry for name, entry in self.entries.items() if is_json_safe(entry["record"])}
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": EXTRACTOR_VERSION, "files": files}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def get(self, name: str, stat: os.stat_result) -> Optional[Dict[str, Any]]:
+        """Return the cached record for name if the file is unchanged."""
+        entry = self.entries.get(name)
+        if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return entry["record"]
+        return None
+
+    def put(self, name: str, stat: os.stat_result, record: Dict[str, Any]) -> None:
+        """Store the record for name."""
+        self.entries[name] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "record": record}
+        self.dirty = True
+        self.generation += 1
+
+    def prune(self, names: Set[str]) -> None:
+        """Drop the records of files that no longer exist."""
+        for name in set(self.entries) - names:
+            del self.entries[name]
+            self.dirty = True
+            self.generation += 1
+
+def sniff_payload_types(file_path: str, limit: int = SNIFF_BYTES) -> Optional[Set[str]]:
+    """Read the payload and declaration type of a file without loading it.
+
+    Only the first limit bytes are read and scanned line by line for the
+    payloadtype/declarationtype entries directly below the top-level payload
+    mapping, which Apple's files list right at the start of the payload.
+
+    Args:
+        file_path: Path of the YAML file
+        limit: Maximum number of bytes to read
+
+    Returns:
+        Set of types found, or None if they could not be determined and the
+        file has to be loaded to find out
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            prefix = f.read(limit)
+    except OSError:
+        return None
+
+    text = prefix.decode('utf-8', errors='replace')
+    truncated = len(prefix) == limit
+    if truncated:
+        # The read stopped at limit, so the last line may be cut short
+        text = text.rpartition("\n")[0]
+
+    types = set()
+    in_payload = False
+    indent = None
+    # Whether the previous line held a type that a deeper line could continue
+    open_type = False
+    for raw_line in text.splitlines():
+        line = raw_line.rstrip()
+        if not line or line.lstrip().startswith("#"):
+            continue
+        stripped = line.lstrip(" ")
+        depth = len(line) - len(stripped)
+
+        if open_type and depth > indent:
+            # The type is a plain scalar spanning several lines
+            return None
+        open_type = False
+
+        if depth == 0:
+            if in_payload:
+                break
+            in_payload = line == "payload:"
+            continue
+        if not in_payload:
+            continue
+
+        if indent is None:
+            indent = depth
+        if depth != indent:
+            continue
+
+        name, _, value = stripped.partition(":")
+        if name in ("payloadtype", "declarationtype"):
+            value = value.split(" #", 1)[0].strip()
+            quote = value[:1]
+            if quote in ("'", '"'):
+                if len(value) < 2 or value[-1] != quote:
+                    return None
+                value = value[1:-1]
+                if "\\" in value or "'" in value:
+                    # Escaped characters need the full parser to resolve
+                    return None
+            elif not value or value[0] in PLAIN_SCALAR_INDICATORS:
+                # Block scalars, flow collections, anchors and tags need the
+                # full parser to resolve
+                return None
+            if not value:
+                return None
+            types.add(value)
+            open_type = True
+
+    if open_type and truncated:
+        # The line continuing the type may lie beyond limit
+        return None
+    return types or None
+
+def iter_records(directory: str, jobs: int = 1, cache: Optional[RecordCache] = None, type_filter: str = "", loader: str = DEFAULT_LOADER) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yield the records of all YAML files in directory as they are loaded.
+
+    Records come out in file order as soon as each file has been processed,
+    so callers can stream results while the rest of the tree is still being
+    parsed. The cache is updated once the generator is exhausted.
+
+    When a type filter is given, files that are not cached are sniffed with
+    sniff_payload_types first and only loaded if they may match, so filtered
+    runs parse files in proportion to the matches rather than the corpus.
+
+    Args:
+        directory: Directory path to search for YAML files
+        jobs: Number of worker processes used to parse files
+        cache: Optional cache to reuse records of unchanged files from
+        type_filter: string value of a declaration or payload type
+        loader: Name of the YAML loader in LOADERS to use
+    """
+    file_paths = list(iter_yaml_files(directory))
+    cached: Dict[str, Dict[str, Any]] = {}
+    stats = {}
+    pending = []
+
+    for file_path in file_paths:
+        if cache is None:
+            pending.append(file_path)
+            continue
+        try:
+            stats[file_path] = os.stat(file_path)
+        except OSError:
+            pending.append(file_path)
+            continue
+        record = cache.get(os.path.relpath(file_path, directory), stats[file_path])
+        if record is None:
+            pending.append(file_path)
+        else:
+            cached[file_path] = record
+
+    if type_filter:
+        pending = [
+            file_path for file_path in pending
+            if type_filter in (sniff_payload_types(file_path) or {type_filter})
+        ]
+
+    # scan_files yields in the order of pending, which follows file_paths
+    scanned = scan_files(pending, jobs, loader)
+    pending_paths = set(pending)
+
+    for file_path in file_paths:
+        if file_path in cached:
+            yield file_path, cached[file_path]
+            continue
+        if file_path not in pending_paths:
+            continue
+
+        _, record, error = next(scanned)
+        if error:
+            print(error, file=sys.stderr)
+            continue
+        if cache is not None and file_path in stats:
+            cache.put(os.path.relpath(file_path, directory), stats[file_path], record)
+        yield file_path, record
+
+    if cache is not None:
+        cache.prune({os.path.relpath(file_path, directory) for file_path in file_paths})
+        cache.save()
+
+def load_records(directory: str, jobs: int = 1, cache: Optional[RecordCache] = None, type_filter: str = "", loader: str = DEFAULT_LOADER) -> List[Tuple[str, Dict[str, Any]]]:
+    """Load the records of all YAML files in directory.
+
+    Args:
+        directory: Directory path to search for YAML files
+        jobs: Number of worker processes used to parse files
+        cache: Optional cache to reuse records of unchanged files from
+        type_filter: string value of a declaration or payload type
+        loader: Name of the YAML loader in LOADERS to use
+
+    Returns:
+        List of (file path, record) tuples in file order
+    """
+    return list(iter_records(directory, jobs, cache, type_filter, loader))
+
+def iter_selected_records(directory: str, options: argparse.Namespace) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yield the records of all files in directory that pass the type filter.
+
+    Args:
+        directory: Directory path to search for YAML files
+        options: Parsed command line arguments containing type filter,
+            number of jobs and cache file
+    """
+    cache_path = getattr(options, "cache", "")
+    cache = RecordCache(cache_path) if cache_path else None
+
+    records = iter_records(
+        directory,
+        getattr(options, "jobs", 1),
+        cache,
+        options.type_filter,
+        getattr(options, "loader", DEFAULT_LOADER),
+    )
+    for file_path, record in records:
+        if not skip_file(options.type_filter, record):
+            yield file_path, record
+
+def collect_keys(directory: str, options: argparse.Namespace) -> Dict[str, List[Dict[str, Any]]]:
+    """Collect payload keys from all YAML configuration files in directory.
+
+    Args:
+        directory: Directory path to search for YAML files
+        options: Parsed command line arguments containing platform, type
+            filter, number of jobs and cache file
+
+    Returns:
+        Dictionary mapping file paths to lists of extracted payload keys
+    """
+    return {
+        file_path: extract_matches(record, options.platform, getattr(options, "subkeys", False))
+        for file_path, record in iter_selected_records(directory, options)
+    }
+
+def extract_matrix_rows(record: Dict[str, Any], subkeys: bool = False) -> List[Dict[str, Any]]:
+    """Extract the payload keys of a record for every platform at once.
+
+    Follows the same rules as extract_matches for each platform, including
+    the fallback to the payload itself for platforms none of the payloadkeys
+    apply to.
+
+    Args:
+        record: File record as returned by extract_record
+        subkeys: Include nested subkeys, named by their dotted path
+
+    Returns:
+        List of rows holding the payload key name and, per platform, the
+        entries extract_os_key found for it
+    """
+    rows = []
+    unmatched = set(PLATFORMS)
+
+    for payload_key in record.get("payloadkeys", []):
+        if not subkeys and "depth" in payload_key:
+            continue
+        row = {}
+        for platform in PLATFORMS:
+            match = extract_os_key(payload_key, platform)
+            if match:
+                row["Payload Key"] = match.pop("Payload Key")
+                row[platform] = match
+                unmatched.discard(platform)
+        if row:
+            rows.append(row)
+
+    payload = record.get("payload")
+    if unmatched and isinstance(payload, dict):
+        row = {}
+        for platform in PLATFORMS:
+            if platform in unmatched:
+                match = extract_os_key(payload, platform)
+                if match:
+                    row["Payload Key"] = match.pop("Payload Key")
+                    row[platform] = match
+        if row:
+            rows.append(row)
+
+    return rows
+
+def collect_matrix(directory: str, options: argparse.Namespace) -> Dict[str, List[Dict[str, Any]]]:
+    """Collect the payload keys of all platforms in a single pass.
+
+    Args:
+        directory: Directory path to search for YAML files
+        options: Parsed command line arguments containing type filter,
+            number of jobs and cache file
+
+    Returns:
+        Dictionary mapping file paths to lists of matrix rows
+    """
+    return {
+        file_path: extract_matrix_rows(record, getattr(options, "subkeys", False))
+        for file_path, record in iter_selected_records(directory, options)
+    }
+
+def iter_entries(directory: str, options: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    """Yield one flat entry per matching payload key and platform.
+
+    Entries are produced file by file as the records are loaded, and the
+    version filter is applied to each entry on its own, so nothing has to be
+    held in memory beyond the file being processed.
+
+    Args:
+        directory: Directory path to search for YAML files
+        options: Parsed command line arguments
+    """
+    platforms = PLATFORMS if options.platform == ALL_PLATFORMS else (options.platform,)
+    version_filter = VersionFilter.from_options(options)
+    subkeys = getattr(options, "subkeys", False)
+
+    for file_path, record in iter_selected_records(directory, options):
+        for platform in platforms:
+            for match in extract_matches(record, platform, subkeys):
+                if version_filter and not version_filter.matches(match):
+                    continue
+                yield {"File": file_path, "Platform": platform, **match}
+
+def write_jsonl(entries: Iterator[Dict[str, Any]]) -> None:
+    """Write entries to stdout as JSON Lines, flushing after every line."""
+    for entry in entries:
+        print(json.dumps(entry), flush=True)
+
+def write_csv(entries: Iterator[Dict[str, Any]]) -> None:
+    """Write entries to stdout as CSV with the columns in CSV_FIELDS."""
+    writer = csv.DictWriter(sys.stdout, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for entry in entries:
+        writer.writerow(entry)
+        sys.stdout.flush()
+
 def find_keys(directory: str, options: argparse.Namespace) -> None:
     """Find and extract payload keys from YAML configuration files.
     
@@ -70,43 +706,22 @@ def find_keys(directory: str, options: argparse.Namespace) -> None:
         directory: Directory path to search for YAML files
         options: Parsed command line arguments containing platform and OS filter
     """
-    platform = options.platform
-    os_filter = options.os_filter
-    type_filter = options.type_filter
-    results = defaultdict(list)
-
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith(".yaml"):
-                file_path = os.path.join(root, file)
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        data = yaml.safe_load(f)
-                        if skip_file(type_filter, data):
-                            continue
-                        if isinstance(data, dict):
-                            # Try payloadkeys first
-                            payload_keys = data.get("payloadkeys")
-                            if isinstance(payload_keys, list):
-                                for payload_key in payload_keys:
-                                    match = extract_os_key(payload_key, platform)
-                                    if match:
-                                        results[file_path].append(match)
-                            
-                            # If no payloadkeys found, try payload
-                            if not results[file_path]:
-                                payload = data.get("payload")
-                                if isinstance(payload, dict):
-                                    match = extract_os_key(payload, platform)
-                                    if match:
-                                        results[file_path].append(match)
-                                        
-                except (yaml.YAMLError, IOError, UnicodeDecodeError) as e:
-                    print(f"Error processing {file_path}: {e}")
-                except Exception as e:
-                    print(f"Unexpected error processing {file_path}: {e}")
-
-    print_results_table(results, os_filter)
+    output_format = getattr(options, "output_format", "table")
+    if output_format in ("jsonl", "csv"):
+        writer = write_jsonl if output_format == "jsonl" else write_csv
+        try:
+            writer(iter_entries(directory, options))
+        except BrokenPipeError:
+            # The consumer of the stream (e.g. head) exited early
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            exit(1)
+    elif options.platform == ALL_PLATFORMS:
+        results = collect_matrix(directory, options)
+        print_matrix_table(results, VersionFilter.from_options(options))
+    else:
+        results = collect_keys(directory, options)
+        print_results_table(results, VersionFilter.from_options(options))
 
 def extract_os_key(payload_key: Dict[str, Any], platform: str) -> Optional[Dict[str, Any]]:
     """Extract OS-specific key information from payload key data.
@@ -136,46 +751,749 @@ def extract_os_key(payload_key: Dict[str, Any], platform: str) -> Optional[Dict[
 
     return None
 
-def print_results_table(results: Dict[str, List[Dict[str, Any]]], os_filter: str) -> None:
+def parse_version(value: Any) -> Optional[Version]:
+    """Parse a version string into a comparable tuple.
+
+    Trailing zero components are dropped so that '26', '26.0' and '26.0.0'
+    compare equal.
+
+    Args:
+        value: Version string such as '15.1' or '26.0'
+
+    Returns:
+        Tuple of version components, or None if value is not a version
+    """
+    match = VERSION_PATTERN.match(str(value).strip())
+    if not match:
+        return None
+    parts = [int(part) for part in match.group(0).split(".")]
+    while len(parts) > 1 and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
+
+def version_arg(value: str) -> str:
+    """Validate a version given on the command line.
+
+    Raises:
+        argparse.ArgumentTypeError: If value is not a version
+    """
+    if parse_version(value) is None:
+        raise argparse.ArgumentTypeError(f"Invalid version: {value}")
+    return value
+
+def version_prefix(value: str) -> Tuple[Version, Version]:
+    """Return the half-open range of versions starting with value.
+
+    '26' covers 26 up to but excluding 27, '15.0' covers 15.0.x but not 15.1.
+    """
+    parts = [int(part) for part in VERSION_PATTERN.match(value.strip()).group(0).split(".")]
+    upper = parts[:-1] + [parts[-1] + 1]
+    return parse_version(value), parse_version(".".join(map(str, upper)))
+
+class VersionIndex:
+    """Sorted versions of a list of entries, searched with bisect.
+
+    For every version field the parsed versions are kept in ascending order
+    alongside the number of the entry they came from, so a range of versions
+    is found with two binary searches instead of a scan over all entries.
+    """
+
+    def __init__(self, entries: List[Dict[str, Any]]) -> None:
+        self.versions: Dict[str, List[Version]] = {}
+        self.numbers: Dict[str, List[int]] = {}
+        for field in VERSION_FIELDS:
+            pairs = []
+            for number, entry in enumerate(entries):
+                if field in entry:
+                    version = parse_version(entry[field])
+                    if version is not None:
+                        pairs.append((version, number))
+            pairs.sort()
+            self.versions[field] = [version for version, _ in pairs]
+            self.numbers[field] = [number for _, number in pairs]
+
+    def select(self, field: str, low: Optional[Version], high: Optional[Version]) -> List[int]:
+        """Return the entries whose field lies in the range [low, high).
+
+        Args:
+            field: Version field to search
+            low: Lowest included version, or None for no lower bound
+            high: First excluded version, or None for no upper bound
+        """
+        versions = self.versions[field]
+        start = 0 if low is None else bisect_left(versions, low)
+        end = len(versions) if high is None else bisect_left(versions, high)
+        return self.numbers[field][start:end]
+
+class VersionFilter:
+    """Version criteria that entries have to satisfy.
+
+    Each condition is a set of version fields and a half-open version range;
+    an entry satisfies a condition if any of the fields lies in the range,
+    and the filter if it satisfies every condition.
+    """
+
+    def __init__(self) -> None:
+        self.conditions: List[Tuple[Tuple[str, ...], Optional[Version], Optional[Version]]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.conditions)
+
+    def add(self, fields: Tuple[str, ...], low: Optional[Version], high: Optional[Version]) -> None:
+        """Add a condition on fields for the range [low, high)."""
+        self.conditions.append((fields, low, high))
+
+    @classmethod
+    def from_options(cls, options: argparse.Namespace) -> "VersionFilter":
+        """Build the filter from the version options of either command."""
+        version_filter = cls()
+        if getattr(options, "os_filter", ""):
+            version_filter.add(VERSION_FIELDS, *version_prefix(options.os_filter))
+        for field in VERSION_FIELDS:
+            if getattr(options, field, ""):
+                version_filter.add((field,), *version_prefix(getattr(options, field)))
+        if getattr(options, "introduced_since", ""):
+            version_filter.add(("introduced",), parse_version(options.introduced_since), None)
+        if getattr(options, "deprecated_before", ""):
+            version_filter.add(("deprecated",), None, parse_version(options.deprecated_before))
+        if getattr(options, "changed_between", None):
+            first, last = options.changed_between
+            version_filter.add(VERSION_FIELDS, parse_version(first), version_prefix(last)[1])
+        return version_filter
+
+    def matches(self, entry: Dict[str, Any]) -> bool:
+        """Return whether a single entry satisfies the filter.
+
+        Used when entries are streamed one at a time and no index over all of
+        them exists.
+        """
+        for fields, low, high in self.conditions:
+            for field in fields:
+                version = parse_version(entry[field]) if field in entry else None
+                if version is None:
+                    continue
+                if (low is None or version >= low) and (high is None or version < high):
+                    break
+            else:
+                return False
+        return True
+
+    def select(self, index: VersionIndex) -> Set[int]:
+        """Return the numbers of the indexed entries satisfying the filter."""
+        selected = None
+        for fields, low, high in self.conditions:
+            numbers = set()
+            for field in fields:
+                numbers.update(index.select(field, low, high))
+            selected = numbers if selected is None else selected & numbers
+        return selected or set()
+
+def add_version_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the version range options shared by the scan and query commands."""
+    parser.add_argument(
+        "--introduced-since",
+        dest="introduced_since",
+        type=version_arg,
+        default=None,
+        help="Only keys introduced in this OS version or later"
+    )
+
+    parser.add_argument(
+        "--deprecated-before",
+        dest="deprecated_before",
+        type=version_arg,
+        default=None,
+        help="Only keys deprecated before this OS version"
+    )
+
+    parser.add_argument(
+        "--changed-between",
+        dest="changed_between",
+        type=version_arg,
+        nargs=2,
+        metavar=("FIRST", "LAST"),
+        default=None,
+        help="Only keys introduced, deprecated or removed from FIRST through LAST"
+    )
+
+def add_loader_argument(parser: argparse.ArgumentParser) -> None:
+    """Add the --loader option shared by the scan and query commands."""
+    parser.add_argument(
+        "--loader",
+        dest="loader",
+        type=loader_name,
+        default="auto",
+        help="YAML loader: auto (libyaml C loader when available), c, or python"
+    )
+
+def print_results_table(results: Dict[str, List[Dict[str, Any]]], version_filter: VersionFilter) -> None:
     """Print results in a formatted table.
     
     Args:
         results: Dictionary mapping file paths to lists of extracted payload keys
-        os_filter: OS version filter to apply to results
+        version_filter: OS version criteria to apply to results
     """
     if not results:
         print("No payloadKeys with non-'n/a' entries found.")
         return
 
+    selected = None
+    if version_filter:  # Show all results if no filter specified
+        entries = [match for matches in results.values() for match in matches]
+        selected = version_filter.select(VersionIndex(entries))
+
+    number = 0
     for file, matches in results.items():
-        try:
-            table_data = []
-            for match in matches:
-                if not os_filter:  # Show all results if no filter specified
-                    table_data.append(match)
-                    continue
-                if "introduced" in match:
-                    if os_filter in match["introduced"]:
-                        table_data.append(match)
-                if "deprecated" in match:
-                    if os_filter in match["deprecated"]:
-                        table_data.append(match)
-                elif "removed" in match:
-                    if os_filter in match["removed"]:
-                        table_data.append(match)
-                
-
-        except KeyError:
-            table_data = []
+        table_data = []
+        for match in matches:
+            if selected is None or number in selected:
+                table_data.append(match)
+            number += 1
             
         if table_data:
             print(f"\n📄 File: {file}")
             print(tabulate(table_data, headers="keys", tablefmt="grid"))
 
+def format_matrix_cell(entries: Optional[Dict[str, Any]]) -> str:
+    """Format the entries of one platform as a multi-line table cell."""
+    if not entries:
+        return ""
+    return "\n".join(f"{field}: {value}" for field, value in entries.items())
+
+def print_matrix_table(results: Dict[str, List[Dict[str, Any]]], version_filter: VersionFilter) -> None:
+    """Print the key x platform compatibility matrix.
+
+    A row is shown if the entries of any platform satisfy the version filter.
+
+    Args:
+        results: Dictionary mapping file paths to lists of matrix rows
+        version_filter: OS version criteria to apply to results
+    """
+    if not results:
+        print("No payloadKeys with non-'n/a' entries found.")
+        return
+
+    selected = None
+    if version_filter:
+        cells = []
+        cell_rows = []
+        number = 0
+        for rows in results.values():
+            for row in rows:
+                for platform in PLATFORMS:
+                    if platform in row:
+                        cells.append(row[platform])
+                        cell_rows.append(number)
+                number += 1
+        selected = {cell_rows[cell] for cell in version_filter.select(VersionIndex(cells))}
+
+    number = 0
+    for file, rows in results.items():
+        table_data = []
+        for row in rows:
+            if selected is None or number in selected:
+                table_data.append({
+                    "Payload Key": row["Payload Key"],
+                    **{platform: format_matrix_cell(row.get(platform)) for platform in PLATFORMS},
+                })
+            number += 1
+
+        if table_data:
+            print(f"\n📄 File: {file}")
+            print(tabulate(table_data, headers="keys", tablefmt="grid"))
+
+class KeyIndex:
+    """Inverted index over the payload keys of a device-management checkout.
+
+    Every (file, payload key, platform) combination with non-'n/a' entries,
+    nested subkeys included, is stored once as an entry. Postings map
+    lowercased key names, payload or declaration types and platforms to entry
+    numbers, and a VersionIndex holds the sorted versions, so queries are
+    answered by lookups, binary searches and set intersection instead of a
+    scan. Only the entries are saved to disk; postings are rebuilt on load.
+    """
+
+    def __init__(self, entries: List[Dict[str, Any]]) -> None:
+        self.entries = entries
+        self.postings: Dict[str, Dict[str, List[int]]] = {
+            field: defaultdict(list) for field in ("key", "type", "platform")
+        }
+        for number, entry in enumerate(entries):
+            key_path = entry["Payload Key"].lower()
+            self.postings["key"][key_path].append(number)
+            # Nested keys can also be found by their own name
+            key_name = key_path.rsplit(".", 1)[-1]
+            if key_name != key_path:
+                self.postings["key"][key_name].append(number)
+            self.postings["type"][entry["Type"].lower()].append(number)
+            self.postings["platform"][entry["Platform"]].append(number)
+        self.versions = VersionIndex(entries)
+
+    @classmethod
+    def build(cls, directory: str, records: List[Tuple[str, Dict[str, Any]]]) -> "KeyIndex":
+        """Build the index from file records.
+
+        Args:
+            directory: Checkout the records were loaded from
+            records: List of (file path, record) tuples as returned by load_records
+        """
+        entries = []
+        for file_path, record in records:
+            payload = record.get("payload")
+            if not isinstance(payload, dict):
+                continue
+            payload_type = payload.get("payloadtype") or payload.get("declarationtype") or ""
+            platforms = set()
+            for item in [payload, *record.get("payloadkeys", [])]:
+                supported_os = item.get("supportedOS")
+                if isinstance(supported_os, dict):
+                    platforms.update(supported_os)
+            for platform in sorted(platforms):
+                for match in extract_matches(record, platform, subkeys=True):
+                    entries.append({
+                        "File": os.path.relpath(file_path, directory),
+                        "Type": payload_type,
+                        "Platform": platform,
+                        **match,
+                    })
+        return cls(entries)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["KeyIndex"]:
+        """Load an index saved with save, or None if missing or outdated."""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if not isinstance(data, dict) or data.get("version") != EXTRACTOR_VERSION:
+            return None
+        return cls(data["entries"])
+
+    def save(self, path: str) -> None:
+        """Write the index entries to path."""
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": EXTRACTOR_VERSION, "entries": self.entries}, f)
+        os.replace(tmp_path, path)
+
+    def lookup(self, version_filter: Optional[VersionFilter] = None, **criteria: str) -> List[Dict[str, Any]]:
+        """Return the entries matching all given criteria.
+
+        Args:
+            version_filter: Optional OS version criteria
+            criteria: Values for key, type or platform. Key names and types
+                are matched case-insensitively, empty values are ignored.
+
+        Returns:
+            Matching entries in file order
+        """
+        postings = []
+        for field, value in criteria.items():
+            if not value:
+                continue
+            if field in ("key", "type"):
+                value = value.lower()
+            postings.append(self.postings[field].get(value, []))
+
+        if version_filter:
+            postings.append(version_filter.select(self.versions))
+
+        if not postings:
+            return list(self.entries)
+
+        # Intersect starting from the shortest posting list
+        postings.sort(key=len)
+        numbers = set(postings[0])
+        for posting in postings[1:]:
+            numbers.intersection_update(posting)
+        return [self.entries[number] for number in sorted(numbers)]
+
+def load_index(options: argparse.Namespace) -> Optional[KeyIndex]:
+    """Load the index named by options.index, building it when needed.
+
+    Args:
+        options: Parsed query arguments containing directory, index, cache,
+            jobs and the rebuild flag
+
+    Returns:
+        The index, or None if it could not be loaded or built
+    """
+    index = None
+    if options.index and not options.rebuild:
+        index = KeyIndex.load(options.index)
+
+    if index is None:
+        if not os.path.exists(options.directory):
+            print(f"Directory {options.directory} does not exist.")
+            return None
+        cache = RecordCache(options.cache) if options.cache else None
+        index = KeyIndex.build(options.directory, load_records(options.directory, options.jobs, cache, loader=options.loader))
+        if options.index:
+            index.save(options.index)
+
+    return index
+
+def query_main(argv: List[str]) -> None:
+    """Entry point for the query subcommand."""
+    parser = argparse.ArgumentParser(
+        prog=f"{os.path.basename(sys.argv[0])} query",
+        description="Look up payload keys in a prebuilt index of Apple's device management repo"
+    )
+
+    parser.add_argument(
+        "-d", "--directory",
+        dest="directory",
+        required=False,
+        default="",
+        help="Directory of Apple's Device Managment repo, used to build the index"
+    )
+
+    parser.add_argument(
+        "-i", "--index",
+        dest="index",
+        required=False,
+        default="",
+        help="Index file to reuse across queries; built from --directory if missing"
+    )
+
+    parser.add_argument(
+        "--rebuild",
+        dest="rebuild",
+        action="store_true",
+        help="Rebuild the index file even if it exists"
+    )
+
+    parser.add_argument(
+        "-k", "--key",
+        dest="key",
+        default="",
+        help="Payload key name or dotted path of a nested key (case-insensitive)"
+    )
+
+    parser.add_argument(
+        "-t", "--type",
+        dest="type_filter",
+        default="",
+        help="Payload or declaration type (case-insensitive)"
+    )
+
+    parser.add_argument(
+        "-p", "--platform",
+        dest="platform",
+        type=normalize_platform,
+        default=None,
+        help="Target platform: macOS, iOS, or visionOS"
+    )
+
+    for field in VERSION_FIELDS:
+        parser.add_argument(
+            f"--{field}",
+            dest=field,
+            type=version_arg,
+            default=None,
+            help=f"OS version the key was {field} in (e.g., '26' or '15.1')"
+        )
+
+    add_version_arguments(parser)
+
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=positive_jobs,
+        default=1,
+        help="Number of worker processes used to parse files when building the index"
+    )
+
+    parser.add_argument(
+        "-c", "--cache",
+        dest="cache",
+        default="",
+        help="File used to cache parsed records when building the index"
+    )
+
+    add_loader_argument(parser)
+
+    options = parser.parse_args(argv)
+    if not options.index and not options.directory:
+        parser.error("one of --index or --directory is required")
+
+    index = load_index(options)
+    if index is None:
+        exit(1)
+
+    entries = index.lookup(
+        VersionFilter.from_options(options),
+        key=options.key,
+        type=options.type_filter,
+        platform=None if options.platform == ALL_PLATFORMS else options.platform,
+    )
+
+    if entries:
+        print(tabulate(entries, headers="keys", tablefmt="grid"))
+    else:
+        print("No payload keys match the query.")
+
+class Corpus:
+    """Device-management records and their index, kept in memory.
+
+    The checkout is re-scanned at most every refresh_interval seconds; the
+    scan only stats files and parses the ones that were added or changed, and
+    the index is rebuilt only when a record actually changed. Once an index
+    is loaded, scans run on a background thread and queries keep being
+    answered from the current index until the new one is swapped in.
+    """
+
+    def __init__(self, directory: str, jobs: int = 1, cache_path: str = "", loader: str = DEFAULT_LOADER, refresh_interval: float = 2.0) -> None:
+        self.directory = directory
+        self.jobs = jobs
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.cache = RecordCache(cache_path)
+        self.index: Optional[KeyIndex] = None
+        self.files = 0
+        self.generation = -1
+        self.refreshed = 0.0
+        self.scanning = False
+        # Guards the fields above and is only held briefly
+        self.lock = threading.Lock()
+        # Serialises scans, which update the cache
+        self.scan_lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> KeyIndex:
+        """Return the index, starting a background scan when it is due.
+
+        Scans block the caller only for the first load and when forced.
+        """
+        if force or self.index is None:
+            self.scan(force)
+            return self.index
+
+        with self.lock:
+            due = not self.scanning and time.monotonic() - self.refreshed >= self.refresh_interval
+            if due:
+                self.scanning = True
+            index = self.index
+        if due:
+            threading.Thread(target=self.background_scan, daemon=True).start()
+        return index
+
+    def background_scan(self) -> None:
+        """Run a scan started by refresh and allow the next one."""
+        try:
+            self.scan()
+        finally:
+            with self.lock:
+                self.scanning = False
+
+    def scan(self, force: bool = False) -> None:
+        """Re-scan the checkout and swap in a new index if a record changed."""
+        with self.scan_lock:
+            # Another caller may have finished a scan while this one waited
+            if not force and self.index is not None and time.monotonic() - self.refreshed < self.refresh_interval:
+                return
+            records = load_records(self.directory, self.jobs, self.cache, loader=self.loader)
+            index = None
+            if self.index is None or self.cache.generation != self.generation:
+                index = KeyIndex.build(self.directory, records)
+            with self.lock:
+                if index is not None:
+                    self.index = index
+                    self.files = len(records)
+                    self.generation = self.cache.generation
+                self.refreshed = time.monotonic()
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answers queries against the Corpus of the server with JSON.
+
+    GET /query accepts the options of the query subcommand as parameters
+    (key, type, platform, introduced, deprecated, removed, introduced_since,
+    deprecated_before and changed_between=FIRST,LAST) and returns the
+    matching payload keys grouped by file. GET /status describes the loaded
+    corpus and POST /reload forces a refresh.
+    """
+
+    def address_string(self) -> str:
+        # Unix socket peers have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def send_json(self, status: int, body: Any) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        corpus = self.server.corpus
+
+        if url.path == "/status":
+            index = corpus.refresh()
+            self.send_json(200, {
+                "directory": corpus.directory,
+                "files": corpus.files,
+                "entries": len(index.entries),
+            })
+        elif url.path == "/query":
+            try:
+                options = self.query_options(parse_qs(url.query))
+            except (argparse.ArgumentTypeError, ValueError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+
+            entries = corpus.refresh().lookup(
+                VersionFilter.from_options(options),
+                key=options.key,
+                type=options.type_filter,
+                platform=options.platform,
+            )
+            results: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+            for entry in entries:
+                results[entry["File"]].append({k: v for k, v in entry.items() if k != "File"})
+            self.send_json(200, {"count": len(entries), "results": results})
+        else:
+            self.send_json(404, {"error": f"Unknown path: {url.path}"})
+
+    def do_POST(self) -> None:
+        if urlparse(self.path).path == "/reload":
+            index = self.server.corpus.refresh(force=True)
+            self.send_json(200, {"files": self.server.corpus.files, "entries": len(index.entries)})
+        else:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    @staticmethod
+    def query_options(params: Dict[str, List[str]]) -> argparse.Namespace:
+        """Convert query string parameters to query subcommand options."""
+        def param(name: str) -> str:
+            return params.get(name, [""])[-1]
+
+        platform = normalize_platform(param("platform")) if param("platform") else None
+        options = argparse.Namespace(
+            key=param("key"),
+            type_filter=param("type"),
+            platform=None if platform == ALL_PLATFORMS else platform,
+            introduced_since=param("introduced_since") and version_arg(param("introduced_since")),
+            deprecated_before=param("deprecated_before") and version_arg(param("deprecated_before")),
+            changed_between=None,
+        )
+        for field in VERSION_FIELDS:
+            setattr(options, field, param(field) and version_arg(param(field)))
+        if param("changed_between"):
+            first, last = param("changed_between").split(",")
+            options.changed_between = (version_arg(first), version_arg(last))
+        return options
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """Threaded HTTP server listening on a Unix domain socket."""
+    daemon_threads = True
+
+def serve_main(argv: List[str]) -> None:
+    """Entry point for the serve subcommand."""
+    parser = argparse.ArgumentParser(
+        prog=f"{os.path.basename(sys.argv[0])} serve",
+        description="Keep Apple's device management repo loaded and answer queries over HTTP"
+    )
+
+    parser.add_argument(
+        "-d", "--directory",
+        dest="directory",
+        required=True,
+        help="Directory of Apple's Device Managment repo"
+    )
+
+    parser.add_argument(
+        "--host",
+        dest="host",
+        default="127.0.0.1",
+        help="Address to listen on (default: 127.0.0.1)"
+    )
+
+    parser.add_argument(
+        "--port",
+        dest="port",
+        type=int,
+        default=8765,
+        help="TCP port to listen on (default: 8765)"
+    )
+
+    parser.add_argument(
+        "--socket",
+        dest="socket",
+        default="",
+        help="Listen on this Unix domain socket instead of TCP"
+    )
+
+    parser.add_argument(
+        "--refresh-interval",
+        dest="refresh_interval",
+        type=float,
+        default=2.0,
+        help="Minimum seconds between checks of the repo for changed files (default: 2)"
+    )
+
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=positive_jobs,
+        default=1,
+        help="Number of worker processes used to parse files"
+    )
+
+    parser.add_argument(
+        "-c", "--cache",
+        dest="cache",
+        default="",
+        help="File used to persist parsed records across restarts"
+    )
+
+    add_loader_argument(parser)
+
+    options = parser.parse_args(argv)
+    if not os.path.exists(options.directory):
+        print(f"Directory {options.directory} does not exist.")
+        exit(1)
+
+    corpus = Corpus(options.directory, options.jobs, options.cache, options.loader, options.refresh_interval)
+    index = corpus.refresh()
+
+    if options.socket:
+        if os.path.exists(options.socket):
+            os.unlink(options.socket)
+        server = UnixHTTPServer(options.socket, QueryHandler)
+        address = options.socket
+    else:
+        server = ThreadingHTTPServer((options.host, options.port), QueryHandler)
+        address = f"http://{options.host}:{server.server_address[1]}"
+    server.corpus = corpus
+
+    print(f"Loaded {corpus.files} files ({len(index.entries)} entries), listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if options.socket and os.path.exists(options.socket):
+            os.unlink(options.socket)
+
 def main() -> None:
     """Main entry point for the script."""
+    if sys.argv[1:2] == ["query"]:
+        query_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["serve"]:
+        serve_main(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(
-        description="Parse Apple device management YAML files to extract payload keys"
+        description="Parse Apple device management YAML files to extract payload keys",
+        epilog="Run '%(prog)s query --help' to look up keys in a prebuilt index, "
+               "or '%(prog)s serve --help' to answer queries from a long-lived process."
     )
 
     parser.add_argument(
@@ -183,16 +1501,19 @@ def main() -> None:
         dest="platform", 
         type=normalize_platform, 
         required=True, 
-        help="Target platform: macOS, iOS, or visionOS"
+        help="Target platform: macOS, iOS, visionOS, or all for a compatibility matrix"
     )
 
     parser.add_argument(
         "-o", "--os_filter", 
         dest="os_filter", 
+        type=version_arg,
         required=False, 
-        default="", 
-        help="OS version to filter results (e.g., '26' for version 26)"
+        default=None, 
+        help="OS version to filter results (e.g., '26' for any 26.x version)"
     )
+
+    add_version_arguments(parser)
     
     parser.add_argument(
         "-d", "--directory",
@@ -210,6 +1531,40 @@ def main() -> None:
         help="Only provide results filtered on provided payload or declaration type"
     )
 
+    parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=positive_jobs,
+        required=False,
+        default=1,
+        help="Number of worker processes used to parse files (0 = one per CPU core)"
+    )
+
+    parser.add_argument(
+        "-c", "--cache",
+        dest="cache",
+        required=False,
+        default="",
+        help="File used to cache parsed records between runs; only changed files are parsed again"
+    )
+
+    add_loader_argument(parser)
+
+    parser.add_argument(
+        "-s", "--subkeys",
+        dest="subkeys",
+        action="store_true",
+        help="Include nested subkeys, named by their dotted path (e.g. Rules.Conditions.Operator)"
+    )
+
+    parser.add_argument(
+        "-f", "--format",
+        dest="output_format",
+        choices=OUTPUT_FORMATS,
+        default="table",
+        help="Output format; jsonl and csv are streamed while files are processed"
+    )
+
     options = parser.parse_args()
     
     if os.path.exists(options.directory):
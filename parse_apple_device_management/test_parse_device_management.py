@@ -0,0 +1,197 @@
+"""Tests for parse_device_management.py
+
+The YAML files are small stand-ins for the ones in Apple's device-management
+repository, written to a temporary checkout for every test.
+Run with `python -m unittest` or pytest from this directory.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import parse_device_management as pdm
+import yaml
+
+PAYLOAD = """\
+title: {name}
+payload:
+  payloadtype: {payload_type}
+  supportedOS:
+    macOS:
+      introduced: {introduced}
+payloadkeys:
+- key: {name}Key
+  supportedOS:
+    iOS:
+      introduced: '17.0'
+"""
+
+
+def write_file(directory, name, text):
+    path = os.path.join(directory, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+
+class CheckoutTestCase(unittest.TestCase):
+    """Creates an empty checkout and a cache path next to it."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="device-management-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.checkout = os.path.join(self.directory, "checkout")
+        os.mkdir(self.checkout)
+        self.cache_path = os.path.join(self.directory, "cache.json")
+
+    def write_payload(self, name, payload_type="com.apple.test", introduced="'14.0'"):
+        text = PAYLOAD.format(name=name, payload_type=payload_type, introduced=introduced)
+        return write_file(self.checkout, f"{name}.yaml", text)
+
+    def load(self, cache, **kwargs):
+        """Return the records and the files that had to be parsed to get them."""
+        with mock.patch.object(pdm, "process_file", wraps=pdm.process_file) as process_file:
+            records = pdm.load_records(self.checkout, cache=cache, loader="python", **kwargs)
+        parsed = sorted(os.path.basename(call.args[0]) for call in process_file.call_args_list)
+        return records, parsed
+
+
+class RecordCacheTest(CheckoutTestCase):
+    def setUp(self):
+        super().setUp()
+        self.first = self.write_payload("First")
+        self.second = self.write_payload("Second")
+        self.load(pdm.RecordCache(self.cache_path))
+
+    def saved_names(self):
+        with open(self.cache_path, encoding="utf-8") as f:
+            return sorted(json.load(f)["files"])
+
+    def test_unchanged_files_are_not_parsed(self):
+        records, parsed = self.load(pdm.RecordCache(self.cache_path))
+        self.assertEqual(parsed, [])
+        self.assertEqual(records, self.load(None)[0])
+
+    def test_changed_mtime_is_parsed_again(self):
+        stat = os.stat(self.first)
+        os.utime(self.first, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        self.assertEqual(self.load(pdm.RecordCache(self.cache_path))[1], ["First.yaml"])
+
+    def test_changed_size_is_parsed_again(self):
+        stat = os.stat(self.second)
+        with open(self.second, "a", encoding="utf-8") as f:
+            f.write("# comment\n")
+        os.utime(self.second, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(self.load(pdm.RecordCache(self.cache_path))[1], ["Second.yaml"])
+
+    def test_other_extractor_version_discards_cache(self):
+        with mock.patch.object(pdm, "EXTRACTOR_VERSION", pdm.EXTRACTOR_VERSION + 1):
+            cache = pdm.RecordCache(self.cache_path)
+            self.assertEqual(cache.entries, {})
+            self.assertEqual(self.load(cache)[1], ["First.yaml", "Second.yaml"])
+
+    def test_deleted_files_are_pruned(self):
+        os.unlink(self.first)
+        records, parsed = self.load(pdm.RecordCache(self.cache_path))
+        self.assertEqual([os.path.basename(path) for path, _ in records], ["Second.yaml"])
+        self.assertEqual(parsed, [])
+        self.assertEqual(self.saved_names(), ["Second.yaml"])
+
+    def test_records_json_can_not_represent_stay_in_memory_only(self):
+        # An unquoted date is loaded as datetime.date, which JSON would turn into a string
+        path = self.write_payload("Dated", introduced="2024-01-01")
+        cache = pdm.RecordCache(self.cache_path)
+        records, parsed = self.load(cache)
+        self.assertEqual(parsed, ["Dated.yaml"])
+        self.assertNotIn("Dated.yaml", self.saved_names())
+
+        again, parsed = self.load(cache)
+        self.assertEqual(parsed, [])
+        self.assertEqual(again, records)
+        self.assertEqual(dict(again)[path], pdm.process_file(path, "python")[0])
+
+
+class SniffPayloadTypesTest(CheckoutTestCase):
+    # Payload entries whose type can only be resolved by the YAML parser
+    UNRESOLVED = {
+        "folded": "  payloadtype: >-\n    com.apple.target\n",
+        "literal": "  payloadtype: |-\n    com.apple.target\n",
+        "flow sequence": "  payloadtype: [com.apple.target]\n",
+        "anchor": "  payloadtype: &type com.apple.target\n",
+        "tag": "  payloadtype: !!str com.apple.target\n",
+        "double quoted escape": '  payloadtype: "com.apple\\u002etarget"\n',
+        "single quoted escape": "  payloadtype: 'com.apple''target'\n",
+        "continued plain scalar": "  payloadtype: com.apple\n    .target\n",
+        "continued quoted scalar": "  payloadtype: 'com.apple\n    .target'\n",
+    }
+
+    def sniff(self, name, text, limit=pdm.SNIFF_BYTES):
+        return pdm.sniff_payload_types(write_file(self.checkout, f"{name}.yaml", text), limit)
+
+    def test_plain_and_quoted_types(self):
+        for value in ("com.apple.target", "com.apple.target # comment", "'com.apple.target'", '"com.apple.target"'):
+            with self.subTest(value=value):
+                self.assertEqual(self.sniff("type", f"payload:\n  payloadtype: {value}\n"), {"com.apple.target"})
+
+    def test_declaration_type(self):
+        text = "payload:\n  declarationtype: com.apple.configuration.target\n"
+        self.assertEqual(self.sniff("declaration", text), {"com.apple.configuration.target"})
+
+    def test_unresolved_scalars_need_a_full_load(self):
+        for name, entry in self.UNRESOLVED.items():
+            with self.subTest(name):
+                self.assertIsNone(self.sniff(name, "payload:\n" + entry))
+
+    def test_flow_mapping_payload_needs_a_full_load(self):
+        self.assertIsNone(self.sniff("flow", "payload: {payloadtype: com.apple.target}\n"))
+
+    def test_type_cut_at_limit_needs_a_full_load(self):
+        text = "payload:\n  payloadtype: com.apple.target\n  supportedOS: {}\n"
+        limit = text.index(".target")
+        self.assertEqual(self.sniff("cut", text), {"com.apple.target"})
+        self.assertIsNone(self.sniff("cut", text, limit))
+
+    def test_continuation_beyond_limit_needs_a_full_load(self):
+        text = "payload:\n  payloadtype: com.apple\n    .target\n"
+        self.assertIsNone(self.sniff("continued", text, text.index("    .target") + 1))
+
+    def test_filtered_run_matches_full_load(self):
+        self.write_payload("Plain", "com.apple.target")
+        self.write_payload("Other", "com.apple.other")
+        self.write_payload("Quoted", "'com.apple.target'")
+        for number, entry in enumerate(self.UNRESOLVED.values()):
+            text = PAYLOAD.format(name=f"Unresolved{number}", payload_type="", introduced="'14.0'")
+            write_file(self.checkout, f"Unresolved{number}.yaml", text.replace("  payloadtype: \n", entry))
+        write_file(self.checkout, "Flow.yaml", "payload: {payloadtype: com.apple.target, supportedOS: {macOS: {introduced: '13.0'}}}\n")
+
+        types = set()
+        for name in os.listdir(self.checkout):
+            with open(os.path.join(self.checkout, name), encoding="utf-8") as f:
+                payload_type = yaml.safe_load(f)["payload"]["payloadtype"]
+            if isinstance(payload_type, str):
+                types.add(payload_type)
+        self.assertIn("com.apple.target", types)
+
+        for type_filter in sorted(types):
+            with self.subTest(type_filter=type_filter):
+                options = argparse.Namespace(platform=pdm.ALL_PLATFORMS, type_filter=type_filter, loader="python")
+                with mock.patch.object(pdm, "process_file", wraps=pdm.process_file) as process_file:
+                    sniffed = list(pdm.iter_entries(self.checkout, options))
+                with mock.patch.object(pdm, "sniff_payload_types", return_value=None):
+                    loaded = list(pdm.iter_entries(self.checkout, options))
+                self.assertEqual(sniffed, loaded)
+                self.assertTrue(loaded)
+                if type_filter == "com.apple.other":
+                    # Only the files with a type sniffed from the raw text are skipped
+                    parsed = {os.path.basename(call.args[0]) for call in process_file.call_args_list}
+                    self.assertEqual(parsed & {"Plain.yaml", "Quoted.yaml"}, set())
+                    self.assertEqual(len(parsed), len(os.listdir(self.checkout)) - 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
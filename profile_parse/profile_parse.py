@@ -6,39 +6,385 @@
 # Date          : 2023-03-29
 # Version       : 1.0
 # Changelog     : 2023-03-29 - Initial Script   
+#                 2026-10-18 - Report on saved dumps from many hosts with --dumps
+#                 2026-10-18 - Read profile dumps incrementally, one profile at a time
 # Notes         : In order to run this, you must run the script with sudo, as the profiles command requires sudo.
 #                 This is only tested on macOS Ventura, but I believe will work on macOS Monterey. 
+#                 With --dumps, saved profile dumps are analysed instead, which does not require sudo or macOS.
 #                 Adapted from an original script from Bob Gendler https://gist.github.com/boberito/9bf7294cb206735ab482d60707714393
 
-import plistlib
+import argparse
+import base64
+import hashlib
+import io
 import subprocess
 import os
+import plistlib
 import sys
+import tarfile
 import textwrap
+import zipfile
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime
+from xml.etree.ElementTree import ParseError, XMLPullParser
 
-def check_values(x):
-    same_values = True
-    same_keys = False
+DUMP_SUFFIXES = ('.xml', '.plist')
+# colors of the groups of differing values, the first group is red as before
+GROUP_COLORS = ('\033[91m', '\033[95m', '\033[96m', '\033[94m')
+READ_SIZE = 64 * 1024
+
+def _canonical_update(digest, value):
+    # every value is tagged with its type and length, and dict keys are sorted,
+    # so equal structures always feed the digest the same bytes
+    if isinstance(value, dict):
+        digest.update(b'd%d:' % len(value))
+        for k in sorted(value):
+            _canonical_update(digest, k)
+            _canonical_update(digest, value[k])
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'l%d:' % len(value))
+        for v in value:
+            _canonical_update(digest, v)
+    elif isinstance(value, bool):
+        digest.update(b'b1' if value else b'b0')
+    elif isinstance(value, int):
+        digest.update(b'i%d;' % value)
+    elif isinstance(value, float):
+        digest.update(b'f' + repr(value).encode() + b';')
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8')
+        digest.update(b's%d:' % len(encoded) + encoded)
+    elif isinstance(value, (bytes, bytearray)):
+        digest.update(b'x%d:' % len(value) + bytes(value))
+    elif isinstance(value, datetime):
+        digest.update(b't' + value.isoformat().encode() + b';')
+    else:
+        encoded = repr(value).encode('utf-8')
+        digest.update(b'r%d:' % len(encoded) + encoded)
+
+def canonical_hash(value):
+    """Hash a plist value so that structurally equal values get the same hash.
+
+    Values of different plist types never match, so true and 1 are different values.
+    """
+    digest = hashlib.sha256()
+    _canonical_update(digest, value)
+    return digest.digest()
 
-    values = []
-    keys = []
+def group_values(x):
+    """Group the entries of a key_dict entry by the value they set.
 
+    Returns a list of groups in the order their values were first seen, each a list
+    of the {profile_name: value} entries setting the same value.
+    """
+    groups = {}
     for d in x:
         for k,v in d.items():
-            values.append(v)
-            if k in keys:
+            groups.setdefault(canonical_hash(v), []).append({k: v})
+    return list(groups.values())
+
+def check_values(x):
+    """Return the entries of a key_dict entry grouped by value, as group_values does, and
+    whether a profile sets the key more than once. The values all match if there is one group.
+    """
+    profiles = set()
+    same_keys = False
+
+    for d in x:
+        for k in d:
+            if k in profiles:
                 same_keys = True
-            keys.append(k)
-    
-    ele = values[0]
-    for value in values:
-        if ele != value:
-            same_values = False
+            profiles.add(k)
+
+    return group_values(x), same_keys
+
+def collect_keys(profile, key_dict, warnings=None):
+    """Add the keys set by the payloads of a profile to key_dict.
+
+    Payloads whose content is not a dict, such as <data> payloads, are skipped. Problems
+    with managed preferences are appended to warnings, or printed to stderr without it.
+    """
+    for items in profile.get("ProfileItems", []):
+        content = items.get("PayloadContent") if isinstance(items, dict) else None
+        if not isinstance(content, dict):
+            continue
+        for key,value in content.items():
+            if key == "PayloadContentManagedPreferences":               
+                for k,v in content['PayloadContentManagedPreferences'].items():
+                    try:
+                        for mcx in content['PayloadContentManagedPreferences'][k]['Forced']:
+                            for mcx_k,mcx_v in mcx['mcx_preference_settings'].items():
+                                key_dict.setdefault(mcx_k, []).append({profile["ProfileDisplayName"] : mcx_v})
+                    except (KeyError, TypeError, AttributeError):
+                        message = f'Unknown error processing settings in {profile["ProfileDisplayName"]}'
+                        if warnings is None:
+                            print(message, file=sys.stderr)
+                        else:
+                            warnings.append(message)
+                        continue
+            else:
+                key_dict.setdefault(key, []).append({profile["ProfileDisplayName"]: value})
+
+def plist_value(element):
+    """Convert a parsed plist XML element to the value plistlib would return for it.
+    """
+    tag = element.tag
+    if tag == 'dict':
+        children = list(element)
+        return {children[i].text or '': plist_value(children[i + 1]) for i in range(0, len(children) - 1, 2)}
+    if tag == 'array':
+        return [plist_value(child) for child in element]
+    if tag == 'string':
+        return element.text or ''
+    if tag == 'true':
+        return True
+    if tag == 'false':
+        return False
+    if tag in ('integer', 'real', 'date'):
+        text = (element.text or '').strip()
+        if not text:
+            raise ValueError(f'Empty <{tag}> element')
+        if tag == 'integer':
+            return int(text, 16) if text.lower().startswith('0x') else int(text)
+        if tag == 'real':
+            return float(text)
+        return datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ')
+    if tag == 'data':
+        return base64.b64decode(element.text or '')
+    raise ValueError(f'Unsupported plist element <{tag}>')
+
+def iter_profiles(stream):
+    """Yield the computer level profiles of a `profiles -P -o stdout-xml` dump one at a time.
+
+    The dump is parsed incrementally from stream and every profile is dropped from the
+    tree once it has been yielded, so memory use follows the largest profile rather than
+    the whole dump. Any text before the XML, like the "configuration profiles installed"
+    line, is skipped. Binary plist dumps can not be parsed incrementally and are loaded
+    whole with plistlib.
+    """
+    # skip to the start of the XML
+    head = b''
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            raise ValueError('No plist found')
+        head += chunk
+        if head.startswith(b'bplist00'):
+            head += stream.read()
+            profiles_dict = plistlib.loads(head)
+            yield from profiles_dict.get('_computerlevel', []) if isinstance(profiles_dict, dict) else []
+            return
+        start = head.find(b'<?xml')
+        if start == -1:
+            start = head.find(b'<plist')
+        if start != -1:
             break
+        # keep enough to match a tag split across reads
+        head = head[-6:]
+
+    parser = XMLPullParser(events=('start', 'end'))
+    chunk = head[start:]
+    stack = []
+    key = None
+    in_computerlevel = False
+    while chunk:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == 'start':
+                stack.append(element)
+                # plist > dict > array of the _computerlevel key
+                if len(stack) == 3 and element.tag == 'array' and key == '_computerlevel':
+                    in_computerlevel = True
+                continue
+
+            stack.pop()
+            if len(stack) == 3 and in_computerlevel and element.tag == 'dict':
+                yield plist_value(element)
+                stack[-1].remove(element)
+            elif len(stack) == 2:
+                if element.tag == 'key':
+                    key = element.text
+                else:
+                    in_computerlevel = False
+                # top level keys and values are not needed once read
+                stack[-1].remove(element)
+        chunk = stream.read(READ_SIZE)
+    parser.close()
+
+def find_conflicts(key_dict):
+    """Return the keys set to differing values and the profiles setting them.
+    """
+    conflicts = {}
+    for k,v in key_dict.items():
+        if len(v) > 1:
+            groups, keys_match = check_values(v)
+            if len(groups) > 1 and not keys_match:
+                conflicts[k] = tuple(sorted(name for item in v for name in item))
+    return conflicts
 
-    return same_values, same_keys
+def iter_dumps(path):
+    """Yield a (host, source) pair for every saved dump in a directory or archive.
+
+    Hosts are named after the path of their dump relative to the directory or archive,
+    without the extension, so a <host>/profiles.xml layout names them <host>/profiles.
+    Workers open members of plain tar archives at their offset in the archive, while
+    members of compressed tar archives are read whole here, as they can not be opened
+    again cheaply by the workers.
+    """
+    def host_name(name):
+        return os.path.splitext(name)[0]
+
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(DUMP_SUFFIXES):
+                    file_path = os.path.join(root, name)
+                    yield host_name(os.path.relpath(file_path, path)), ('file', file_path)
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if name.endswith(DUMP_SUFFIXES):
+                    yield host_name(name), ('zip', path, name)
+    elif tarfile.is_tarfile(path):
+        try:
+            archive = tarfile.open(path, 'r:')
+            compressed = False
+        except tarfile.ReadError:
+            archive = tarfile.open(path)
+            compressed = True
+        with archive:
+            for member in archive:
+                if not member.isfile() or not member.name.endswith(DUMP_SUFFIXES):
+                    continue
+                if compressed or member.issparse():
+                    yield host_name(member.name), ('data', archive.extractfile(member).read())
+                else:
+                    yield host_name(member.name), ('tar', path, member.offset_data, member.size)
+    else:
+        sys.exit(f"\n{path} is not a directory or a zip or tar archive of profile dumps.\n")
+
+class ArchiveMember:
+    """Reads size bytes of an open file from its current position.
+    """
+    def __init__(self, file, size):
+        self.file = file
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+@contextmanager
+def open_dump(source):
+    if source[0] == 'file':
+        with open(source[1], 'rb') as dump:
+            yield dump
+    elif source[0] == 'zip':
+        with zipfile.ZipFile(source[1]) as archive, archive.open(source[2]) as dump:
+            yield dump
+    elif source[0] == 'tar':
+        with open(source[1], 'rb') as archive:
+            archive.seek(source[2])
+            yield ArchiveMember(archive, source[3])
+    else:
+        yield io.BytesIO(source[1])
+
+def analyse_dump(host, source):
+    """Return the host, its conflicting keys, an error message if the dump can not be
+    analysed and the warnings raised while collecting its keys.
+    """
+    key_dict = {}
+    warnings = []
+    try:
+        with open_dump(source) as dump:
+            for profile in iter_profiles(dump):
+                collect_keys(profile, key_dict, warnings)
+    except (OSError, ValueError, ParseError, zipfile.BadZipFile) as e:
+        return host, {}, str(e) or type(e).__name__, warnings
+    except (KeyError, TypeError, AttributeError) as e:
+        # a well-formed dump that is not shaped like `profiles` output
+        return host, {}, f'unexpected profile layout ({type(e).__name__}: {e})', warnings
+
+    return host, find_conflicts(key_dict), None, warnings
+
+def analyse_dumps(dumps, jobs):
+    """Yield the result of analyse_dump for every dump, on a pool of jobs worker processes.
+
+    Only a few dumps per worker are in flight at a time, so a large archive is never
+    held in memory at once. Results are yielded as they complete.
+    """
+    if jobs <= 1:
+        for host, source in dumps:
+            yield analyse_dump(host, source)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        for host, source in dumps:
+            if len(pending) >= jobs * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(analyse_dump, host, source))
+        for future in pending:
+            yield future.result()
+
+def fleet_report(path, jobs):
+    hosts = 0
+    failed = []
+    key_hosts = Counter()
+    key_combinations = {}
+
+    for host, conflicts, error, warnings in analyse_dumps(iter_dumps(path), jobs):
+        for warning in warnings:
+            print(f'{host}: {warning}', file=sys.stderr)
+        if error:
+            failed.append((host, error))
+            continue
+        hosts += 1
+        for k, profile_names in conflicts.items():
+            key_hosts[k] += 1
+            key_combinations.setdefault(k, Counter())[profile_names] += 1
+
+    for host, error in sorted(failed):
+        print(f'Unable to read the profiles of {host}: {error}', file=sys.stderr)
+
+    for k, count in sorted(key_hosts.items(), key=lambda item: (-item[1], item[0])):
+        print('\033[93m' + f'\n{k}' + '\033[0m' + f' : conflicting values on {count} of {hosts} hosts')
+        for profile_names, combination_count in key_combinations[k].most_common():
+            print(f'{combination_count:>6} : ' + '\033[91m' + ', '.join(profile_names) + '\033[0m')
+
+    print(f'\n{hosts} hosts analysed, {len(key_hosts)} keys with conflicting values, {len(failed)} dumps could not be read')
+
+    infoblob = 'Output lists the keys that are set to different values by multiple configuration profiles on the analysed hosts, with the number of hosts affected. For every key, the combinations of profiles setting the differing values are listed in red along with the number of hosts carrying each combination. Keys set to the same value by all the profiles on a host are not counted.'
+
+    print('\n\n***** INFORMATION *****')
+    print(textwrap.fill(infoblob, 120))
+
+def parse_jobs(value):
+    jobs = int(value)
+    if jobs < 0:
+        raise argparse.ArgumentTypeError(f"Invalid job count: {value}")
+    return jobs or os.cpu_count() or 1
 
 def main():
+    parser = argparse.ArgumentParser(description='Report on keys being set in multiple configuration profiles.')
+    parser.add_argument('-d', '--dumps', default='',
+                        help='Directory or zip/tar archive of saved `profiles -P -o stdout-xml` dumps, one per host, to report on instead of this machine')
+    parser.add_argument('-j', '--jobs', type=parse_jobs, default=1,
+                        help='Number of worker processes used to analyse dumps, 0 for one per CPU core (default: 1)')
+    args = parser.parse_args()
+
+    if args.dumps:
+        fleet_report(args.dumps, args.jobs)
+        return
+
     if not os.geteuid() == 0:
         sys.exit("\nThis script must be run as root.\n")
 
@@ -46,53 +392,39 @@ def main():
     
     cmd = '/usr/bin/profiles -P -o stdout-xml | /usr/bin/grep -v "configuration profiles installed"'
 
-    profiles_bytes = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE).stdout
-    profiles_dict = plistlib.loads(profiles_bytes)
-
     key_dict = {}
-
-    for profile in profiles_dict["_computerlevel"]:
-        for items in profile["ProfileItems"]:
-            for key,value in items["PayloadContent"].items():
-                if key == "PayloadContentManagedPreferences":               
-                    for k,v in items["PayloadContent"]['PayloadContentManagedPreferences'].items():
-                        try:
-                            for mcx in items["PayloadContent"]['PayloadContentManagedPreferences'][k]['Forced']:
-                                for mcx_k,mcx_v in mcx['mcx_preference_settings'].items():
-                                    if mcx_k in key_dict:
-                                        key_dict[mcx_k].append({profile["ProfileDisplayName"] : mcx_v})
-                                    else:
-                                        key_dict[mcx_k] = [{profile["ProfileDisplayName"] : mcx_v}]
-                        except KeyError:
-                            print(f'Unknown error processing settings in {profile["ProfileDisplayName"]}')
-                            continue
-                else:
-                    if key in key_dict:
-                        key_dict[key].append({profile["ProfileDisplayName"]: value})
-                    else:
-                        key_dict[key] = [{profile["ProfileDisplayName"]: value}]
+    try:
+        with subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE) as proc:
+            for profile in iter_profiles(proc.stdout):
+                collect_keys(profile, key_dict)
+    except (ValueError, ParseError) as e:
+        # a truncated dump must not be reported on as if it held every profile
+        sys.exit(f"\nUnable to read the output of the profiles command: {e}\n")
 
     for k,v in key_dict.items():
         if len(v) > 1:
-            values_match, keys_match = check_values(v)
+            groups, keys_match = check_values(v)
 
             if keys_match:
                 continue
             else:
                 print('\033[93m' + f'\n{k}' + '\033[0m')
-                if values_match:
-                    color = '\033[92m'
+                if len(groups) == 1:
+                    labelled = [('\033[92m', '', v)]
                 else:
-                    color = '\033[91m'
+                    # profiles setting the same value are listed together, numbered by value
+                    labelled = [(GROUP_COLORS[n % len(GROUP_COLORS)], f'[{n + 1}] ', items)
+                        for n, items in enumerate(groups)]
 
-                for item in v:    
-                    for profile_name, value in item.items():
-                        if len(str(value)) > 60:
-                            print(f'{profile_name} : ' + color + f'{str(value)[:60]}...' + '\033[0m')   
-                        else:
-                            print(f'{profile_name} : ' + color + f'{str(value)}' + '\033[0m')
+                for color, label, items in labelled:
+                    for item in items:
+                        for profile_name, value in item.items():
+                            if len(str(value)) > 60:
+                                print(f'{profile_name} : ' + color + label + f'{str(value)[:60]}...' + '\033[0m')
+                            else:
+                                print(f'{profile_name} : ' + color + label + f'{str(value)}' + '\033[0m')
 
-    infoblob = 'Output indicates that multiple configuration profiles are defining values for the duplicate keys. This may result in unexpected behavior. For any keys (yellow) listed, the corresponding profile names, along with the values are provided. The values in green are the same, while values in red are different and may need review. Values have been truncated for readability.  NOTE: There are a number of keys that can be defined in multiple profiles with differing values. These are typically in application specific profiles, or seen in networking profiles or PPPC profiles. Red values in output do not necessarily indicate a problem, but rather listed to be reviewed.'
+    infoblob = 'Output indicates that multiple configuration profiles are defining values for the duplicate keys. This may result in unexpected behavior. For any keys (yellow) listed, the corresponding profile names, along with the values are provided. The values in green are the same, while values that are different are numbered, with the profiles setting the same value listed together in the same color, and may need review. Values are compared by type as well, so true and 1, or 1 and 1.0, are different values. Values have been truncated for readability.  NOTE: There are a number of keys that can be defined in multiple profiles with differing values. These are typically in application specific profiles, or seen in networking profiles or PPPC profiles. Differing values in output do not necessarily indicate a problem, but rather listed to be reviewed.'
 
     print(f'\n\n***** INFORMATION *****')
     print(textwrap.fill(infoblob, 120))
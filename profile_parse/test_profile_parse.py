@@ -0,0 +1,253 @@
+"""Tests for profile_parse.py
+
+The profile dumps are built with plistlib in the layout of
+`profiles -P -o stdout-xml`, so the tests run without macOS or root.
+Run with `python -m unittest` or pytest from this directory.
+"""
+
+import contextlib
+import datetime
+import io
+import os
+import plistlib
+import re
+import shutil
+import tarfile
+import tempfile
+import sys
+import unittest
+import zipfile
+from unittest import mock
+
+import profile_parse as pp
+
+BANNER = b"There are 2 configuration profiles installed\n"
+
+
+def make_dump(profiles, fmt=plistlib.FMT_XML, banner=BANNER):
+    """Return a dump of profiles, a {display name: payload content} dict, like `profiles` writes."""
+    computer_level = [
+        {"ProfileDisplayName": name, "ProfileIdentifier": f"com.example.{n}",
+         "ProfileItems": [{"PayloadType": "com.apple.ManagedClient.preferences", "PayloadContent": content}]}
+        for n, (name, content) in enumerate(profiles.items())
+    ]
+    data = plistlib.dumps({"_computerlevel": computer_level}, fmt=fmt)
+    return data if fmt == plistlib.FMT_BINARY else banner + data
+
+
+def read_profiles(data):
+    return list(pp.iter_profiles(io.BytesIO(data)))
+
+
+class IterProfilesTest(unittest.TestCase):
+    CONTENT = {
+        "Nested": {"Dict": {"Inner": {"Deep": [1, "two", {"Three": 3.5}]}}, "Empty": {}, "Array": [[], [[True]], {}]},
+        "Scalars": {
+            "Data": bytes(range(256)),
+            "Date": datetime.datetime(2024, 2, 29, 12, 30, 5),
+            "Real": -1.25e-7,
+            "Integer": -42,
+            "Big": 2 ** 63,
+            "Bools": [True, False],
+            "Text": "<&> caf\u00e9",
+        },
+    }
+
+    def assertMatchesPlistlib(self, data, xml=None):
+        expected = plistlib.loads(xml if xml is not None else data)["_computerlevel"]
+        self.assertEqual(read_profiles(data), expected)
+
+    def test_xml_dump_with_banner(self):
+        data = make_dump(self.CONTENT)
+        for read_size in (7, 100, pp.READ_SIZE):
+            with self.subTest(read_size=read_size), mock.patch.object(pp, "READ_SIZE", read_size):
+                self.assertMatchesPlistlib(data, data[len(BANNER):])
+
+    def test_xml_dump_without_banner(self):
+        self.assertMatchesPlistlib(make_dump(self.CONTENT, banner=b""))
+
+    def test_binary_dump(self):
+        self.assertMatchesPlistlib(make_dump(self.CONTENT, fmt=plistlib.FMT_BINARY))
+
+    def test_hex_and_negative_integers(self):
+        xml = make_dump({"Numbers": {"Hex": 0, "Negative": 0, "Zero": 0}}, banner=b"")
+        xml = (xml.replace(b"<integer>0</integer>", b"<integer>0x1F</integer>", 1)
+                  .replace(b"<integer>0</integer>", b"<integer>-17</integer>", 1))
+        self.assertMatchesPlistlib(BANNER + xml, xml)
+        self.assertEqual(read_profiles(xml)[0]["ProfileItems"][0]["PayloadContent"],
+                         {"Hex": 31, "Negative": -17, "Zero": 0})
+
+    def test_empty_scalars(self):
+        xml = make_dump({"Empty": {"String": "", "Data": b""}}, banner=b"")
+        xml = xml.replace(b"<string></string>", b"<string/>")
+        xml = re.sub(rb"<data>\s*</data>", b"<data/>", xml)
+        self.assertIn(b"<string/>", xml)
+        self.assertIn(b"<data/>", xml)
+        self.assertMatchesPlistlib(xml)
+
+    def test_empty_numbers_and_dates_are_rejected(self):
+        for tag in (b"integer", b"real", b"date"):
+            with self.subTest(tag=tag):
+                xml = make_dump({"Empty": {"Value": 1}}, banner=b"").replace(b"<integer>1</integer>", b"<%s/>" % tag)
+                # plistlib fails on an empty date with an AttributeError
+                with self.assertRaises((ValueError, AttributeError)):
+                    plistlib.loads(xml)
+                with self.assertRaises(ValueError):
+                    read_profiles(xml)
+
+    def test_truncated_dumps_are_reported(self):
+        data = make_dump({"First": {"Key": "value"}, "Second": {"Key": [1, 2]}})
+        end = data.rindex(b"</plist>")
+        for cut in range(len(BANNER) + 1, end):
+            with self.subTest(cut=cut), mock.patch.object(pp, "READ_SIZE", 64):
+                with self.assertRaises((ValueError, pp.ParseError)):
+                    read_profiles(data[:cut])
+
+    def test_truncated_binary_dump_is_reported(self):
+        data = make_dump(self.CONTENT, fmt=plistlib.FMT_BINARY)
+        for cut in (8, len(data) // 2, len(data) - 1):
+            with self.subTest(cut=cut):
+                with self.assertRaises((ValueError, pp.ParseError)):
+                    read_profiles(data[:cut])
+
+    def test_truncated_live_output_exits(self):
+        data = make_dump(self.CONTENT)[:-200]
+        process = mock.MagicMock()
+        process.__enter__.return_value.stdout = io.BytesIO(data)
+        stdout = io.StringIO()
+        with mock.patch.object(sys, "argv", ["profile_parse.py"]), \
+                mock.patch.object(pp.os, "geteuid", return_value=0, create=True), \
+                mock.patch.object(pp.subprocess, "Popen", return_value=process), \
+                contextlib.redirect_stdout(stdout):
+            with self.assertRaises(SystemExit) as raised:
+                pp.main()
+        self.assertIn("Unable to read the output of the profiles command", str(raised.exception.code))
+        self.assertEqual(stdout.getvalue(), "")
+
+
+class CanonicalHashTest(unittest.TestCase):
+    def test_dict_key_order_does_not_matter(self):
+        first = {"a": 1, "b": [{"x": True, "y": "z"}]}
+        second = {"b": [{"y": "z", "x": True}], "a": 1}
+        self.assertEqual(pp.canonical_hash(first), pp.canonical_hash(second))
+
+    def test_array_order_matters(self):
+        self.assertNotEqual(pp.canonical_hash([1, 2]), pp.canonical_hash([2, 1]))
+
+    def test_types_are_distinct(self):
+        values = [True, 1, 1.0, "1", b"1", [1], {"1": 1}]
+        hashes = {pp.canonical_hash(value) for value in values}
+        self.assertEqual(len(hashes), len(values))
+        self.assertNotEqual(pp.canonical_hash(False), pp.canonical_hash(0))
+
+    def test_strings_do_not_run_together(self):
+        self.assertNotEqual(pp.canonical_hash(["ab", "c"]), pp.canonical_hash(["a", "bc"]))
+
+
+class CheckValuesTest(unittest.TestCase):
+    def test_groups_follow_first_appearance(self):
+        entries = [{"A": {"x": 1, "y": 2}}, {"B": True}, {"C": {"y": 2, "x": 1}}, {"D": 1}]
+        groups, same_keys = pp.check_values(entries)
+        self.assertFalse(same_keys)
+        self.assertEqual(groups, [[{"A": {"x": 1, "y": 2}}, {"C": {"y": 2, "x": 1}}], [{"B": True}], [{"D": 1}]])
+
+    def test_matching_values_form_one_group(self):
+        groups, same_keys = pp.check_values([{"A": [1, 2]}, {"B": [1, 2]}])
+        self.assertEqual(len(groups), 1)
+        self.assertFalse(same_keys)
+
+    def test_profile_setting_key_twice(self):
+        self.assertTrue(pp.check_values([{"A": 1}, {"A": 2}])[1])
+
+    def test_conflicts_ignore_matching_values(self):
+        key_dict = {
+            "Same": [{"A": {"x": 1}}, {"B": {"x": 1}}],
+            "Differs": [{"B": 1}, {"A": True}],
+            "Single": [{"A": 1}],
+        }
+        self.assertEqual(pp.find_conflicts(key_dict), {"Differs": ("A", "B")})
+
+
+class FleetReportTest(unittest.TestCase):
+    # The profiles of alpha and beta set Screensaver to different values and those of
+    # delta set Firewall to true and 1, while gamma's agree; broken and layout can not be read
+    DUMPS = {
+        "alpha.xml": make_dump({"Security": {"Screensaver": 300, "Firewall": True}, "Baseline": {"Screensaver": 600}}),
+        "site/beta/profiles.xml": make_dump({"Baseline": {"Screensaver": 900}, "Security": {"Screensaver": 300}}),
+        "gamma.plist": make_dump({"Security": {"Screensaver": 300}, "Baseline": {"Screensaver": 300}}),
+        "delta.xml": make_dump({"Security": {"Firewall": True}, "Extra": {"Firewall": 1}}, fmt=plistlib.FMT_BINARY),
+        "broken.xml": b"profiles: error\n",
+        "layout.xml": plistlib.dumps({"_computerlevel": [{"ProfileItems": [{"PayloadContent": {"Key": 1}}]}]}),
+        "notes.txt": b"not a dump",
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="profile-parse-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.dumps = os.path.join(self.directory, "dumps")
+        for name, data in self.DUMPS.items():
+            path = os.path.join(self.dumps, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as dump:
+                dump.write(data)
+
+    def report(self, path, jobs=1):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            pp.fleet_report(path, jobs)
+        # drop the colors
+        return re.sub(r"\033\[\d+m", "", stdout.getvalue()), stderr.getvalue()
+
+    def archive(self, name):
+        path = os.path.join(self.directory, name)
+        if name.endswith(".zip"):
+            with zipfile.ZipFile(path, "w") as archive:
+                for dump in self.DUMPS:
+                    archive.write(os.path.join(self.dumps, dump), dump)
+        else:
+            with tarfile.open(path, "w:gz" if name.endswith(".tgz") else "w") as archive:
+                for dump in self.DUMPS:
+                    archive.add(os.path.join(self.dumps, dump), dump)
+        return path
+
+    def assertReport(self, path, jobs=1):
+        stdout, stderr = self.report(path, jobs)
+        self.assertIn("\nScreensaver : conflicting values on 2 of 4 hosts\n     2 : Baseline, Security\n", stdout)
+        self.assertIn("\nFirewall : conflicting values on 1 of 4 hosts\n     1 : Extra, Security\n", stdout)
+        self.assertIn("4 hosts analysed, 2 keys with conflicting values, 2 dumps could not be read", stdout)
+        self.assertIn("Unable to read the profiles of broken: No plist found", stderr)
+        self.assertIn("Unable to read the profiles of layout: unexpected profile layout (KeyError", stderr)
+        self.assertNotIn("gamma", stdout + stderr)
+
+    def test_directory(self):
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                self.assertReport(self.dumps, jobs)
+
+    def test_zip_archive(self):
+        self.assertReport(self.archive("dumps.zip"), 2)
+
+    def test_tar_archives(self):
+        for name in ("dumps.tar", "dumps.tgz"):
+            with self.subTest(name):
+                self.assertReport(self.archive(name), 2)
+
+    def test_hosts_are_named_relative_to_dumps(self):
+        expected = ["alpha", "broken", "delta", "gamma", "layout", "site/beta/profiles"]
+        for path in (self.dumps, self.archive("dumps.zip"), self.archive("dumps.tar")):
+            with self.subTest(path=os.path.basename(path)):
+                self.assertEqual(sorted(host for host, _ in pp.iter_dumps(path)), expected)
+
+    def test_warnings_name_the_host(self):
+        with open(os.path.join(self.dumps, "epsilon.xml"), "wb") as dump:
+            dump.write(make_dump({"Broken": {"PayloadContentManagedPreferences": {"com.example": {"Forced": 1}}}}))
+        _, stderr = self.report(self.dumps)
+        self.assertIn("epsilon: Unknown error processing settings in Broken", stderr)
+
+    def test_not_a_dump_location(self):
+        with self.assertRaises(SystemExit):
+            list(pp.iter_dumps(os.path.join(self.dumps, "notes.txt")))
+
+
+if __name__ == "__main__":
+    unittest.main()